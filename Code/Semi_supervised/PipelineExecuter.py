@@ -1,5 +1,6 @@
 import os
 import sys
+import json
 import torch
 import random
 import numpy
@@ -10,6 +11,8 @@ ROOT_DIR = os.path.dirname(os.path.dirname(os.getcwd()))
 sys.path.insert(1, ROOT_DIR + "/")
 sys.path.insert(0, ROOT_DIR + "/")
 from Code.Semi_supervised.Train.Pipeline import Pipeline
+from Code.Utils.distributed import initDistributed, cleanup
+from Code.Utils.artifacts import ArtifactStore
 
 torch.manual_seed(42)
 torch.backends.cudnn.benchmark = False
@@ -20,19 +23,27 @@ log_date = datetime.now().strftime("%Y.%m.%d")
 logging.getLogger('matplotlib.font_manager').disabled = True
 
 
-def preTrainM0(SEED, device="cuda", isChaos=True, train=False):
+def preTrainM0(SEED, device="cuda", isChaos=True, train=False, resume=False):
     """
     Use for pre training model M0
+    With an artifact store the stage always goes through the store, it only trains when no finished M0 matches;
+    the weights are then trained or restored in the weights directory of this run
     :return: best weights model path
     """
+    store = getArtifactStore()
+    train = train or store is not None
     if isChaos:
         obj = Pipeline(chaos_dataset_path, modelWeights_path, log_path, "chaos", device=device, seed_value=SEED,
-                       loss_fn=Loss_fn, model_type=Model_name)
+                       loss_fn=Loss_fn, model_type=Model_name, val_interval=VAL_INTERVAL, patience=PATIENCE,
+                       batch_size=BATCH_SIZE, accum_steps=ACCUM_STEPS, pretrained_path=pretrainedWeights_path,
+                       artifact_store=store, profile=PROFILE)
     else:
         obj = Pipeline(clinical_dataset_path, modelWeights_path, log_path, "chaos", device=device, seed_value=SEED,
-                       loss_fn=Loss_fn, model_type=Model_name)
+                       loss_fn=Loss_fn, model_type=Model_name, val_interval=VAL_INTERVAL, patience=PATIENCE,
+                       batch_size=BATCH_SIZE, accum_steps=ACCUM_STEPS, pretrained_path=pretrainedWeights_path,
+                       artifact_store=store, profile=PROFILE)
     if train:
-        obj.trainModel_M0(epochs=M0_EPOCHS)
+        obj.trainModel_M0(epochs=M0_EPOCHS, resume=resume)
     else:
         logging.info("############################# Model M0 : Using saved weights #############################")
     M0_model_path = obj.M0_model_base
@@ -41,8 +52,29 @@ def preTrainM0(SEED, device="cuda", isChaos=True, train=False):
     return M0_model_path, M0_model_path_bw
 
 
+def getOption(name, default=None):
+    # Optional "--name value" pair on the command line
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+def getDevice(cuda):
+    return "cpu" if cuda == "cpu" else "cuda:{}".format(cuda)
+
+
+def getArtifactStore():
+    return None if artifactStore_path is None else ArtifactStore(artifactStore_path)
+
+
+def rankSuffix(distributed):
+    # Every rank but 0 logs into its own file
+    rank = os.environ.get("RANK", "0")
+    return "_rank" + rank if distributed and rank != "0" else ""
+
+
 ##################################################
-def chaos_unified(cuda, seed):
+def chaos_unified(cuda, seed, resume=False, distributed=False):
     """
         Step 1:
             Pre train the M0 model
@@ -51,22 +83,32 @@ def chaos_unified(cuda, seed):
         Step 3 :
             Test Chaos
     """
-    CUDA = "cuda:{}".format(cuda)
-    log_file_path = log_path + "Chaos_{}_{}_Unified_{}_{}".format(Model_name, Loss_fn, seed, log_date) + "_log.txt"
+    CUDA = getDevice(cuda)
+    log_file_path = log_path + "Chaos_{}_{}_Unified_{}_{}".format(Model_name, Loss_fn, seed, log_date) \
+                    + rankSuffix(distributed) + "_log.txt"
     logging.basicConfig(filename=log_file_path, filemode='w', level=logging.DEBUG)
+    if distributed:
+        # One process per device (or CPU process with gloo), the device argument is replaced by the local rank
+        CUDA = initDistributed(CUDA)
 
     # Pre train the M0 model
-    M0_model_path, M0_model_path_bw = preTrainM0(SEED=seed, device=CUDA, train=False)
+    M0_model_path, M0_model_path_bw = preTrainM0(SEED=seed, device=CUDA, train=False, resume=resume)
 
     # Train the mode in combined mode : isM0Frozen=False, isM1Frozen=False
     obj = Pipeline(chaos_dataset_path, modelWeights_path, log_path, "chaos", isM0Frozen=False, isM1Frozen=False,
-                   device=CUDA, seed_value=seed, loss_fn=Loss_fn, model_type=Model_name)
+                   device=CUDA, seed_value=seed, loss_fn=Loss_fn, model_type=Model_name,
+                   val_interval=VAL_INTERVAL, patience=PATIENCE,
+                   batch_size=BATCH_SIZE, accum_steps=ACCUM_STEPS, pretrained_path=pretrainedWeights_path,
+                   artifact_store=getArtifactStore(), flow_cache_path=flowCache_path,
+                   profile=PROFILE)
     modelM0 = obj.getModelM0(M0_model_path_bw)
-    obj.trainModel_M1(modelM0, epochs=M1_EPOCHS, logger=True, TestModel=True)
+    metrics = obj.trainModel_M1(modelM0, epochs=M1_EPOCHS, logger=True, TestModel=True, resume=resume)
+    cleanup()
     logging.getLogger().removeHandler(logging.getLogger().handlers[0])
+    return metrics
 
 
-def chaos_sequential(cuda, seed):
+def chaos_sequential(cuda, seed, resume=False, distributed=False):
     """
         Step 1:
             Pre train the M0 model
@@ -77,31 +119,44 @@ def chaos_sequential(cuda, seed):
         Step 3:
             Test Chaos
     """
-    CUDA = "cuda:{}".format(cuda)
+    CUDA = getDevice(cuda)
 
     # Logging
-    log_file_path = log_path + "Chaos_{}_{}_Sequential_{}_{}".format(Model_name, Loss_fn, seed, log_date) + "_log.txt"
+    log_file_path = log_path + "Chaos_{}_{}_Sequential_{}_{}".format(Model_name, Loss_fn, seed, log_date) \
+                    + rankSuffix(distributed) + "_log.txt"
     logging.basicConfig(filename=log_file_path, filemode='w', level=logging.DEBUG)
+    if distributed:
+        CUDA = initDistributed(CUDA)
 
     # Part 1: Pre train the M0 model
-    M0_model_path, M0_model_path_bw = preTrainM0(SEED=seed, device=CUDA, train=False)
+    M0_model_path, M0_model_path_bw = preTrainM0(SEED=seed, device=CUDA, train=False, resume=resume)
 
     # Part 2: Train model M1 while M0 frozen [isM0Frozen=False, isM1Frozen=False]
     obj_0 = Pipeline(chaos_dataset_path, modelWeights_path, log_path, "chaos",
                      isM0Frozen=True, isM1Frozen=False, device=CUDA,
-                     seed_value=seed, loss_fn=Loss_fn, model_type=Model_name)
+                     seed_value=seed, loss_fn=Loss_fn, model_type=Model_name,
+                     val_interval=VAL_INTERVAL, patience=PATIENCE,
+                     batch_size=BATCH_SIZE, accum_steps=ACCUM_STEPS, pretrained_path=pretrainedWeights_path,
+                     artifact_store=getArtifactStore(), flow_cache_path=flowCache_path,
+                     profile=PROFILE)
     modelM0 = obj_0.getModelM0(M0_model_path_bw)
-    obj_0.trainModel_M1(modelM0, epochs=M1_EPOCHS, logger=True)
+    obj_0.trainModel_M1(modelM0, epochs=M1_EPOCHS, logger=True, resume=resume)
 
     # Part 3: Train model M0 while M1 frozen [isM0Frozen=False, isM1Frozen=True]
     # Passing the M1 weight paths and Model M0 from previous object
     obj_1 = Pipeline(chaos_dataset_path, modelWeights_path, log_path, "chaos",
                      M1_model_path=obj_0.M1_model_path, M1_bw_path=obj_0.M1_bw_path,
                      isM0Frozen=False, isM1Frozen=True, device=CUDA,
-                     seed_value=seed, loss_fn=Loss_fn, model_type=Model_name)
-
-    obj_1.trainModel_M1(modelM0, epochs=M1_EPOCHS, logger=True, TestModel=True)
+                     seed_value=seed, loss_fn=Loss_fn, model_type=Model_name,
+                     val_interval=VAL_INTERVAL, patience=PATIENCE,
+                     batch_size=BATCH_SIZE, accum_steps=ACCUM_STEPS, pretrained_path=pretrainedWeights_path,
+                     artifact_store=getArtifactStore(), flow_cache_path=flowCache_path,
+                     profile=PROFILE)
+
+    metrics = obj_1.trainModel_M1(modelM0, epochs=M1_EPOCHS, logger=True, TestModel=True, resume=resume)
+    cleanup()
     logging.getLogger().removeHandler(logging.getLogger().handlers[0])
+    return metrics
 
 
 ##################################################
@@ -148,13 +203,43 @@ def clinical_sequential(SEED):
 
 ##################################################
 def main():
+    global Loss_fn, Model_name, modelWeights_path, log_path, artifactStore_path, flowCache_path, PROFILE, \
+        chaos_dataset_path
     print('cmd entry:', sys.argv)
+    # Optional overrides of the module settings, used by SweepRunner
+    Loss_fn = getOption("--loss", Loss_fn)
+    Model_name = getOption("--model", Model_name)
+    chaos_dataset_path = os.path.join(getOption("--dataset", chaos_dataset_path), "")
+    threads = getOption("--threads")
+    if threads is not None:
+        # The modules limit torch to one thread when they are imported, the budget of the run is applied afterwards
+        torch.set_num_threads(int(threads))
+    workdir = getOption("--workdir")
+    if workdir is not None:
+        # Weights and logs of this run go to their own directory, the pre-trained M0 weights stay shared
+        modelWeights_path = os.path.join(workdir, "model_weights", "")
+        log_path = os.path.join(workdir, "Logs", "")
+        os.makedirs(modelWeights_path, exist_ok=True)
+        os.makedirs(log_path, exist_ok=True)
+    metrics_path = getOption("--metrics")
+    # Stages whose configuration, seed, data and upstream weights match a stored artifact are not recomputed
+    artifactStore_path = getOption("--artifacts", artifactStore_path)
+    # M0 is tested and fine-tuned against a fixed M1 without registering the same pairs again
+    flowCache_path = getOption("--flow-cache", flowCache_path)
+    # Per-phase step timing, synchronizes the device at every phase boundary
+    PROFILE = PROFILE or "--profile" in sys.argv
+    metrics = None
+    # Continue every stage from its saved training state, stages that already finished are skipped
+    resume = "--resume" in sys.argv
+    # Data parallel over all processes started by torchrun, e.g.
+    # torchrun --nproc_per_node=4 PipelineExecuter.py 1 0 42 --distributed
+    distributed = "--distributed" in sys.argv
     if sys.argv[1] == "1":
         print("Executing Chaos Unified - cuda:{} , seed-value:{}, Loss-Function:{}, Model:{}".format(sys.argv[2], sys.argv[3], Loss_fn, Model_name))
-        chaos_unified(sys.argv[2], int(sys.argv[3]))
+        metrics = chaos_unified(sys.argv[2], int(sys.argv[3]), resume, distributed)
     elif sys.argv[1] == "2":
         print("Executing Chaos Sequential - cuda:{} , seed-value:{}, Loss-Function:{}, Model:{}".format(sys.argv[2], sys.argv[3], Loss_fn, Model_name))
-        chaos_sequential(sys.argv[2], int(sys.argv[3]))
+        metrics = chaos_sequential(sys.argv[2], int(sys.argv[3]), resume, distributed)
     elif sys.argv[1] == "3":
         print("Executing Clinical unified")
         # clinical_unified()
@@ -164,15 +249,35 @@ def main():
     else:
         print("Wrong Argument")
 
+    if metrics_path is not None and metrics is not None:
+        with open(metrics_path, "w") as f:
+            json.dump(metrics, f, indent=2)
+
 ##################################################
 modelWeights_path = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/"
 log_path = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/Logs/runs/"
 chaos_dataset_path = "/project/mukhopad/tmp/LiverTumorSeg/Dataset/chaos_3D/"
 clinical_dataset_path = "/project/mukhopad/tmp/LiverTumorSeg/Dataset/chaos_3D/"
+pretrainedWeights_path = modelWeights_path
+# Directory of the stage artifact store (None: every stage trains, M0 uses the saved pre-trained weights)
+artifactStore_path = None
+# Directory of the cached Mscgunet registrations, keyed by image pair and M1 weights (None: no cache)
+flowCache_path = None
 
 M0_EPOCHS = 250
 M1_EPOCHS = 1200
 
+# Validate every VAL_INTERVAL epochs, stop after PATIENCE validations without improvement (None: run all epochs)
+VAL_INTERVAL = 1
+PATIENCE = None
+
+# Volumes per step and number of steps whose gradients are accumulated before an optimizer update
+BATCH_SIZE = 1
+ACCUM_STEPS = 1
+
+# Per-phase step timing of the trainers, off by default as it synchronizes the device at every phase boundary
+PROFILE = False
+
 Loss_fn = "TFL"
 # Loss_fn = "Dice"
 
@@ -182,4 +287,6 @@ Model_name = "Unet"
 
 if __name__ == "__main__":
     main()
-    # PipelineExecutor.py --ExecutionType --CUDA --SEED
+    # PipelineExecutor.py --ExecutionType --CUDA|cpu --SEED [--resume] [--distributed] [--loss TFL|Dice]
+    #                     [--model Unet|DeepSup] [--workdir DIR] [--metrics FILE.json]
+    #                     [--artifacts DIR] [--flow-cache DIR] [--profile] [--dataset DIR] [--threads N]
@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+import subprocess
+from collections import deque
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(1, ROOT_DIR + "/")
+sys.path.insert(0, ROOT_DIR + "/")
+
+from Code.Utils.results import ResultStreamWriter
+
+# PipelineExecuter expects to be started from its own directory
+SEMI_SUPERVISED_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODES = {"unified": "1", "sequential": "2"}
+METRIC_COLUMNS = ["dice", "soft_dice", "jaccard", "precision", "sensitivity", "volume_difference", "hd95", "asd",
+                  "loss_0", "loss_1"]
+RESULT_COLUMNS = ["job", "mode", "model", "loss_fn", "seed", "device", "returncode", "runtime_s"] + METRIC_COLUMNS
+
+
+def expandGrid(seeds, loss_fns, models, modes):
+    return [{"seed": seed, "loss_fn": loss_fn, "model": model, "mode": mode}
+            for mode, model, loss_fn, seed in itertools.product(modes, models, loss_fns, seeds)]
+
+
+def jobName(job):
+    return "{}_{}_{}_{}".format(job["mode"], job["model"], job["loss_fn"], job["seed"])
+
+
+def prewarmCache(dataset_path):
+    """
+    Fills the shared preprocessing cache of the M1 dataset once, so the concurrent runs only read it
+    """
+    from Code.Semi_supervised.Train.Model_M1.M1_main import M1_Pipeline
+    from Code.Semi_supervised.Train.Model_M1.M1_dataloader import CustomDataset
+    from Code.Utils.CSVGenerator import checkCSV_Student
+
+    obj = M1_Pipeline(dataset_path, "", "", loss_fn="", model_type="", isChaos=True)
+    checkCSV_Student(dataset_Path=obj.dataset_path, csv_FileName=obj.csv_file, overwrite=False)
+    dataset = CustomDataset(obj.dataset_path, obj.csv_file, obj.transform_val, obj.isChaos, obj.ct_level,
+                            obj.ct_window)
+    since = time.time()
+    dataset.prewarm()
+    logging.info("Cache of {} subjects ready in {:.0f}s".format(len(dataset), time.time() - since))
+
+
+class SweepRunner:
+    """
+    Runs one PipelineExecuter process per job, at most one job per slot at a time
+    A slot is a device ("0", "1", ... for cuda:N or "cpu"); list a device several times to share it between jobs.
+    Every job writes its weights and logs into output_dir/<job>/ and its test metrics into metrics.json, which are
+    collected into output_dir/results.csv as soon as the job finishes. Jobs sharing an artifact store reuse the stages
+    they have in common, e.g. the M0 pre-training of one model and loss; jobs sharing a flow cache reuse the
+    registrations of identical M1 weights.
+    """
+
+    def __init__(self, jobs, slots, output_dir, threads_per_job=1, resume=False, skip_done=True, poll_interval=10,
+                 artifacts=None, flow_cache=None, dataset_path=None):
+        self.jobs = jobs
+        self.slots = list(slots)
+        self.output_dir = output_dir
+        self.threads_per_job = threads_per_job
+        self.resume = resume
+        self.skip_done = skip_done
+        self.poll_interval = poll_interval
+        self.artifacts = artifacts
+        self.flow_cache = flow_cache
+        # Dataset of every job, None keeps the one configured in PipelineExecuter
+        self.dataset_path = dataset_path
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def workdir(self, job):
+        return os.path.join(os.path.abspath(self.output_dir), jobName(job))
+
+    def metricsPath(self, job):
+        return os.path.join(self.workdir(job), "metrics.json")
+
+    def command(self, job, device):
+        cmd = [sys.executable, "PipelineExecuter.py", MODES[job["mode"]], device, str(job["seed"]),
+               "--loss", job["loss_fn"], "--model", job["model"],
+               "--workdir", self.workdir(job), "--metrics", self.metricsPath(job),
+               "--threads", str(self.threads_per_job)]
+        if self.dataset_path is not None:
+            cmd += ["--dataset", os.path.abspath(self.dataset_path)]
+        if self.resume:
+            cmd.append("--resume")
+        if self.artifacts is not None:
+            cmd += ["--artifacts", os.path.abspath(self.artifacts)]
+        if self.flow_cache is not None:
+            cmd += ["--flow-cache", os.path.abspath(self.flow_cache)]
+        return cmd
+
+    def launch(self, job, device):
+        os.makedirs(self.workdir(job), exist_ok=True)
+        # Every job gets the same CPU thread budget, so concurrent jobs do not oversubscribe the cores
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.threads_per_job), MKL_NUM_THREADS=str(self.threads_per_job))
+        stdout = open(os.path.join(self.workdir(job), "stdout.txt"), "a")
+        process = subprocess.Popen(self.command(job, device), cwd=SEMI_SUPERVISED_DIR, env=env, stdout=stdout,
+                                   stderr=subprocess.STDOUT)
+        logging.info("Started " + jobName(job) + " on " + device)
+        return process, stdout
+
+    def collect(self, job, device, returncode, runtime):
+        row = dict(job, job=jobName(job), device=device, returncode=returncode, runtime_s=runtime)
+        if os.path.isfile(self.metricsPath(job)):
+            with open(self.metricsPath(job)) as f:
+                metrics = json.load(f)
+            row.update({name: metrics.get(name) for name in METRIC_COLUMNS})
+        return row
+
+    def run(self):
+        pending = deque()
+        writer = ResultStreamWriter(os.path.join(self.output_dir, "results.csv"), RESULT_COLUMNS,
+                                    string_columns=("job", "mode", "model", "loss_fn", "device"))
+        for job in self.jobs:
+            if self.skip_done and os.path.isfile(self.metricsPath(job)):
+                logging.info("Skipping finished job " + jobName(job))
+                continue
+            pending.append(job)
+
+        free = list(self.slots)
+        running = []
+        while pending or running:
+            while pending and free:
+                job = pending.popleft()
+                device = free.pop(0)
+                process, stdout = self.launch(job, device)
+                running.append((process, stdout, job, device, time.time()))
+
+            time.sleep(self.poll_interval)
+            for entry in list(running):
+                process, stdout, job, device, start = entry
+                if process.poll() is None:
+                    continue
+                stdout.close()
+                running.remove(entry)
+                free.append(device)
+                row = self.collect(job, device, process.returncode, time.time() - start)
+                writer.write(row)
+                logging.info("Finished " + jobName(job) + " with return code " + str(process.returncode))
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a grid of PipelineExecuter configurations")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[42])
+    parser.add_argument("--loss", nargs="+", default=["TFL", "Dice"], choices=["TFL", "Dice"])
+    parser.add_argument("--models", nargs="+", default=["Unet", "DeepSup"], choices=["Unet", "DeepSup"])
+    parser.add_argument("--modes", nargs="+", default=["unified", "sequential"], choices=list(MODES))
+    parser.add_argument("--devices", nargs="+", default=["0"], help="CUDA device indices and/or cpu")
+    parser.add_argument("--jobs-per-device", type=int, default=1)
+    parser.add_argument("--threads-per-job", type=int, default=1)
+    parser.add_argument("--output", default="sweep/")
+    parser.add_argument("--dataset", default="/project/mukhopad/tmp/LiverTumorSeg/Dataset/chaos_3D/")
+    parser.add_argument("--no-prewarm", action="store_true")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--artifacts", default=None, help="shared stage artifact store")
+    parser.add_argument("--flow-cache", default=None, help="shared cache of the M1 registrations")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.no_prewarm:
+        prewarmCache(args.dataset)
+
+    jobs = expandGrid(args.seeds, args.loss, args.models, args.modes)
+    slots = [device for device in args.devices for _ in range(args.jobs_per_device)]
+    logging.info("{} jobs on {} slots".format(len(jobs), len(slots)))
+    SweepRunner(jobs, slots, args.output, args.threads_per_job, args.resume,
+                artifacts=args.artifacts, flow_cache=args.flow_cache, dataset_path=args.dataset).run()
+
+
+if __name__ == "__main__":
+    main()
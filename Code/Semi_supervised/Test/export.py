@@ -0,0 +1,178 @@
+import os
+import sys
+import logging
+import argparse
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.getcwd())))
+sys.path.insert(1, ROOT_DIR + "/")
+sys.path.insert(0, ROOT_DIR + "/")
+
+from Code.Semi_supervised.mscgunet.train import Mscgunet
+from Code.Utils.inferenceBenchmark import compare, maxAbsDiff, RESULT_COLUMNS
+from Code.Utils.results import ResultStreamWriter
+from Model.M0 import U_Net_M0
+from Model.DeepSupAttUNet3D import DeepSupAttentionUnet
+
+# Mscgunet builds its sampling grids for this volume size, M0 accepts any multiple of 16
+INPUT_SHAPE = (1, 1, 32, 128, 128)
+
+
+class FinalHead(nn.Module):
+    """
+    DeepSupAttentionUnet exported with the final map only
+    """
+
+    def __init__(self, model):
+        super(FinalHead, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.forward_final(x)
+
+
+class RegistrationGraph(nn.Module):
+    """
+    Mscgunet inference path with a fixed signature: CT, MRI, MRI label -> warped MRI, pseudo label, flow
+    """
+
+    def __init__(self, modelM1):
+        super(RegistrationGraph, self).__init__()
+        self.inference = modelM1.inference
+
+    def forward(self, CT, MRI, MRI_LBL):
+        warped, pseudo_lbl, full_flow, _ = self.inference(CT, MRI, MRI_LBL)
+        return warped, pseudo_lbl, full_flow
+
+
+def loadM0(weights_path, model_type):
+    if model_type == "DeepSup":
+        model = DeepSupAttentionUnet(1, 1)
+    else:
+        model = U_Net_M0()
+    if weights_path is not None:
+        model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    model.eval()
+    return FinalHead(model).eval() if model_type == "DeepSup" else model
+
+
+def loadM1(weights_path):
+    modelM1 = Mscgunet(device="cpu")
+    if weights_path is not None:
+        modelM1.initializeModel(weights_path)
+    return RegistrationGraph(modelM1).eval()
+
+
+def exampleInputs(name, shape=INPUT_SHAPE, seed=42):
+    generator = torch.Generator().manual_seed(seed)
+    if name == "M1":
+        return [torch.rand(shape, generator=generator), torch.rand(shape, generator=generator),
+                (torch.rand(shape, generator=generator) > 0.5).float()]
+    return [torch.rand(shape, generator=generator)]
+
+
+def exportModel(model, inputs, path, export_format="torchscript", opset=20):
+    """
+    Traces the model on the example inputs, the graph is specialized to their shapes
+    :return: path of the exported graph
+    """
+    with torch.no_grad():
+        if export_format == "torchscript":
+            traced = torch.jit.trace(model, tuple(inputs), check_trace=False)
+            traced = torch.jit.freeze(traced)
+            torch.jit.save(traced, path)
+        else:
+            # 5D grid_sample (SpatialTransformer, VecInt) needs the GridSample operator of opset 20
+            num_outputs = 3 if len(inputs) == 3 else 1
+            torch.onnx.export(model, tuple(inputs), path, opset_version=opset,
+                              input_names=["input_{}".format(i) for i in range(len(inputs))],
+                              output_names=["output_{}".format(i) for i in range(num_outputs)])
+    logging.info("Exported " + path)
+    return path
+
+
+def loadExported(path):
+    """
+    :return: callable taking and returning torch tensors
+    """
+    if path.endswith(".onnx"):
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        names = [inp.name for inp in session.get_inputs()]
+
+        def run(*inputs):
+            outputs = session.run(None, {name: inp.numpy() for name, inp in zip(names, inputs)})
+            outputs = [torch.from_numpy(out) for out in outputs]
+            return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+        return run
+    return torch.jit.load(path, map_location="cpu")
+
+
+def checkParity(model, exported, inputs, atol=1e-4):
+    """
+    Largest absolute difference between the eager model and the exported graph over all outputs
+    """
+    with torch.no_grad():
+        expected = model(*inputs)
+        actual = exported(*inputs)
+    if isinstance(expected, torch.Tensor):
+        expected, actual = [expected], [actual]
+    diff = max(maxAbsDiff(a, e) for a, e in zip(actual, expected))
+    (logging.info if diff <= atol else logging.warning)("Parity max|diff| {:.2e} (tolerance {:.0e})".format(diff, atol))
+    return diff
+
+
+def firstOutput(fn):
+    # The benchmark compares the first output (the warped MRI for M1)
+    def run(*inputs):
+        output = fn(*inputs)
+        return output if isinstance(output, torch.Tensor) else output[0]
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export M0 and M1 for CPU inference and compare them with PyTorch")
+    parser.add_argument("--m0-weights", help="exports M0 when given")
+    parser.add_argument("--model", default="Unet", choices=["Unet", "DeepSup"])
+    parser.add_argument("--m1-weights", help="exports the Mscgunet inference path when given")
+    parser.add_argument("--format", default="torchscript", choices=["torchscript", "onnx"])
+    parser.add_argument("--opset", type=int, default=20)
+    parser.add_argument("--output", default="exported/")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    torch.set_num_threads(args.threads)
+    os.makedirs(args.output, exist_ok=True)
+    extension = ".pt" if args.format == "torchscript" else ".onnx"
+
+    models = {}
+    if args.m0_weights is not None:
+        models["M0_" + args.model] = ("M0", loadM0(args.m0_weights, args.model))
+    if args.m1_weights is not None:
+        models["M1"] = ("M1", loadM1(args.m1_weights))
+    if not models:
+        parser.error("nothing to export, give --m0-weights and/or --m1-weights")
+
+    writer = ResultStreamWriter(os.path.join(args.output, "export_benchmark.csv"), RESULT_COLUMNS,
+                                string_columns=("benchmark", "variant", "device", "shape"))
+    for name, (kind, model) in models.items():
+        inputs = exampleInputs(kind)
+        path = exportModel(model, inputs, os.path.join(args.output, name + extension), args.format, args.opset)
+        exported = loadExported(path)
+        checkParity(model, exported, inputs, args.atol)
+        for row in compare(name, {"eager": firstOutput(model), args.format: firstOutput(exported)}, inputs, "cpu",
+                           repeats=args.repeats):
+            writer.write(row)
+            print("{:<12} {:<12} median {:9.2f} ms  max|diff| {:.2e}  speedup {:.2f}x".format(
+                name, row["variant"], row["median_ms"], row["max_abs_diff"], row["speedup"]))
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()
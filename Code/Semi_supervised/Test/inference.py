@@ -0,0 +1,335 @@
+import os
+import sys
+import time
+import queue
+import logging
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import torch
+import torch.nn.functional as f
+import torchio as tio
+from torch.utils.data.dataset import Dataset
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.getcwd())))
+sys.path.insert(1, ROOT_DIR + "/")
+sys.path.insert(0, ROOT_DIR + "/")
+
+from Code.Semi_supervised.mscgunet.train import Mscgunet
+from Code.Utils.loss import normalize_per_sample
+from Code.Utils.slidingWindow import slidingWindowInference
+from Code.Utils.tta import ttaPredict
+from Model.M0 import U_Net_M0
+from Model.DeepSupAttUNet3D import DeepSupAttentionUnet
+
+_STOP = object()
+
+
+def _single(batch):
+    return batch[0]
+
+
+def listPairs(input_dir):
+    """
+    Pairs of a directory laid out like the datasets: ct/<name>, mri/<name> and optionally mri_gt/<name>
+    """
+    rows = []
+    for name in sorted(os.listdir(os.path.join(input_dir, "ct"))):
+        mri_lbl = os.path.join(input_dir, "mri_gt", name)
+        rows.append({"name": name.split(".")[0], "ct": os.path.join(input_dir, "ct", name),
+                     "mri": os.path.join(input_dir, "mri", name),
+                     "mri_lbl": mri_lbl if os.path.isfile(mri_lbl) else ""})
+    return rows
+
+
+def readManifest(csv_path):
+    """
+    CSV with a header and the columns ct, mri, optional mri_lbl and optional name
+    """
+    data = pd.read_csv(csv_path).fillna("")
+    rows = []
+    for idx, row in data.iterrows():
+        rows.append({"name": row["name"] if "name" in row and row["name"] else os.path.basename(row["ct"]).split(".")[0],
+                     "ct": row["ct"], "mri": row["mri"], "mri_lbl": row["mri_lbl"] if "mri_lbl" in row else ""})
+    return rows
+
+
+class InferenceDataset(Dataset):
+    """
+    Reads and decodes one CT/MRI pair with the preprocessing of the M1 dataset, runs in the DataLoader workers
+    """
+
+    def __init__(self, pairs, transform_val=(32, 128, 128), level=50, window=350, isChaos=True):
+        self.pairs = pairs
+        self.transform_val = transform_val
+        self.level = level
+        self.window = window
+        self.isChaos = isChaos
+
+    def __getitem__(self, index):
+        pair = self.pairs[index]
+        ct_img = tio.ScalarImage(pair["ct"])
+        ct = ct_img[tio.DATA].permute(0, 3, 1, 2).float()
+        ct = self.normalize(ct.clamp(self.level - self.window / 2, self.level + self.window / 2))
+        native_shape = ct.shape[1:]
+        ct = f.interpolate(ct.unsqueeze(0), size=self.transform_val).squeeze(0)
+
+        mri = tio.ScalarImage(pair["mri"])[tio.DATA].permute(0, 3, 1, 2).float()
+        mri = f.interpolate(self.normalize(mri).unsqueeze(0), size=self.transform_val).squeeze(0)
+
+        has_lbl = bool(pair["mri_lbl"])
+        if has_lbl:
+            mri_lbl = tio.ScalarImage(pair["mri_lbl"])[tio.DATA].permute(0, 3, 1, 2).float()
+            if self.isChaos:
+                # Using the liver section in the MRI label
+                mri_lbl = ((mri_lbl >= 55) & (mri_lbl <= 70)).float()
+            mri_lbl = f.interpolate(mri_lbl.unsqueeze(0), size=self.transform_val).squeeze(0)
+        else:
+            mri_lbl = torch.zeros_like(mri)
+
+        # Voxel to world mapping of the model grid: the CT affine scaled by the resize factor of every axis
+        # (the model volumes are (D, W, H), the NIfTI axes (W, H, D))
+        scale = [native_shape[1] / self.transform_val[1], native_shape[2] / self.transform_val[2],
+                 native_shape[0] / self.transform_val[0], 1.]
+        affine = ct_img.affine @ np.diag(scale)
+        return ct, mri, mri_lbl, has_lbl, affine, pair["name"]
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @staticmethod
+    def normalize(img):
+        return (img - img.min()) / (img.max() - img.min() + 1e-8)
+
+
+class NativeCTDataset(InferenceDataset):
+    """
+    CT volumes windowed and normalized like the M1 dataset but kept at their native resolution
+    """
+
+    def __getitem__(self, index):
+        pair = self.pairs[index]
+        ct_img = tio.ScalarImage(pair["ct"])
+        ct = ct_img[tio.DATA].permute(0, 3, 1, 2).float()
+        ct = self.normalize(ct.clamp(self.level - self.window / 2, self.level + self.window / 2))
+        return ct, ct_img.affine, pair["name"]
+
+
+def saveNifti(volume, affine, path, dtype):
+    """
+    :param volume: CPU tensor (D, W, H), written with the NIfTI axes (W, H, D)
+    """
+    # nibabel picks the compression from the extension, so the temporary file keeps it
+    tmp_path = os.path.join(os.path.dirname(path), ".{}.tmp.{}.{}.nii.gz".format(
+        os.path.basename(path).split(".")[0], os.getpid(), threading.get_ident()))
+    data = volume.permute(1, 2, 0).numpy().astype(dtype)
+    nib.save(nib.Nifti1Image(data, affine), tmp_path)
+    os.replace(tmp_path, path)
+
+
+class NiftiWriter:
+    """
+    Compresses and writes volumes on background threads fed by a bounded queue
+    gzip releases the GIL, so a few threads keep up with the GPU; a full queue blocks the producer
+    """
+
+    def __init__(self, output_dir, workers=2, maxsize=8):
+        self.output_dir = output_dir
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.written = 0
+        self.threads = [threading.Thread(target=self._run, name="NiftiWriter_{}".format(i), daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, volume, affine, name, dtype):
+        """
+        :param volume: CPU tensor (D, W, H) on the model grid
+        """
+        if self.error is not None:
+            raise RuntimeError("Writing the segmentations failed") from self.error
+        self.queue.put((volume, affine, name, dtype))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                volume, affine, name, dtype = item
+                saveNifti(volume, affine, os.path.join(self.output_dir, name + ".nii.gz"), dtype)
+                self.written += 1
+            except Exception as e:
+                logging.exception("Writing " + str(item[2]) + " failed")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise RuntimeError("Writing the segmentations failed") from self.error
+
+
+class Inference_Pipeline:
+    """
+    Batch inference over CT/MRI pairs: M1 registers the MRI (and its label) onto the CT, M0 segments the warped MRI
+    Reading and decoding (DataLoader workers), compute (main thread) and compressed writing (writer threads) overlap,
+    connected by the bounded DataLoader prefetch and the writer queue.
+    Writes <output>/warped_mri/, <output>/pseudo_lbl/ (pairs with an MRI label) and <output>/ct_seg/ as NIfTI.
+    Mscgunet is built for the (32, 128, 128) grid, the outputs are written on that grid with a rescaled CT affine.
+    runNative segments the CT itself and writes <output>/ct_seg_native/ instead.
+    """
+
+    def __init__(self, M0_bw_path, M1_bw_path, output_dir, model_type="Unet", device="cuda", batch_size=1,
+                 readers=4, writers=2, queue_size=8, threshold=0.5, transform_val=(32, 128, 128), tta=False):
+        self.M0_bw_path = M0_bw_path
+        self.M1_bw_path = M1_bw_path
+        self.output_dir = output_dir
+        self.model_type = model_type
+        self.device = device
+        self.batch_size = batch_size
+        self.readers = readers
+        self.writers = writers
+        self.queue_size = queue_size
+        self.threshold = threshold
+        self.transform_val = transform_val
+        self.tta = tta
+        for folder in ("warped_mri", "pseudo_lbl", "ct_seg", "ct_seg_native"):
+            os.makedirs(os.path.join(self.output_dir, folder), exist_ok=True)
+
+    def defineModelM0(self):
+        if self.model_type == "DeepSup":
+            model = DeepSupAttentionUnet(1, 1)
+        else:
+            model = U_Net_M0()
+        model.load_state_dict(torch.load(self.M0_bw_path, map_location=self.device))
+        return model.to(self.device).eval()
+
+    def defineModelM1(self):
+        modelM1 = Mscgunet(device=self.device)
+        modelM1.initializeModel(self.M1_bw_path)
+        return modelM1
+
+    @torch.no_grad()
+    def segment(self, modelM0, modelM1, ct, mri, mri_lbl):
+        warped, pseudo_lbl, _, _ = modelM1.register(ct, mri, mri_lbl)
+        # Only the final head of DeepSup, the deep supervision branches are not needed at inference
+        predict = modelM0.forward_final if self.model_type == "DeepSup" else modelM0
+        if self.tta:
+            output = ttaPredict(predict, normalize_per_sample(warped))
+        else:
+            output = predict(normalize_per_sample(warped))
+        return warped, pseudo_lbl, output
+
+    def run(self, pairs):
+        logging.info("############################# START Batch Inference #############################")
+        modelM0 = self.defineModelM0()
+        modelM1 = self.defineModelM1()
+        dataset = InferenceDataset(pairs, self.transform_val)
+        # Each reader keeps up to two batches decoded ahead of the compute stage
+        loader = torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, num_workers=self.readers,
+                                             pin_memory=str(self.device).startswith("cuda"))
+        writer = NiftiWriter(self.output_dir, self.writers, self.queue_size)
+
+        since = time.time()
+        compute_time = 0.
+        num_pairs = 0
+        for ct, mri, mri_lbl, has_lbl, affine, names in loader:
+            start = time.time()
+            warped, pseudo_lbl, output = self.segment(modelM0, modelM1, ct, mri, mri_lbl)
+            # One transfer per batch, the writer threads only see CPU tensors
+            warped, pseudo_lbl, output = warped.float().cpu(), pseudo_lbl.cpu(), output.float().cpu()
+            compute_time += time.time() - start
+
+            for i, name in enumerate(names):
+                writer.submit(warped[i, 0], affine[i].numpy(), os.path.join("warped_mri", name), np.float32)
+                if has_lbl[i]:
+                    writer.submit((pseudo_lbl[i, 0] >= self.threshold).to(torch.uint8), affine[i].numpy(),
+                                  os.path.join("pseudo_lbl", name), np.uint8)
+                writer.submit((output[i, 0] >= self.threshold).to(torch.uint8), affine[i].numpy(),
+                              os.path.join("ct_seg", name), np.uint8)
+            num_pairs += len(names)
+        writer.close()
+
+        time_elapsed = time.time() - since
+        logging.info("Segmented {} pairs in {:.1f}s ({:.2f} pairs/s), compute {:.1f}s ({:.0f}% of the wall time)".format(
+            num_pairs, time_elapsed, num_pairs / max(time_elapsed, 1e-8), compute_time,
+            100. * compute_time / max(time_elapsed, 1e-8)))
+        logging.info("############################# END Batch Inference #############################")
+        return num_pairs
+
+
+    def runNative(self, pairs, patch_size=(32, 128, 128), overlap=0.5, sw_batch_size=4):
+        """
+        Segments the CT volumes with M0 alone at their native resolution, tiled by a sliding window
+        M0 is trained on MRI and, in the pipeline, segments the MRI warped onto the CT; here it is applied to the
+        windowed CT directly, i.e. outside its training domain (the warped MRI only exists on the Mscgunet grid).
+        The results go to <output>/ct_seg_native/ with the original CT affine, separate from the ct_seg/ of run().
+        """
+        logging.info("############################# START Native Resolution Inference #############################")
+        modelM0 = self.defineModelM0()
+        # Native volumes differ in size, every batch holds one volume
+        loader = torch.utils.data.DataLoader(NativeCTDataset(pairs), batch_size=1, num_workers=self.readers,
+                                             collate_fn=_single)
+        writer = NiftiWriter(self.output_dir, self.writers, self.queue_size)
+
+        since = time.time()
+        num_volumes = 0
+        for ct, affine, name in loader:
+            output = slidingWindowInference(modelM0, ct, patch_size, overlap, sw_batch_size, device=self.device,
+                                            tta=self.tta)
+            writer.submit((output[0, 0] >= self.threshold).to(torch.uint8), affine,
+                          os.path.join("ct_seg_native", name), np.uint8)
+            num_volumes += 1
+        writer.close()
+        logging.info("Segmented {} volumes in {:.1f}s".format(num_volumes, time.time() - since))
+        logging.info("############################# END Native Resolution Inference #############################")
+        return num_volumes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register and segment a cohort of CT/MRI pairs into NIfTI files")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="directory with ct/, mri/ and optionally mri_gt/")
+    source.add_argument("--manifest", help="CSV with the columns ct, mri, [mri_lbl], [name]")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--m0-weights", required=True)
+    parser.add_argument("--m1-weights", help="not needed with --native")
+    parser.add_argument("--model", default="Unet", choices=["Unet", "DeepSup"])
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--native", action="store_true",
+                        help="segment the CT volumes directly with M0 (trained on MRI) at native resolution by a "
+                             "sliding window, written to ct_seg_native/")
+    parser.add_argument("--patch-size", type=int, nargs=3, default=[32, 128, 128])
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--sw-batch-size", type=int, default=4)
+    parser.add_argument("--tta", action="store_true", help="average M0 over flipped and rotated views")
+    args = parser.parse_args()
+    if not args.native and args.m1_weights is None:
+        parser.error("--m1-weights is required unless --native is given")
+
+    logging.basicConfig(level=logging.INFO)
+    pairs = listPairs(args.input) if args.input is not None else readManifest(args.manifest)
+    obj = Inference_Pipeline(args.m0_weights, args.m1_weights, args.output, args.model, args.device,
+                             args.batch_size, args.readers, args.writers, args.queue_size, args.threshold,
+                             tta=args.tta)
+    if args.native:
+        obj.runNative(pairs, tuple(args.patch_size), args.overlap, args.sw_batch_size)
+    else:
+        obj.run(pairs)
+
+
+if __name__ == "__main__":
+    main()
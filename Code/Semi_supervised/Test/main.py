@@ -1,7 +1,9 @@
 import os
 import sys
+import json
 import torch
 import logging
+import tempfile
 
 os.environ['HTTP_PROXY'] = 'http://proxy:3128/'
 os.environ['HTTPS_PROXY'] = 'http://proxy:3128/'
@@ -18,13 +20,16 @@ from Code.Semi_supervised.mscgunet.train import Mscgunet
 from Code.Semi_supervised.Train.Model_M1.M1_dataloader import CustomDataset
 from Code.Semi_supervised.Test.test import test
 from Code.Utils.CSVGenerator import checkCSV_Student
+from Code.Utils.artifacts import stageKey, dataManifest, fileHash
+from Code.Utils.flowCache import FlowCache
 from Model.M0 import U_Net_M0
 from Model.DeepSupAttUNet3D import DeepSupAttentionUnet
 
 
 class Test_Pipeline:
     def __init__(self, M0_model_path, M0_bw_path, M1_model_path, M1_bw_path, dataset_path, logPath,
-                 device, loss_fn, model_type):
+                 device, loss_fn, model_type, batch_size=1, artifact_store=None, seed_value=None, tta=False,
+                 flow_cache_path=None):
         # Model Weights
         self.M0_model_path = M0_model_path
         self.M0_bw_path = M0_bw_path
@@ -32,7 +37,7 @@ class Test_Pipeline:
         self.M1_bw_path = M1_bw_path
         self.logPath = logPath + "_Test/"
 
-        self.batch_size = 1
+        self.batch_size = batch_size
         self.lr = 1e-4
 
         self.csv_file = "dataset.csv"
@@ -49,6 +54,22 @@ class Test_Pipeline:
 
         self.loss_fn = loss_fn
         self.model_type = model_type
+        self.tta = tta
+
+        # Metrics of weights that were already tested on the same split are reused from the store
+        self.artifact_store = artifact_store
+        self.seed_value = seed_value
+
+        # Registrations of the M1 weights are cached per image pair, testing other M0 weights skips them
+        self.flow_cache_path = flow_cache_path
+        self.flow_cache = None if flow_cache_path is None else FlowCache(flow_cache_path, self.M1_bw_path)
+
+    def artifactKey(self):
+        config = {"loss_fn": self.loss_fn, "model_type": self.model_type, "batch_size": self.batch_size,
+                  "transform_val": self.transform_val, "ct_level": self.ct_level, "ct_window": self.ct_window,
+                  "tta": self.tta, "flow_cache": None if self.flow_cache is None else self.flow_cache.config()}
+        return stageKey("Test", config, self.seed_value, dataManifest(self.dataset_path),
+                        [fileHash(self.M0_bw_path), fileHash(self.M1_bw_path)])
 
     def defineModelM0(self):
         if self.model_type == "DeepSup":
@@ -69,10 +90,20 @@ class Test_Pipeline:
         logging.info("Logging Enabled  : " + str(logger))
         logging.info("M0 Loss Function : " + self.loss_fn)
         logging.info("M0 Model Type    : " + self.model_type)
+        logging.info("Test-time Augm.  : " + str(self.tta))
+        logging.info("Flow Cache       : " + str(self.flow_cache_path))
 
     def testModel(self, test_loader=None, logger=True):
         self.displayDetails(logger)
 
+        key = None
+        if self.artifact_store is not None:
+            key = self.artifactKey()
+            if self.artifact_store.get(key) is not None:
+                logging.info("Reusing test metrics of artifact " + key)
+                with open(self.artifact_store.filePath(key, "metrics")) as f:
+                    return json.load(f)
+
         logging.debug("Loading Models for Testing")
         modelM0 = self.defineModelM0()
         modelM0.load_state_dict(torch.load(self.M0_bw_path,map_location=self.device))
@@ -88,24 +119,33 @@ class Test_Pipeline:
             # Training and Validation Section
             test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=self.batch_size, shuffle=True)
 
-        test(test_loader, modelM0, modelM1, model_type=self.model_type, logPath=self.logPath, device=self.device)
+        metrics = test(test_loader, modelM0, modelM1, model_type=self.model_type, logPath=self.logPath,
+                       device=self.device, tta=self.tta, flow_cache=self.flow_cache)
+        if key is not None:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                metrics_path = os.path.join(tmp_dir, "metrics.json")
+                with open(metrics_path, "w") as f:
+                    json.dump(metrics, f, indent=2)
+                self.artifact_store.commit(key, "Test", {"metrics": metrics_path})
+        return metrics
 
 
-m0 = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/M0_chaos_M1_Frozen_TFL_DeepSup.pth"
-m0_bw = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/M0_bw_chaos_M1_Frozen_TFL_DeepSup.pth"
+if __name__ == "__main__":
+    m0 = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/M0_chaos_M1_Frozen_TFL_DeepSup.pth"
+    m0_bw = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/M0_bw_chaos_M1_Frozen_TFL_DeepSup.pth"
 
-m1 = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/M1_chaos_M0_Frozen_TFL_DeepSup.pth"
-m1_bw = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/M1_bw_chaos_M0_Frozen_TFL_DeepSup.pth"
+    m1 = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/M1_chaos_M0_Frozen_TFL_DeepSup.pth"
+    m1_bw = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/model_weights/M1_bw_chaos_M0_Frozen_TFL_DeepSup.pth"
 
-d = "/project/mukhopad/tmp/LiverTumorSeg/Dataset/chaos_3D/"
-l = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/Logs/runs/"
+    d = "/project/mukhopad/tmp/LiverTumorSeg/Dataset/chaos_3D/"
+    l = "/project/mukhopad/tmp/LiverTumorSeg/Code/Semi_supervised/Logs/runs/"
 
-model_type = "DeepSup"
-# model_type = "Unet"
+    model_type = "DeepSup"
+    # model_type = "Unet"
 
-loss_fn = "TFL"
-# loss_fn = "Dice"
+    loss_fn = "TFL"
+    # loss_fn = "Dice"
 
-ob = Test_Pipeline(M0_model_path=m0, M0_bw_path=m0_bw, M1_model_path=m1, M1_bw_path=m1_bw, dataset_path=d,
-                   logPath=l, device="cuda:4", model_type=model_type, loss_fn=loss_fn)
-ob.testModel()
+    ob = Test_Pipeline(M0_model_path=m0, M0_bw_path=m0_bw, M1_model_path=m1, M1_bw_path=m1_bw, dataset_path=d,
+                       logPath=l, device="cuda:4", model_type=model_type, loss_fn=loss_fn)
+    ob.testModel()
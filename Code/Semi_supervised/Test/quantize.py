@@ -0,0 +1,104 @@
+import os
+import sys
+import copy
+import logging
+import argparse
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.getcwd())))
+sys.path.insert(1, ROOT_DIR + "/")
+sys.path.insert(0, ROOT_DIR + "/")
+
+from Code.Semi_supervised.Train.Model_M0.M0_main import M0_Pipeline
+from Code.Semi_supervised.Test.export import loadM0
+from Code.Utils.inferenceBenchmark import compare, RESULT_COLUMNS
+from Code.Utils.loss import dice_per_sample
+from Code.Utils.results import ResultStreamWriter
+
+
+def quantizeM0(model, calibration_loader, num_batches=8, backend="fbgemm"):
+    """
+    Post-training static int8 quantization (FX graph mode) of an M0 model for CPU inference
+    prepare_fx folds every Conv3d + BatchNorm3d (+ ReLU) of conv_block, up_conv and UnetConv3D into one quantized
+    convolution; the observers are calibrated on num_batches batches of the training split.
+    :param model: float model in eval mode, DeepSupAttentionUnet wrapped to its final head
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    example_inputs = (next(iter(calibration_loader))[0].unsqueeze(1).float(),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs)
+
+    with torch.no_grad():
+        for idx, (image, _) in enumerate(calibration_loader):
+            if idx == num_batches:
+                break
+            prepared(image.unsqueeze(1).float())
+    logging.info("Calibrated on {} batches".format(min(idx + 1, num_batches)))
+    return convert_fx(prepared)
+
+
+def evaluateDice(model, loader):
+    """
+    Mean Dice of the model on a split of the teacher dataset, the same measure as the M0 validation accuracy
+    """
+    scores = []
+    with torch.no_grad():
+        for image, label in loader:
+            output = model(image.unsqueeze(1).float())
+            scores.append(dice_per_sample(output.float(), label.unsqueeze(1).float()))
+    return torch.cat(scores).mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize M0 to int8 and report its Dice and CPU speed against float32")
+    parser.add_argument("--dataset", default="/project/mukhopad/tmp/LiverTumorSeg/Dataset/chaos_3D/")
+    parser.add_argument("--m0-weights", required=True)
+    parser.add_argument("--model", default="Unet", choices=["Unet", "DeepSup"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--calibration-batches", type=int, default=8)
+    parser.add_argument("--backend", default="fbgemm", choices=["fbgemm", "qnnpack", "x86"])
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--output", default="M0_int8.pt", help="TorchScript file of the quantized model")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    torch.set_num_threads(args.threads)
+
+    # Same split as the M0 training: calibration on the training volumes, Dice on the held-out ones
+    obj = M0_Pipeline(args.dataset, "", "", loss_fn="", model_type=args.model, isChaos=True, device="cpu",
+                      seed_val=args.seed)
+    train_dataset, val_dataset = obj.train_val_split(overwrite_csv=False)
+    calibration_loader = torch.utils.data.DataLoader(train_dataset, batch_size=1, shuffle=True,
+                                                     generator=torch.Generator().manual_seed(args.seed))
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=1)
+
+    model = loadM0(args.m0_weights, args.model)
+    quantized = quantizeM0(model, calibration_loader, args.calibration_batches, args.backend)
+
+    dice_float = evaluateDice(model, val_loader)
+    dice_int8 = evaluateDice(quantized, val_loader)
+    logging.info("Dice float32 {:.4f}  int8 {:.4f}  delta {:+.4f}".format(dice_float, dice_int8,
+                                                                           dice_int8 - dice_float))
+
+    example = next(iter(val_loader))[0].unsqueeze(1).float()
+    rows = compare("M0_" + args.model + "_int8", {"float32": model, "int8": quantized}, [example], "cpu",
+                   repeats=args.repeats)
+    with torch.no_grad():
+        torch.jit.save(torch.jit.trace(quantized, (example,)), args.output)
+    logging.info("Saved the quantized model to " + args.output)
+
+    writer = ResultStreamWriter(os.path.splitext(args.output)[0] + "_benchmark.csv", RESULT_COLUMNS + ["dice"],
+                                string_columns=("benchmark", "variant", "device", "shape"))
+    for row, dice in zip(rows, [dice_float, dice_int8]):
+        writer.write(dict(row, dice=dice))
+        print("{:<8} Dice {:.4f}  median {:9.2f} ms  speedup {:.2f}x".format(row["variant"], dice, row["median_ms"],
+                                                                            row["speedup"]))
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()
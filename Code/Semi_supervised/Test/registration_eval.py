@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import resource
+import numpy as np
+import torch
+from concurrent.futures import as_completed
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.getcwd())))
+sys.path.insert(1, ROOT_DIR + "/")
+sys.path.insert(0, ROOT_DIR + "/")
+
+from Code.Semi_supervised.mscgunet.train import Mscgunet
+from Code.Semi_supervised.Train.Model_M1.M1_main import M1_Pipeline
+from Code.Utils.metrics import ncc, mutualInformation, segmentationMetrics, jacobianDeterminant, foldingFraction
+from Code.Utils.ssim3d import ssim3d
+from Code.Utils.results import ResultStreamWriter
+from Code.Utils.antsImpl import RegistrationService, registration
+
+# peak_memory_mb is the host memory a job added on top of its process, peak_device_mb the CUDA allocator peak;
+# a memory that cannot be attributed to the job alone is NaN
+RESULT_COLUMNS = ["subject", "method", "runtime_s", "peak_memory_mb", "peak_device_mb", "ncc", "mi", "ssim", "dice",
+                  "folding", "error"]
+
+
+def registrationMetrics(fixed, warped, fixed_lbl=None, warped_lbl=None):
+    """
+    Common metric set shared by the learned and the classical registrations
+    :param fixed: fixed (CT) volume, numpy array (D, H, W) in [0, 1]
+    :param warped: moving (MRI) volume warped onto the fixed grid
+    """
+    row = {"ncc": ncc(fixed, warped),
+           "mi": mutualInformation(fixed, warped),
+           "ssim": ssim3d(torch.from_numpy(np.ascontiguousarray(fixed, dtype=np.float32)),
+                          torch.from_numpy(np.ascontiguousarray(warped, dtype=np.float32))).item()}
+    if fixed_lbl is not None and warped_lbl is not None:
+        row["dice"] = segmentationMetrics(warped_lbl, fixed_lbl, surface=False)["dice"][0]
+    return row
+
+
+def peakRSS_MB():
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def normalize(img):
+    return (img - img.min()) / (img.max() - img.min() + 1e-8)
+
+
+def _runAntsJob(subject, transform, ct, mri, mri_gt, ct_gt, tmp_root):
+    """
+    Runs in a freshly spawned worker of an isolated RegistrationService. The process starts with the imports of this
+    module only, its ru_maxrss growth from the start of the job is the host memory of the registration.
+    """
+    import ants
+
+    baseline = peakRSS_MB()
+
+    row = dict.fromkeys(RESULT_COLUMNS)
+    row.update(subject=subject, method="ANTs_" + transform)
+    try:
+        fixed = ants.from_numpy(ct)
+        moving = ants.from_numpy(mri)
+        with registration(fixed, moving, transform, tmp_root, prefix="{}_{}_".format(subject, transform)) \
+                as (mytx, runtime):
+            row["runtime_s"] = runtime
+
+            warped_lbl = None
+            if mri_gt is not None:
+                warped_lbl = ants.apply_transforms(fixed=fixed, moving=ants.from_numpy(mri_gt),
+                                                   transformlist=mytx["fwdtransforms"],
+                                                   interpolator="nearestNeighbor").numpy()
+            row.update(registrationMetrics(ct, normalize(mytx["warpedmovout"].numpy()), ct_gt, warped_lbl))
+
+            # Folding of the deformable part, linear transforms only fold if they flip the orientation
+            deformable = [t for t in mytx["fwdtransforms"] if t.endswith(".nii.gz")]
+            if deformable:
+                jac = ants.create_jacobian_determinant_image(fixed, deformable[0]).numpy()
+                row["folding"] = foldingFraction(jac)[0]
+            else:
+                matrix = np.asarray(ants.read_transform(mytx["fwdtransforms"][0]).parameters[:9]).reshape(3, 3)
+                row["folding"] = float(np.linalg.det(matrix) <= 0)
+        row["peak_memory_mb"] = peakRSS_MB() - baseline
+        row["peak_device_mb"] = float("nan")
+    except Exception as e:
+        row["error"] = repr(e)
+    return row
+
+
+class Registration_Evaluator:
+    def __init__(self, dataset_path, M1_bw_path, output_path, device="cuda", transforms=("SyN", "Affine"),
+                 seed_value=42, workers=4, threads_per_job=1, tmp_root=None):
+        self.dataset_path = dataset_path
+        self.M1_bw_path = M1_bw_path
+        self.output_path = output_path
+        self.device = device
+        self.transforms = list(transforms)
+        self.seed = seed_value
+        self.workers = workers
+        self.threads_per_job = threads_per_job
+        self.tmp_root = tmp_root
+
+    def getTestLoader(self):
+        # Same split (and the same cached, preprocessed volumes) as the M1 training runs
+        obj = M1_Pipeline(self.dataset_path, "", "", loss_fn="", model_type="", device=self.device, isChaos=True,
+                          seed_val=self.seed)
+        return obj.train_val_test_slit()[2]
+
+    def evaluateMscgunet(self, modelM1, ct, mri, mri_gt, ct_gt):
+        isCuda = str(self.device).startswith("cuda")
+        if isCuda:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        since = time.time()
+        warped, pseudo_lbl, full_flow, _ = modelM1.register(ct, mri, mri_gt)
+        if isCuda:
+            torch.cuda.synchronize(self.device)
+        # The host peak of this process includes the dataset and the model, it is not attributable to the registration
+        row = {"runtime_s": time.time() - since, "peak_memory_mb": float("nan"),
+               "peak_device_mb": torch.cuda.max_memory_allocated(self.device) / 2 ** 20 if isCuda else float("nan")}
+
+        warped = warped.squeeze().cpu().numpy()
+        pseudo_lbl = pseudo_lbl.squeeze().cpu().numpy()
+        row.update(registrationMetrics(ct.squeeze().numpy(), normalize(warped), ct_gt.squeeze().numpy(), pseudo_lbl))
+        row["folding"] = foldingFraction(jacobianDeterminant(full_flow))[0]
+        return row
+
+    def evaluate(self):
+        logging.info("############################# START Registration Evaluation #############################")
+        modelM1 = Mscgunet(device=self.device)
+        modelM1.initializeModel(self.M1_bw_path)
+
+        writer = ResultStreamWriter(self.output_path, RESULT_COLUMNS, string_columns=("subject", "method", "error"))
+        jobs = []
+        warm = False
+        for idx, batch in enumerate(self.getTestLoader()):
+            mri, mri_gt, ct, ct_gt = batch[:4]
+            subject = str(batch[4].item()) if len(batch) == 5 else str(idx)
+
+            if not warm:
+                # Untimed warm-up so that the first subject does not pay for kernel selection and allocation
+                modelM1.register(ct, mri, mri_gt)
+                warm = True
+
+            row = dict.fromkeys(RESULT_COLUMNS)
+            row.update(subject=subject, method="Mscgunet")
+            row.update(self.evaluateMscgunet(modelM1, ct, mri, mri_gt, ct_gt))
+            writer.write(row)
+            logging.info(str(row))
+
+            for transform in self.transforms:
+                jobs.append((subject, transform, ct.squeeze().numpy().astype(np.float32),
+                             mri.squeeze().numpy().astype(np.float32), mri_gt.squeeze().numpy().astype(np.float32),
+                             ct_gt.squeeze().numpy(), self.tmp_root))
+
+        with RegistrationService(workers=self.workers, threads_per_job=self.threads_per_job, isolated=True) as service:
+            for future in as_completed([service.submitJob(_runAntsJob, *job) for job in jobs]):
+                row = future.result()
+                writer.write(row)
+                logging.info(str(row))
+        writer.close()
+        logging.info("############################# END Registration Evaluation #############################")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Mscgunet against ANTs on the cached test pairs")
+    parser.add_argument("--dataset", default="/project/mukhopad/tmp/LiverTumorSeg/Dataset/chaos_3D/")
+    parser.add_argument("--m1-weights", required=True)
+    parser.add_argument("--output", default="registration_eval.csv")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--transforms", nargs="+", default=["SyN", "Affine"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads-per-job", type=int, default=1)
+    args = parser.parse_args()
+
+    obj = Registration_Evaluator(args.dataset, args.m1_weights, args.output, args.device, args.transforms,
+                                 args.seed, args.workers, args.threads_per_job)
+    obj.evaluate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.getcwd())))
+sys.path.insert(1, ROOT_DIR + "/")
+sys.path.insert(0, ROOT_DIR + "/")
+
+from Code.Semi_supervised.Test.inference import Inference_Pipeline, InferenceDataset, saveNifti
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error",
+               503: "Service Unavailable"}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100. * len(values)))]
+
+
+class InferenceService:
+    """
+    Keeps M0 and M1 loaded and serves segmentation requests over a local HTTP API
+    Requests are decoded on a thread pool and queued; the batcher groups the queued pairs into one forward pass of at
+    most max_batch_size pairs, waiting at most max_wait_ms for the batch to fill. The models run on a single compute
+    thread, so the event loop keeps accepting requests meanwhile.
+
+    POST /segment  {"ct": path, "mri": path, "mri_lbl": optional path, "name": optional, "output": optional dir}
+    GET  /metrics  queue depth, batch sizes and latency percentiles
+    GET  /health
+    """
+
+    def __init__(self, M0_bw_path, M1_bw_path, output_dir, model_type="Unet", device="cuda", max_batch_size=4,
+                 max_wait_ms=20, max_queue=64, io_workers=4, threshold=0.5):
+        self.pipeline = Inference_Pipeline(M0_bw_path, M1_bw_path, output_dir, model_type, device,
+                                           batch_size=max_batch_size, threshold=threshold)
+        self.output_dir = output_dir
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.max_queue = max_queue
+
+        logging.info("Loading models")
+        self.modelM0 = self.pipeline.defineModelM0()
+        self.modelM1 = self.pipeline.defineModelM1()
+
+        self.compute_executor = ThreadPoolExecutor(1, thread_name_prefix="compute")
+        self.io_executor = ThreadPoolExecutor(io_workers, thread_name_prefix="io")
+        self.queue = None
+
+        self.started = time.time()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+        self.in_flight = 0
+        self.latencies = deque(maxlen=1000)
+        self.batch_sizes = deque(maxlen=1000)
+        self.compute_times = deque(maxlen=1000)
+
+    def computeBatch(self, samples):
+        ct, mri, mri_lbl = [torch.stack([sample[i] for sample in samples]) for i in range(3)]
+        warped, pseudo_lbl, output = self.pipeline.segment(self.modelM0, self.modelM1, ct, mri, mri_lbl)
+        return warped.float().cpu(), pseudo_lbl.cpu(), output.float().cpu()
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.time()
+            try:
+                warped, pseudo_lbl, output = await loop.run_in_executor(self.compute_executor, self.computeBatch,
+                                                                        [sample for sample, _ in items])
+            except Exception as e:
+                logging.exception("Batch of {} pairs failed".format(len(items)))
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            self.compute_times.append(time.time() - start)
+            self.batch_sizes.append(len(items))
+            self.num_batches += 1
+            for i, (_, future) in enumerate(items):
+                future.set_result((warped[i, 0], pseudo_lbl[i, 0], output[i, 0]))
+
+    def writeOutputs(self, sample, warped, pseudo_lbl, output, output_dir):
+        _, _, _, has_lbl, affine, name = sample
+        paths = {"warped_mri": os.path.join(output_dir, "warped_mri", name + ".nii.gz"),
+                 "pseudo_lbl": os.path.join(output_dir, "pseudo_lbl", name + ".nii.gz") if has_lbl else None,
+                 "ct_seg": os.path.join(output_dir, "ct_seg", name + ".nii.gz")}
+        for path in paths.values():
+            if path is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        saveNifti(warped, affine, paths["warped_mri"], np.float32)
+        if has_lbl:
+            saveNifti((pseudo_lbl >= self.pipeline.threshold).to(torch.uint8), affine, paths["pseudo_lbl"], np.uint8)
+        saveNifti((output >= self.pipeline.threshold).to(torch.uint8), affine, paths["ct_seg"], np.uint8)
+        return paths
+
+    async def segment(self, request):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        pair = {"ct": request["ct"], "mri": request["mri"], "mri_lbl": request.get("mri_lbl", ""),
+                "name": request.get("name") or os.path.basename(request["ct"]).split(".")[0]}
+        dataset = InferenceDataset([pair], self.pipeline.transform_val)
+        sample = await loop.run_in_executor(self.io_executor, dataset.__getitem__, 0)
+
+        future = loop.create_future()
+        await self.queue.put((sample, future))
+        warped, pseudo_lbl, output = await future
+
+        paths = await loop.run_in_executor(self.io_executor, self.writeOutputs, sample, warped, pseudo_lbl, output,
+                                           request.get("output", self.output_dir))
+        latency = time.time() - start
+        self.latencies.append(latency)
+        return dict(paths, name=pair["name"], latency_s=latency)
+
+    def metrics(self):
+        return {"uptime_s": time.time() - self.started,
+                "requests": self.num_requests,
+                "errors": self.num_errors,
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+                "batches": self.num_batches,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+                "mean_compute_s": float(np.mean(self.compute_times)) if self.compute_times else None,
+                "latency_p50_s": percentile(self.latencies, 50),
+                "latency_p95_s": percentile(self.latencies, 95),
+                "latency_p99_s": percentile(self.latencies, 99)}
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        if method == "POST" and path == "/segment":
+            if self.in_flight >= self.max_queue:
+                return 503, {"error": "too many pending requests"}
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                request = None
+            if not isinstance(request, dict) or "ct" not in request or "mri" not in request:
+                return 400, {"error": "expected a JSON body with ct and mri paths"}
+            self.num_requests += 1
+            self.in_flight += 1
+            try:
+                return 200, await self.segment(request)
+            except Exception as e:
+                self.num_errors += 1
+                logging.exception("Request failed")
+                return 500, {"error": repr(e)}
+            finally:
+                self.in_flight -= 1
+        return 404, {"error": "unknown endpoint"}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            if len(request_line) < 2:
+                status, payload = 400, {"error": "malformed request"}
+            else:
+                status, payload = await self.route(request_line[0], request_line[1], body)
+            data = json.dumps(payload).encode()
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                         "Connection: close\r\n\r\n".format(status, HTTP_STATUS[status], len(data)).encode() + data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        batcher = asyncio.ensure_future(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        logging.info("Serving on {}:{} (max batch {}, max wait {:.0f}ms)".format(
+            host, port, self.max_batch_size, self.max_wait * 1000))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.compute_executor.shutdown()
+            self.io_executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve M1 registration and M0 segmentation with warm models")
+    parser.add_argument("--m0-weights", required=True)
+    parser.add_argument("--m1-weights", required=True)
+    parser.add_argument("--model", default="Unet", choices=["Unet", "DeepSup"])
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--output", default="segmentations/")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--io-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    service = InferenceService(args.m0_weights, args.m1_weights, args.output, args.model, args.device,
+                               args.max_batch_size, args.max_wait_ms, args.max_queue, args.io_workers)
+    asyncio.run(service.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@ import time
 import random
 import numpy
 from datetime import datetime
-from torchmetrics import JaccardIndex
 import matplotlib.pyplot as plt
 from torch.cuda.amp import autocast, GradScaler
 from torch.utils.tensorboard import SummaryWriter
@@ -11,7 +10,10 @@ import logging
 
 torch.set_num_threads(1)
 
-from Code.Utils.loss import DiceLoss, focal_tversky_loss
+from Code.Utils.loss import focal_tversky_loss, dice_per_sample, normalize_per_sample
+from Code.Utils.metrics import SegmentationMetrics
+from Code.Utils.visualization import VisualizationWriter
+from Code.Utils.tta import ttaPredict
 
 scaler = GradScaler()
 
@@ -56,94 +58,113 @@ def saveImage(mri, mri_lbl, ct, ctmri_merge, ct_op, pseudo_gt, ct_gt):
     return figure
 
 
-def test(dataloaders, modelM0, modelM1, model_type, log=False, logPath="", device="cuda"):
+def test(dataloaders, modelM0, modelM1, model_type, log=False, logPath="", device="cuda", tta=False, flow_cache=None):
+    """
+    :param tta: the M0 prediction is the average over flipped and rotated views of the warped MRI, computed in one
+                batched forward pass; loss_0 is then measured on the final map only, also for DeepSup
+    :param flow_cache: FlowCache of modelM1, pairs registered before are read from it instead of registered again
+    """
     if log:
         start_time = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
         TBLOGDIR = logPath + "{}".format(start_time)
         writer = SummaryWriter(TBLOGDIR)
-        logging.info("Tensorboard for testing path : ", TBLOGDIR)
+        visualizer = VisualizationWriter(writer)
+        logging.info("Tensorboard for testing path : " + TBLOGDIR)
 
     GPU_ID_M0 = device
     modelM0.to(device)
     since = time.time()
     criterion = focal_tversky_loss
-    getDice = DiceLoss()
-    jaccard = JaccardIndex(num_classes=2)
+    seg_metrics = SegmentationMetrics()
 
     idx = 0
+    sample_idx = 0
     running_loss_0 = 0
     running_loss_1 = 0
     running_corrects = 0
     for batch in dataloaders:
-        # Get Data
-        mri_batch, labels_batch, ct_batch, ct_gt_batch, id = batch
+        # Get Data, cached samples additionally carry their dataset index
+        mri_batch, labels_batch, ct_batch, ct_gt_batch = batch[:4]
+        ids = batch[4].tolist() if len(batch) == 5 else list(range(sample_idx, sample_idx + mri_batch.shape[0]))
 
         with autocast(enabled=False):
-            loss_1, fully_warped_image_yx, pseudo_lbl = modelM1.lossCal(ct_batch, mri_batch, labels_batch)
-            fully_warped_image_yx = (fully_warped_image_yx - fully_warped_image_yx.min()) / \
-                                    (fully_warped_image_yx.max() - fully_warped_image_yx.min())
-
-            output_ct = modelM0(fully_warped_image_yx.to(GPU_ID_M0))
-            if model_type == "DeepSup":
+            if flow_cache is None:
+                loss_1, fully_warped_image_yx, pseudo_lbl = modelM1.lossCal(ct_batch, mri_batch, labels_batch)
+            else:
+                loss_1, fully_warped_image_yx, pseudo_lbl = flow_cache.lossCal(modelM1, ct_batch, mri_batch,
+                                                                               labels_batch)
+            fully_warped_image_yx = normalize_per_sample(fully_warped_image_yx)
+
+            if tta:
+                with torch.no_grad():
+                    predict = modelM0.forward_final if model_type == "DeepSup" else modelM0
+                    output_ct = ttaPredict(predict, fully_warped_image_yx.to(GPU_ID_M0))
+                loss_0 = criterion(output_ct, pseudo_lbl.to(GPU_ID_M0))
+            elif model_type == "DeepSup":
+                output_ct = modelM0(fully_warped_image_yx.to(GPU_ID_M0))
                 loss_0 = (criterion(output_ct[0], pseudo_lbl[:, :, ::8, ::8, ::8])
                           + criterion(output_ct[1], pseudo_lbl[:, :, ::4, ::4, ::4])
                           + criterion(output_ct[2], pseudo_lbl[:, :, ::2, ::2, ::2])
                           + criterion(output_ct[3], pseudo_lbl)) / 4.
             else:
-                loss_0 = criterion(output_ct.squeeze(), pseudo_lbl.squeeze().to(GPU_ID_M0))
-            # Dice Score
-            acc_gt = 1 - getDice(ct_gt_batch.squeeze().to(GPU_ID_M0), pseudo_lbl.squeeze().to(GPU_ID_M0))
-
-            # Jaccard Index
-            j_value = jaccard(ct_gt_batch.squeeze(), pseudo_lbl.squeeze().cpu().type(torch.int))
-
-            print("File: ", id, "  Dice: ", acc_gt.item(), "  Jaccard: ", j_value.item(), "  Focal_Tr: ",
-                  loss_0.item())
-            logging.debug("File: " + str(idx) + "  Dice: " + str(acc_gt.item()) + "  Jaccard: " + str(
-                j_value.item()) + "  Focal_Tr: " + str(loss_0.item()))
+                output_ct = modelM0(fully_warped_image_yx.to(GPU_ID_M0))
+                loss_0 = criterion(output_ct, pseudo_lbl.to(GPU_ID_M0))
+            # Dice Score of every subject in the batch
+            acc_gt = dice_per_sample(pseudo_lbl, ct_gt_batch.to(device=pseudo_lbl.device, dtype=pseudo_lbl.dtype))
+
+            # Overlap and surface metrics of the pseudo label against the CT label
+            metrics = seg_metrics.update(pseudo_lbl, ct_gt_batch)
+
+            for i, subject in enumerate(ids):
+                print("File: ", subject, "  Dice: ", acc_gt[i].item(), "  Jaccard: ", metrics["jaccard"][i],
+                      "  HD95: ", metrics["hd95"][i], "  ASD: ", metrics["asd"][i], "  Focal_Tr: ", loss_0.item())
+                logging.debug("File: " + str(sample_idx) + "  Dice: " + str(acc_gt[i].item()) + "  Jaccard: "
+                              + str(metrics["jaccard"][i]) + "  HD95: " + str(metrics["hd95"][i]) + "  ASD: "
+                              + str(metrics["asd"][i]) + "  Focal_Tr: " + str(loss_0.item()))
+                if log:
+                    writer.add_scalar("Acc_GT", acc_gt[i].item(), sample_idx)
+                    writer.add_scalar("Jaccard", metrics["jaccard"][i], sample_idx)
+                    writer.add_scalar("HD95", metrics["hd95"][i], sample_idx)
+                    writer.add_scalar("ASD", metrics["asd"][i], sample_idx)
+                sample_idx += 1
 
         if log:
-            temp = labels_batch.squeeze().detach().cpu()
-            slice = 0
-            for i in range(len(temp)):
-                if temp[i].max() == 1:
-                    slice = i
-                    break
-            mri = mri_batch.squeeze()[slice, :, :].unsqueeze(0)
-            ct = ct_batch.squeeze()[slice, :, :].unsqueeze(0)
-            ctmri_merge = fully_warped_image_yx.squeeze()[slice, :, :].unsqueeze(0).float().clone().detach().cpu()
-            ct_op = output_ct[3].squeeze()[slice, :, :].unsqueeze(0).clone().detach().cpu().float()
-            mri_lbl = labels_batch.squeeze()[slice, :, :].unsqueeze(0).clone().detach().cpu()
-            pseudo_gt = pseudo_lbl.squeeze()[slice, :, :].unsqueeze(0).clone().detach().cpu()
-            ct_gt = ct_gt_batch.squeeze()[slice, :, :].unsqueeze(0)
-
-            ctmri_merge = (ctmri_merge - ctmri_merge.min()) / (ctmri_merge.max() - ctmri_merge.min())
-            ct_op = (ct_op - ct_op.min()) / (ct_op.max() - ct_op.min())
-
-            fig = saveImage(mri, mri_lbl, ct, ctmri_merge, ct_op, pseudo_gt, ct_gt)
-            text = "Images : " + str(idx)
-            writer.add_figure(text, fig, idx)
+            volumes = {"mri": mri_batch, "mri_lbl": labels_batch, "ct": ct_batch,
+                       "ctmri_merge": fully_warped_image_yx,
+                       "ct_op": output_ct[3] if model_type == "DeepSup" and not tta else output_ct,
+                       "pseudo_gt": pseudo_lbl, "ct_gt": ct_gt_batch}
+            # Test figures are written once per batch, so wait for a free slot instead of dropping them
+            visualizer.submit(saveImage, "Images : " + str(idx), idx, volumes, label_key="mri_lbl",
+                              normalize_keys=("ctmri_merge", "ct_op"), block=True)
 
         if log:
             writer.add_scalar("Loss_0", loss_0.item(), idx)
             writer.add_scalar("Loss_1", loss_1.item(), idx)
-            writer.add_scalar("Acc_GT", acc_gt.item(), idx)
-            writer.add_scalar("Jaccard", j_value, idx)
 
         # statistics
         running_loss_0 += loss_0.item()
         running_loss_1 += loss_1.item()
-        running_corrects += acc_gt.item()
+        running_corrects += acc_gt.sum().item()
         idx += 1
 
+    if log:
+        visualizer.close()
+    if flow_cache is not None:
+        flow_cache.logStats()
     print("Overall loss 0: ", running_loss_0 / len(dataloaders))
     print("Overall loss 1: ", running_loss_1 / len(dataloaders))
-    print("Overall Accuracy : ", running_corrects / len(dataloaders))
+    print("Overall Accuracy : ", running_corrects / sample_idx)
+    overall_metrics = seg_metrics.compute()
+    print("Overall Metrics  : ", overall_metrics)
     time_elapsed = time.time() - since
     print('Testing complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
 
     logging.debug("Overall loss 0   : " + str(running_loss_0 / len(dataloaders)))
     logging.debug("Overall loss 1   : " + str(running_loss_1 / len(dataloaders)))
-    logging.debug("Overall Accuracy : " + str(running_corrects / len(dataloaders)))
+    logging.debug("Overall Accuracy : " + str(running_corrects / sample_idx))
+    logging.debug("Overall Metrics  : " + str(overall_metrics))
     logging.debug('Testing complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
     logging.info("############################# END Model Testing #############################")
+
+    return dict(overall_metrics, loss_0=running_loss_0 / len(dataloaders), loss_1=running_loss_1 / len(dataloaders),
+                soft_dice=running_corrects / sample_idx)
@@ -6,6 +6,7 @@ import torchio as tio
 
 from Code.Semi_supervised.Train.Model_M0.M0_dataloader import TeacherCustomDataset
 from Code.Semi_supervised.Train.Model_M0.M0_train import train
+from Code.Utils.distributed import getSampler
 from Model.M0 import U_Net_M0
 from Model.DeepSupAttUNet3D import DeepSupAttentionUnet
 
@@ -20,8 +21,11 @@ except ImportError:
 
 class M0_Pipeline:
     def __init__(self, dataset_path, M0_model_path, M0_bw_path, loss_fn, model_type, isChaos=False, device="cuda",
-                 log_path="runs/Training/", epochs=100, seed_val=42):
-        self.batch_size = 1
+                 log_path="runs/Training/", epochs=100, seed_val=42, val_interval=1, patience=None, min_delta=0.0,
+                 batch_size=1, accum_steps=1, profile=False):
+        self.batch_size = batch_size
+        # Effective batch size is batch_size * accum_steps
+        self.accum_steps = accum_steps
 
         # Model Weights
         self.M0_model_path = M0_model_path
@@ -38,6 +42,13 @@ class M0_Pipeline:
         self.seed = seed_val
         self.isChaos = isChaos
 
+        # Validation cadence and early stopping, patience=None trains for all epochs
+        self.val_interval = val_interval
+        self.patience = patience
+        self.min_delta = min_delta
+        # Per-phase step timing, synchronizes the device at every phase boundary
+        self.profile = profile
+
     def defineModel(self):
         if self.model_type == "DeepSup":
             model = DeepSupAttentionUnet(1, 1)
@@ -60,16 +71,14 @@ class M0_Pipeline:
         logging.info("Epochs total     : " + str(self.num_epochs))
         logging.info("Loss Function    : " + self.loss_fn)
         logging.info("Model Type       : " + self.model_type)
+        logging.info("Batch Size       : " + str(self.batch_size) + " x " + str(self.accum_steps) + " accumulation steps")
+        logging.info("Val Interval     : " + str(self.val_interval))
+        logging.info("Patience         : " + str(self.patience))
 
-    def trainModel(self):
-        self.displayDetails()
-
-        model = self.defineModel()
-        optimizer = self.defineOptimizer(model)
-
+    def train_val_split(self, overwrite_csv=True):
         transform = tio.CropOrPad(self.transform_val)
 
-        checkCSV(dataset_Path=self.dataset_path, csv_FileName=self.csv_file, overwrite=True)
+        checkCSV(dataset_Path=self.dataset_path, csv_FileName=self.csv_file, overwrite=overwrite_csv)
         dataset = TeacherCustomDataset(self.isChaos, self.dataset_path, self.csv_file, transform)
 
         train_size = int(0.8 * len(dataset))
@@ -81,14 +90,29 @@ class M0_Pipeline:
 
         logging.info("Train Indices  : {}".format(str(train_dataset.indices)))
         logging.info("Val   Indices  : {}".format(str(val_dataset.indices)))
+        return train_dataset, val_dataset
+
+    def trainModel(self, resume=False):
+        self.displayDetails()
+
+        model = self.defineModel()
+        optimizer = self.defineOptimizer(model)
+
+        train_dataset, val_dataset = self.train_val_split()
 
         # Training and Validation Section
-        train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True,
-                                                   generator=torch.Generator().manual_seed(self.seed))
+        # In a distributed run every rank trains on its own shard of the training split
+        train_sampler = getSampler(train_dataset, self.seed)
+        if train_sampler is None:
+            train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True,
+                                                       generator=torch.Generator().manual_seed(self.seed))
+        else:
+            train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=self.batch_size, sampler=train_sampler)
         validation_loader = torch.utils.data.DataLoader(val_dataset, batch_size=self.batch_size, shuffle=True,
                                                         generator=torch.Generator().manual_seed(self.seed))
 
         dataloaders = [train_loader, validation_loader]
         train(dataloaders, self.M0_model_path, self.M0_bw_path, self.num_epochs, model, optimizer, self.device,
               self.loss_fn, self.model_type,
-              log=logging, logPath=self.logPath)
+              log=logging, logPath=self.logPath, resume=resume, val_interval=self.val_interval,
+              patience=self.patience, min_delta=self.min_delta, accum_steps=self.accum_steps, profile=self.profile)
@@ -8,7 +8,14 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import numpy as np
 
-from Code.Utils.loss import DiceLoss, focal_tversky_loss
+from Code.Utils.checkpoint import CheckpointWriter, statePath, loaderGenerators, getRNGState, setRNGState, \
+    loadTrainingState
+from Code.Utils.distributed import isMainProcess, broadcastParameters, allReduceGradients, allReduceSum, \
+    broadcastFlag, setEpoch
+from Code.Utils.earlyStopping import EarlyStopping, isValidationEpoch
+from Code.Utils.loss import DiceLoss, focal_tversky_loss, dice_per_sample
+from Code.Utils.profiling import StepTimer
+from Code.Utils.visualization import VisualizationWriter
 
 torch.set_num_threads(1)
 scaler = GradScaler()
@@ -32,11 +39,18 @@ def saveImage(img, lbl, op):
 
 def train(dataloaders, modelPath, modelPath_bestweight, num_epochs, model, optimizer, device="cuda", loss_fn="Dice",
           model_type="DeepSup",
-          log=False, logPath=""):
+          log=False, logPath="", profile=False, resume=False, val_interval=1, patience=None, min_delta=0.0,
+          accum_steps=1):
+    start_time = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
+    TBLOGDIR = logPath + "{}".format(start_time)
+    # In a distributed run only rank 0 writes logs and checkpoints
+    isMain = isMainProcess()
+    log = log and isMain
     if log:
-        start_time = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
-        TBLOGDIR = logPath + "{}".format(start_time)
         writer = SummaryWriter(TBLOGDIR)
+        visualizer = VisualizationWriter(writer)
+    timer = StepTimer(device, enabled=profile)
+    checkpointer = CheckpointWriter(enabled=isMain)
     best_acc = 0.0
     best_val_loss = 99999
     since = time.time()
@@ -45,78 +59,110 @@ def train(dataloaders, modelPath, modelPath_bestweight, num_epochs, model, optim
         criterion = focal_tversky_loss
     else:
         criterion = DiceLoss()
-    getDice = DiceLoss()
     store_idx = int(len(dataloaders[0]) / 2)
-    for epoch in range(num_epochs):
+    # patience counts validations, i.e. patience * val_interval epochs
+    stopper = EarlyStopping("M0 Loss/Validation", patience, min_delta)
+
+    state_path = statePath(modelPath)
+    generators = loaderGenerators(dataloaders)
+    start_epoch = 0
+    if resume:
+        state = loadTrainingState(state_path)
+        if state is not None:
+            model.load_state_dict(state["model"])
+            optimizer.load_state_dict(state["optimizer"])
+            scaler.load_state_dict(state["scaler"])
+            best_acc = state["best_acc"]
+            best_val_loss = state["best_val_loss"]
+            start_epoch = state["epoch"]
+            since -= state["elapsed"]
+            stopper.load_state_dict(state["early_stopping"])
+            setRNGState(state["rng"], generators)
+            if stopper.shouldStop:
+                start_epoch = num_epochs
+            logging.info("Resuming M0 training at epoch " + str(start_epoch))
+    # Every rank starts from the weights of rank 0
+    broadcastParameters([model])
+
+    for epoch in range(start_epoch, num_epochs):
+        setEpoch(dataloaders, epoch)
         print('Epoch {}/{}'.format(epoch, num_epochs))
         print('-' * 10)
-        # Each epoch has a training and validation phase
-        for phase in [0, 1]:
+        # Each epoch has a training phase, the validation phase runs every val_interval epochs
+        phases = [0, 1] if isValidationEpoch(epoch, num_epochs, val_interval) else [0]
+        for phase in phases:
             if phase == 0:
                 print("Model In Training mode")
                 model.train()  # Set model to training mode
+                timer.mode = "Train"
             else:
                 print("Model In Validation mode")
                 model.eval()  # Set model to evaluate mode
+                timer.mode = "Val"
 
             running_loss = 0.0
             running_corrects = 0
+            num_batches = len(dataloaders[phase])
+            num_samples = len(dataloaders[phase].sampler)
+            optimizer.zero_grad()
             idx = 0
             # Iterate over data.
-            for batch in tqdm(dataloaders[phase]):
+            for batch in tqdm(timer.iterate(dataloaders[phase]), total=num_batches):
                 image_batch, labels_batch = batch
-
-                optimizer.zero_grad()
+                batch_len = image_batch.shape[0]
                 # forward
                 with torch.set_grad_enabled(phase == 0):
                     with autocast(enabled=True):
-                        prediction = model(image_batch.unsqueeze(0).to(device))
-                        gt = labels_batch.unsqueeze(0).to(device)
+                        with timer.phase("h2d"):
+                            # (B, D, H, W) -> (B, 1, D, H, W)
+                            image = image_batch.unsqueeze(1).to(device)
+                            gt = labels_batch.unsqueeze(1).to(device)
+
+                        with timer.phase("forward"):
+                            prediction = model(image)
 
-                        if model_type == "DeepSup":
-                            loss = (criterion(prediction[0], gt[:, :, ::8, ::8, ::8])
-                                    + criterion(prediction[1], gt[:, :, ::4, ::4, ::4])
-                                    + criterion(prediction[2], gt[:, :, ::2, ::2, ::2])
-                                    + criterion(prediction[3], gt)) / 4.
+                        with timer.phase("loss"):
+                            if model_type == "DeepSup":
+                                loss = (criterion(prediction[0], gt[:, :, ::8, ::8, ::8])
+                                        + criterion(prediction[1], gt[:, :, ::4, ::4, ::4])
+                                        + criterion(prediction[2], gt[:, :, ::2, ::2, ::2])
+                                        + criterion(prediction[3], gt)) / 4.
 
-                            # Get the Dice Score for checking the accuracy
-                            acc = 1 - getDice(prediction[3], gt)
-                        else:
-                            loss = criterion(prediction, gt)
-                            acc = 1 - getDice(prediction, gt)
+                                # Get the Dice Score for checking the accuracy
+                                acc = dice_per_sample(prediction[3].float(), gt)
+                            else:
+                                loss = criterion(prediction, gt)
+                                acc = dice_per_sample(prediction.float(), gt)
 
                     # backward + optimize only if in training phase
                     if phase == 0:
-                        scaler.scale(loss).backward()
-                        scaler.step(optimizer)
-                        scaler.update()
+                        # Gradients are accumulated over accum_steps batches before each optimizer step
+                        with timer.phase("backward"):
+                            scaler.scale(loss / accum_steps).backward()
+                        if (idx + 1) % accum_steps == 0 or idx + 1 == num_batches:
+                            with timer.phase("allreduce"):
+                                allReduceGradients(optimizer)
+                            with timer.phase("optimizer"):
+                                scaler.step(optimizer)
+                                scaler.update()
+                                optimizer.zero_grad()
 
                         if epoch % 5 == 0 and idx == store_idx and log:
-                            temp = labels_batch.squeeze().detach().cpu()
-                            slice = 0
-                            for i in range(len(temp)):
-                                if temp[i].max() == 1:
-                                    slice = i
-                                    break
-                            # print("Storing images", idx, epoch)
-                            img = image_batch.squeeze()[slice, :, :].unsqueeze(0)
-                            lbl = labels_batch.squeeze()[slice, :, :].unsqueeze(0)
-                            if model_type == "DeepSup":
-                                op = prediction[3].squeeze()[slice, :, :].unsqueeze(0).cpu().detach()  # For DeepSup
-                            else:
-                                op = prediction.squeeze()[slice, :, :].unsqueeze(0).cpu().detach()  # For Unet
-
-                            fig = saveImage(img, lbl, op)
-                            text = "Epoch : " + str(epoch)
-                            writer.add_figure(text, fig, epoch)
-
-                    # statistics
-                    running_loss += loss.item()
-                    running_corrects += acc.item()
+                            with timer.phase("logging"):
+                                op = prediction[3] if model_type == "DeepSup" else prediction
+                                visualizer.submit(saveImage, "Epoch : " + str(epoch), epoch,
+                                                  {"img": image_batch, "lbl": labels_batch, "op": op},
+                                                  label_key="lbl")
+
+                    # statistics, weighted by the batch size so that a smaller last batch is not over-counted
+                    running_loss += loss.item() * batch_len
+                    running_corrects += acc.sum().item()
                     idx += 1
 
-            epoch_loss = running_loss / len(dataloaders[phase])
-            epoch_acc = running_corrects / len(dataloaders[phase])
+            # Totals over all ranks
+            running_loss, running_corrects, num_samples = allReduceSum([running_loss, running_corrects, num_samples])
+            epoch_loss = running_loss / num_samples
+            epoch_acc = running_corrects / num_samples
             if phase == 0:
                 mode = "Train"
                 if log:
@@ -130,24 +176,49 @@ def train(dataloaders, modelPath, modelPath_bestweight, num_epochs, model, optim
 
             logging.info('Epoch: {} Mode: {} Loss: {:.4f} Acc: {:.4f}'.format(epoch, mode, epoch_loss, epoch_acc))
 
+            if phase == 1:
+                stopper.step(epoch_loss, epoch, time.time() - since)
+
             # deep copy the model
             if phase == 1 and (epoch_acc > best_acc or epoch_loss < best_val_loss):
                 logging.info("Saving the best model weights of M0")
                 best_val_loss = epoch_loss
                 best_acc = epoch_acc
-                torch.save(model.state_dict(), modelPath_bestweight)
+                with timer.phase("checkpoint"):
+                    checkpointer.save(model.state_dict(), modelPath_bestweight)
 
         # save the model weights after an interval
         if epoch % 10 == 0:
             logging.info("Saving M0 model weights")
-            torch.save(model.state_dict(), modelPath)
+            with timer.phase("checkpoint"):
+                checkpointer.save(model.state_dict(), modelPath)
+
+        # Full training state, a resumed run continues with the next epoch
+        with timer.phase("checkpoint"):
+            checkpointer.save({"epoch": epoch + 1, "model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                               "scaler": scaler.state_dict(), "best_acc": best_acc, "best_val_loss": best_val_loss,
+                               "elapsed": time.time() - since, "early_stopping": stopper.state_dict(),
+                               "rng": getRNGState(generators)}, state_path)
+
+        timer.endEpoch(epoch, writer if log else None)
+
+        if broadcastFlag(stopper.shouldStop):
+            logging.info("Early stopping at epoch {}: no improvement in the last {} validations".format(
+                epoch, stopper.bad_validations))
+            break
 
     time_elapsed = time.time() - since
     logging.info('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
     logging.info('Best val Acc: {:4f}'.format(best_acc))
+    logging.info('Time to target - ' + stopper.report())
+    if isMain:
+        timer.dumpJSON(TBLOGDIR + "_step_timing.json")
 
     # save the model
+    if log:
+        visualizer.close()
     logging.info("Saving M0 model weights before exiting")
-    torch.save(model.state_dict(), modelPath)
+    checkpointer.save(model.state_dict(), modelPath)
+    checkpointer.close()
 
     logging.info("############################# END M0 Model Training #############################")
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import pandas as pd
 import torch
@@ -47,6 +48,7 @@ class CustomDataset(Dataset):
         self.window = window
 
         self.temp_location = self.dataset_path + "temp/"
+        os.makedirs(self.temp_location, exist_ok=True)
 
     def __getitem__(self, index):
         if exists(self.temp_location + "mri_transformed_{}.pickle".format(index)) \
@@ -109,17 +111,10 @@ class CustomDataset(Dataset):
                 # Transform CT label with size mentioned
                 ct_gt_transformed = f.interpolate(gt_ct_actualSize.unsqueeze(0), size=self.transform_val)
 
-                with open(self.temp_location + "mri_transformed_{}.pickle".format(index), "wb") as output_file:
-                    cPickle.dump(mri_transformed.squeeze(0), output_file)
-
-                with open(self.temp_location + "mri_gt_transformed_{}.pickle".format(index), "wb") as output_file:
-                    cPickle.dump(mri_gt_transformed.squeeze(0), output_file)
-
-                with open(self.temp_location + "ct_transformed_{}.pickle".format(index), "wb") as output_file:
-                    cPickle.dump(ct_transformed.squeeze(0), output_file)
-
-                with open(self.temp_location + "ct_gt_transformed_{}.pickle".format(index), "wb") as output_file:
-                    cPickle.dump(ct_gt_transformed.squeeze(0), output_file)
+                self.dumpCache(mri_transformed.squeeze(0), "mri_transformed_{}.pickle".format(index))
+                self.dumpCache(mri_gt_transformed.squeeze(0), "mri_gt_transformed_{}.pickle".format(index))
+                self.dumpCache(ct_transformed.squeeze(0), "ct_transformed_{}.pickle".format(index))
+                self.dumpCache(ct_gt_transformed.squeeze(0), "ct_gt_transformed_{}.pickle".format(index))
 
                 return mri_transformed.squeeze(0), mri_gt_transformed.squeeze(0), ct_transformed.squeeze(
                     0), ct_gt_transformed.squeeze(0)
@@ -133,6 +128,21 @@ class CustomDataset(Dataset):
     def __len__(self):
         return self.data_len
 
+    def dumpCache(self, obj, file_name):
+        # Written to a temporary file and renamed, so concurrent runs sharing the cache never read a partial pickle
+        path = self.temp_location + file_name
+        tmp_path = "{}.tmp.{}".format(path, os.getpid())
+        with open(tmp_path, "wb") as output_file:
+            cPickle.dump(obj, output_file)
+        os.replace(tmp_path, path)
+
+    def prewarm(self):
+        """
+        Preprocesses and caches every subject once, e.g. before starting several runs on the same dataset
+        """
+        for index in range(self.data_len):
+            self[index]
+
     @staticmethod
     def normalize(img):
         return (img - img.min()) / (img.max() - img.min())
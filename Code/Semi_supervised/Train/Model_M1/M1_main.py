@@ -18,11 +18,15 @@ from Code.Semi_supervised.Train.Model_M1.M1_dataloader import CustomDataset
 from Code.Semi_supervised.Train.Model_M1.M1_train import train
 from Code.Semi_supervised.mscgunet.train import Mscgunet
 from Code.Utils.CSVGenerator import checkCSV_Student
+from Code.Utils.distributed import getSampler
+from Code.Utils.flowCache import FlowCache
 
 
 class M1_Pipeline:
     def __init__(self, dataset_path, M1_model_path, M1_bw_path,loss_fn,model_type, device="cuda", log_path="runs/Training/",
-                 isChaos=False, isM0Frozen=False, isM1Frozen=False, epochs=3000, seed_val=42):
+                 isChaos=False, isM0Frozen=False, isM1Frozen=False, epochs=3000, seed_val=42, val_interval=1,
+                 patience=None, min_delta=0.0, batch_size=1, accum_steps=1, flow_cache_path=None,
+                 profile=False):
         # Model Weights
         self.M1_model_path = M1_model_path
         self.M1_bw_path = M1_bw_path
@@ -30,7 +34,9 @@ class M1_Pipeline:
         self.train_size = 5
         self.val_size = 1
         self.test_size = 2
-        self.batch_size = 1
+        self.batch_size = batch_size
+        # Effective batch size is batch_size * accum_steps
+        self.accum_steps = accum_steps
         self.lr = 1e-4
 
         self.loss_fn = loss_fn
@@ -54,6 +60,16 @@ class M1_Pipeline:
 
         self.seed = seed_val
 
+        # Validation cadence and early stopping, patience=None trains for all epochs
+        self.val_interval = val_interval
+        self.patience = patience
+        self.min_delta = min_delta
+        # Per-phase step timing, synchronizes the device at every phase boundary
+        self.profile = profile
+
+        # Registrations of the frozen M1 are cached per image pair (None: register every batch)
+        self.flow_cache_path = flow_cache_path
+
     @staticmethod
     def defineOptimizer_unified(modelM0, modelM1):
         optimizer = torch.optim.Adam(
@@ -95,6 +111,9 @@ class M1_Pipeline:
         logging.info("Epochs total     : " + str(self.num_epochs))
         logging.info("M0 Loss Function : " + str(self.loss_fn))
         logging.info("M0 Model Type    : " + str(self.model_type))
+        logging.info("Batch Size       : " + str(self.batch_size) + " x " + str(self.accum_steps) + " accumulation steps")
+        logging.info("Val Interval     : " + str(self.val_interval))
+        logging.info("Patience         : " + str(self.patience))
 
     def train_val_test_slit(self):
         logging.info("\n\n\n")
@@ -126,8 +145,14 @@ class M1_Pipeline:
         print("Test  Indices  : " + str(test_dataset.indices))
 
         # Training and Validation Section
-        train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=self.batch_size,
-                                                   shuffle=True,generator=torch.Generator().manual_seed(self.seed))
+        # In a distributed run every rank trains on its own shard of the training split
+        train_sampler = getSampler(train_dataset, self.seed)
+        if train_sampler is None:
+            train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=self.batch_size,
+                                                       shuffle=True,generator=torch.Generator().manual_seed(self.seed))
+        else:
+            train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=self.batch_size,
+                                                       sampler=train_sampler)
         validation_loader = torch.utils.data.DataLoader(val_dataset, batch_size=self.batch_size,
                                                         shuffle=True,generator=torch.Generator().manual_seed(self.seed))
         test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=self.batch_size,
@@ -135,7 +160,7 @@ class M1_Pipeline:
 
         return train_loader, validation_loader, test_loader
 
-    def trainModel(self, modelM0, dataloaders, logger, M0_model_path=None, M0_bw_path=None):
+    def trainModel(self, modelM0, dataloaders, logger, M0_model_path=None, M0_bw_path=None, resume=False):
         self.displayDetails(logger)
         # Initialize Model M1
         modelM1 = Mscgunet(device=self.device)
@@ -152,12 +177,24 @@ class M1_Pipeline:
             optimizer = self.defineOptimizer_M1(modelM1)
 
         # if M1 is frozen - load best weights
+        flow_cache = None
         if self.isM1Frozen:
             modelM1.initializeModel(self.M1_bw_path)
+            if self.flow_cache_path is not None:
+                flow_cache = FlowCache(self.flow_cache_path, self.M1_bw_path)
 
         train(dataloaders, self.M1_model_path, self.M1_bw_path, self.num_epochs, modelM0, modelM1, optimizer,
               self.isChaos, self.isM0Frozen, self.isM1Frozen, self.device, self.loss_fn, self.model_type,
               log=logging,
               logPath=self.logPath,
               M0_model_path=M0_model_path,
-              M0_bw_path=M0_bw_path)
+              M0_bw_path=M0_bw_path,
+              resume=resume,
+              val_interval=self.val_interval,
+              patience=self.patience,
+              min_delta=self.min_delta,
+              accum_steps=self.accum_steps,
+              flow_cache=flow_cache,
+              profile=self.profile)
+        if flow_cache is not None:
+            flow_cache.logStats()
@@ -8,7 +8,14 @@ torch.set_num_threads(1)
 from torch.cuda.amp import autocast, GradScaler
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
-from Code.Utils.loss import DiceLoss, focal_tversky_loss
+from Code.Utils.checkpoint import CheckpointWriter, atomicSave, statePath, loaderGenerators, getRNGState, \
+    setRNGState, loadTrainingState
+from Code.Utils.distributed import isMainProcess, broadcastParameters, allReduceGradients, allReduceSum, \
+    broadcastFlag, setEpoch
+from Code.Utils.earlyStopping import EarlyStopping, isValidationEpoch
+from Code.Utils.loss import DiceLoss, focal_tversky_loss, dice_per_sample, normalize_per_sample
+from Code.Utils.profiling import StepTimer
+from Code.Utils.visualization import VisualizationWriter
 
 scaler = GradScaler()
 
@@ -49,32 +56,32 @@ def saveImage(mri, mri_lbl, ct, ctmri_merge, ct_op, pseudo_gt, ct_gt=None, isCha
     return figure
 
 
-def saveModel(modelM1, path):
-    torch.save({"feature_extractor_training": modelM1.feature_extractor_training.state_dict(),
-                "scg_training": modelM1.scg_training.state_dict(),
-                "upsampler1_training": modelM1.upsampler1_training.state_dict(),
-                "upsampler2_training": modelM1.upsampler2_training.state_dict(),
-                "upsampler3_training": modelM1.upsampler3_training.state_dict(),
-                "upsampler4_training": modelM1.upsampler4_training.state_dict(),
-                "upsampler5_training": modelM1.upsampler5_training.state_dict(),
-                "graph_layers1_training": modelM1.graph_layers1_training.state_dict(),
-                "graph_layers2_training": modelM1.graph_layers2_training.state_dict(),
-                "conv_decoder1_training": modelM1.conv_decoder1_training.state_dict(),
-                "conv_decoder2_training": modelM1.conv_decoder2_training.state_dict(),
-                "conv_decoder3_training": modelM1.conv_decoder3_training.state_dict(),
-                "conv_decoder4_training": modelM1.conv_decoder4_training.state_dict(),
-                "conv_decoder5_training": modelM1.conv_decoder5_training.state_dict(),
-                "conv_decoder6_training": modelM1.conv_decoder6_training.state_dict()}, path)
+def saveModel(modelM1, path, checkpointer=None):
+    state = {name: module.state_dict() for name, module in modelM1.getModules().items()}
+    if checkpointer is None:
+        atomicSave(state, path)
+    else:
+        checkpointer.save(state, path)
 
 
 def train(dataloaders, M1_model_path, M1_bw_path, num_epochs, modelM0, modelM1, optimizer, isChaos,
           isM0Frozen, isM1Frozen, GPU_ID, loss_fn="Dice", model_type="DeepSup", log=False, logPath="",
-          M0_model_path=None, M0_bw_path=None):
+          M0_model_path=None, M0_bw_path=None, profile=False, resume=False, val_interval=1, patience=None,
+          min_delta=0.0, accum_steps=1, flow_cache=None):
+    """
+    :param flow_cache: FlowCache of the loaded M1 weights, only used while M1 is frozen
+    """
+    start_time = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
+    TBLOGDIR = logPath + "{}".format(start_time)
+    # In a distributed run only rank 0 writes logs and checkpoints
+    isMain = isMainProcess()
+    log = log and isMain
     if log:
-        start_time = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
-        TBLOGDIR = logPath + "{}".format(start_time)
         writer = SummaryWriter(TBLOGDIR)
+        visualizer = VisualizationWriter(writer)
         logging.info("Tensorboard path : " + str(TBLOGDIR))
+    timer = StepTimer(GPU_ID, enabled=profile)
+    checkpointer = CheckpointWriter(enabled=isMain)
     best_acc = 0.0
     best_val_loss_0 = 99999
     best_val_loss_1 = 99999
@@ -83,12 +90,47 @@ def train(dataloaders, M1_model_path, M1_bw_path, num_epochs, modelM0, modelM1,
         criterion = focal_tversky_loss
     else:
         criterion = DiceLoss()
-    getDice = DiceLoss()
-    for epoch in range(num_epochs):
+    # Only the losses of the models being trained are monitored, the run stops once all of them plateaued.
+    # patience counts validations, i.e. patience * val_interval epochs
+    stoppers = {}
+    if not isM0Frozen:
+        stoppers["Loss_0"] = EarlyStopping("Validation/Loss_0", patience, min_delta)
+    if not isM1Frozen:
+        stoppers["Loss_1"] = EarlyStopping("Validation/Loss_1", patience, min_delta)
+
+    # The M1 frozen stage reuses the M1 paths of the stage that trained M1, its state belongs to the M0 it trains
+    state_path = statePath(M0_model_path if isM1Frozen and M0_model_path is not None else M1_model_path)
+    generators = loaderGenerators(dataloaders)
+    start_epoch = 0
+    if resume:
+        state = loadTrainingState(state_path)
+        if state is not None:
+            modelM0.load_state_dict(state["modelM0"])
+            for name, module in modelM1.getModules().items():
+                module.load_state_dict(state["modelM1"][name])
+            optimizer.load_state_dict(state["optimizer"])
+            scaler.load_state_dict(state["scaler"])
+            best_acc = state["best_acc"]
+            best_val_loss_0 = state["best_val_loss_0"]
+            best_val_loss_1 = state["best_val_loss_1"]
+            start_epoch = state["epoch"]
+            since -= state["elapsed"]
+            for name, stopper in stoppers.items():
+                stopper.load_state_dict(state["early_stopping"][name])
+            setRNGState(state["rng"], generators)
+            if stoppers and all(stopper.shouldStop for stopper in stoppers.values()):
+                start_epoch = num_epochs
+            logging.info("Resuming training at epoch " + str(start_epoch))
+    # Every rank starts from the weights of rank 0
+    broadcastParameters([modelM0] + list(modelM1.getModules().values()))
+
+    for epoch in range(start_epoch, num_epochs):
+        setEpoch(dataloaders, epoch)
         print('Epoch {}/{}'.format(epoch, num_epochs))
         print('-' * 10)
-        # Each epoch has a training and validation phase
-        for phase in [0, 1]:
+        # Each epoch has a training phase, the validation phase runs every val_interval epochs
+        phases = [0, 1] if isValidationEpoch(epoch, num_epochs, val_interval) else [0]
+        for phase in phases:
             if phase == 0:
                 if isM0Frozen and isM1Frozen:
                     modelM0.train()
@@ -102,98 +144,115 @@ def train(dataloaders, M1_model_path, M1_bw_path, num_epochs, modelM0, modelM1,
             else:
                 modelM0.eval()
                 # modelM1.eval()
+            timer.mode = "Train" if phase == 0 else "Val"
             running_loss_0 = 0.0
             running_loss_1 = 0.0
             running_corrects = 0
+            num_batches = len(dataloaders[phase])
+            num_samples = len(dataloaders[phase].sampler)
+            optimizer.zero_grad()
             # Iterate over data.
             idx = 0
-            for batch in tqdm(dataloaders[phase]):
-                # Get Data
+            for batch in tqdm(timer.iterate(dataloaders[phase]), total=num_batches):
+                # Get Data, cached samples additionally carry their dataset index
                 if isChaos:
-                    mri_batch, labels_batch, ct_batch, ct_gt_batch = batch
+                    mri_batch, labels_batch, ct_batch, ct_gt_batch = batch[:4]
                 else:
-                    mri_batch, labels_batch, ct_batch = batch
-
-                optimizer.zero_grad()
+                    mri_batch, labels_batch, ct_batch = batch[:3]
+                batch_len = mri_batch.shape[0]
 
                 with torch.set_grad_enabled(phase == 0):
                     with autocast(enabled=False):
-                        loss_1, fully_warped_image_yx, pseudo_lbl = modelM1.lossCal(ct_batch, mri_batch, labels_batch)
-                        fully_warped_image_yx = (fully_warped_image_yx - fully_warped_image_yx.min()) / \
-                                                (fully_warped_image_yx.max() - fully_warped_image_yx.min())
-
-                        output_ct = modelM0(fully_warped_image_yx.to(GPU_ID))
-
-                        if model_type == "DeepSup":
-                            loss_0 = (criterion(output_ct[0], pseudo_lbl[:, :, ::8, ::8, ::8])
-                                      + criterion(output_ct[1], pseudo_lbl[:, :, ::4, ::4, ::4])
-                                      + criterion(output_ct[2], pseudo_lbl[:, :, ::2, ::2, ::2])
-                                      + criterion(output_ct[3], pseudo_lbl)) / 4.
-                        else:
-                            loss_0 = criterion(output_ct.squeeze(), pseudo_lbl.squeeze().to(GPU_ID))
-
-                        if not isM0Frozen and not isM1Frozen:
-                            total_loss = loss_0 + loss_1  # (loss_0 * 0.2) + (loss_1 * 0.8)
-                        if isM0Frozen and not isM1Frozen:
-                            total_loss = loss_1
-                            loss_0 = loss_0.detach()
-                        if isM1Frozen and not isM0Frozen:
-                            total_loss = loss_0
-                            loss_1 = loss_1.detach()
-
-                        if isChaos:
-                            acc_gt = 1 - getDice(ct_gt_batch.squeeze().to(GPU_ID), pseudo_lbl.squeeze().to(GPU_ID))
+                        with timer.phase("h2d"):
+                            ct_batch = ct_batch.to(GPU_ID)
+                            mri_batch = mri_batch.to(GPU_ID)
+                            labels_batch = labels_batch.to(GPU_ID)
+                            if isChaos:
+                                ct_gt_batch = ct_gt_batch.to(GPU_ID)
+
+                        with timer.phase("forward"):
+                            if flow_cache is not None and isM1Frozen:
+                                # Fixed M1: the registration of every pair is computed once and read back
+                                loss_1, fully_warped_image_yx, pseudo_lbl = flow_cache.lossCal(
+                                    modelM1, ct_batch, mri_batch, labels_batch)
+                            else:
+                                loss_1, fully_warped_image_yx, pseudo_lbl = modelM1.lossCal(ct_batch, mri_batch,
+                                                                                            labels_batch)
+                            fully_warped_image_yx = normalize_per_sample(fully_warped_image_yx)
+
+                            output_ct = modelM0(fully_warped_image_yx.to(GPU_ID))
+
+                        with timer.phase("loss"):
+                            if model_type == "DeepSup":
+                                loss_0 = (criterion(output_ct[0], pseudo_lbl[:, :, ::8, ::8, ::8])
+                                          + criterion(output_ct[1], pseudo_lbl[:, :, ::4, ::4, ::4])
+                                          + criterion(output_ct[2], pseudo_lbl[:, :, ::2, ::2, ::2])
+                                          + criterion(output_ct[3], pseudo_lbl)) / 4.
+                            else:
+                                loss_0 = criterion(output_ct, pseudo_lbl)
+
+                            if not isM0Frozen and not isM1Frozen:
+                                total_loss = loss_0 + loss_1  # (loss_0 * 0.2) + (loss_1 * 0.8)
+                            if isM0Frozen and not isM1Frozen:
+                                total_loss = loss_1
+                                loss_0 = loss_0.detach()
+                            if isM1Frozen and not isM0Frozen:
+                                total_loss = loss_0
+                                loss_1 = loss_1.detach()
+
+                            if isChaos:
+                                acc_gt = dice_per_sample(pseudo_lbl, ct_gt_batch.to(pseudo_lbl.dtype))
 
                     if phase == 0:
+                        # Gradients are accumulated over accum_steps batches before each optimizer step
+                        step = (idx + 1) % accum_steps == 0 or idx + 1 == num_batches
                         if autocast:
-                            scaler.scale(total_loss).backward()
-                            scaler.step(optimizer)
-                            scaler.update()
+                            with timer.phase("backward"):
+                                scaler.scale(total_loss / accum_steps).backward()
+                            if step:
+                                with timer.phase("allreduce"):
+                                    allReduceGradients(optimizer)
+                                with timer.phase("optimizer"):
+                                    scaler.step(optimizer)
+                                    scaler.update()
+                                    optimizer.zero_grad()
                         else:
-                            total_loss.backward()
-                            optimizer.step()
+                            with timer.phase("backward"):
+                                (total_loss / accum_steps).backward()
+                            if step:
+                                with timer.phase("allreduce"):
+                                    allReduceGradients(optimizer)
+                                with timer.phase("optimizer"):
+                                    optimizer.step()
+                                    optimizer.zero_grad()
 
                     if epoch % 10 == 0 and log and idx == 0:
-                        temp = labels_batch.squeeze().detach().cpu()
-                        slice = 0
-                        for i in range(len(temp)):
-                            if temp[i].max() == 1:
-                                slice = i
-                                break
-                        mri = mri_batch.squeeze()[slice, :, :].unsqueeze(0)
-                        ct = ct_batch.squeeze()[slice, :, :].unsqueeze(0)
-                        ctmri_merge = fully_warped_image_yx.squeeze()[slice, :, :].unsqueeze(
-                            0).float().clone().detach().cpu()
-                        if model_type == "DeepSup":
-                            ct_op = output_ct[3].squeeze()[slice, :, :].unsqueeze(0).clone().detach().cpu().float()
-                        else:
-                            ct_op = output_ct.squeeze()[slice, :, :].unsqueeze(0).clone().detach().cpu().float()
-                        mri_lbl = labels_batch.squeeze()[slice, :, :].unsqueeze(0).clone().detach().cpu()
-                        pseudo_gt = pseudo_lbl.squeeze()[slice, :, :].unsqueeze(0).clone().detach().cpu()
-
-                        ctmri_merge = (ctmri_merge - ctmri_merge.min()) / (ctmri_merge.max() - ctmri_merge.min())
-                        ct_op = (ct_op - ct_op.min()) / (ct_op.max() - ct_op.min())
-
-                        if isChaos:
-                            ct_gt = ct_gt_batch.squeeze()[slice, :, :].unsqueeze(0)
-                            fig = saveImage(mri, mri_lbl, ct, ctmri_merge, ct_op, pseudo_gt, ct_gt, isChaos)
-                        else:
-                            fig = saveImage(mri, mri_lbl, ct, ctmri_merge, ct_op, pseudo_gt)
-                        text = "Images on - " + str(epoch) + " Phase : " + str(phase)
-                        writer.add_figure(text, fig, epoch)
-
-                    # statistics
-                    running_loss_0 += loss_0.item()
-                    running_loss_1 += loss_1.item()
+                        with timer.phase("logging"):
+                            volumes = {"mri": mri_batch, "mri_lbl": labels_batch, "ct": ct_batch,
+                                       "ctmri_merge": fully_warped_image_yx,
+                                       "ct_op": output_ct[3] if model_type == "DeepSup" else output_ct,
+                                       "pseudo_gt": pseudo_lbl}
+                            if isChaos:
+                                volumes["ct_gt"] = ct_gt_batch
+                            visualizer.submit(saveImage, "Images on - " + str(epoch) + " Phase : " + str(phase),
+                                              epoch, volumes, label_key="mri_lbl",
+                                              normalize_keys=("ctmri_merge", "ct_op"), isChaos=isChaos)
+
+                    # statistics, weighted by the batch size so that a smaller last batch is not over-counted
+                    running_loss_0 += loss_0.item() * batch_len
+                    running_loss_1 += loss_1.item() * batch_len
 
                     if isChaos:
-                        running_corrects += acc_gt
+                        running_corrects += acc_gt.sum().item()
                     idx += 1
 
-            epoch_loss_0 = running_loss_0 / len(dataloaders[phase])
-            epoch_loss_1 = running_loss_1 / len(dataloaders[phase])
+            # Totals over all ranks
+            running_loss_0, running_loss_1, running_corrects, num_samples = allReduceSum(
+                [running_loss_0, running_loss_1, running_corrects, num_samples])
+            epoch_loss_0 = running_loss_0 / num_samples
+            epoch_loss_1 = running_loss_1 / num_samples
             if isChaos:
-                epoch_acc_gt = running_corrects / len(dataloaders[phase])
+                epoch_acc_gt = running_corrects / num_samples
             if phase == 0:
                 mode = "Train"
                 if log:
@@ -212,34 +271,66 @@ def train(dataloaders, M1_model_path, M1_bw_path, num_epochs, modelM0, modelM1,
             logging.info(
                 'Epoch: {} Mode: {} Loss_0: {:.4f} Loss_1: {:.4f}'.format(epoch, mode, epoch_loss_0, epoch_loss_1))
 
+            if phase == 1:
+                losses = {"Loss_0": epoch_loss_0, "Loss_1": epoch_loss_1}
+                for name, stopper in stoppers.items():
+                    stopper.step(losses[name], epoch, time.time() - since)
+
             # deep copy the model
             if phase == 1:
                 if epoch_loss_0 < best_val_loss_0 and not isM0Frozen:
                     logging.info("Saving the best model weights of Model 0")
                     best_val_loss_0 = epoch_loss_0
-                    torch.save(modelM0.state_dict(), M0_bw_path)
+                    with timer.phase("checkpoint"):
+                        checkpointer.save(modelM0.state_dict(), M0_bw_path)
                 if epoch_loss_1 < best_val_loss_1 and not isM1Frozen:
                     logging.info("Saving the best model weights of Model 1")
                     best_val_loss_1 = epoch_loss_1
-                    saveModel(modelM1, M1_bw_path)
+                    with timer.phase("checkpoint"):
+                        saveModel(modelM1, M1_bw_path, checkpointer)
 
         if epoch % 10 == 0:
             logging.info("Saving the model")
             # save the models
-            if not isM0Frozen:
-                torch.save(modelM0.state_dict(), M0_model_path)
-            if not isM1Frozen:
-                saveModel(modelM1, M1_model_path)
+            with timer.phase("checkpoint"):
+                if not isM0Frozen:
+                    checkpointer.save(modelM0.state_dict(), M0_model_path)
+                if not isM1Frozen:
+                    saveModel(modelM1, M1_model_path, checkpointer)
+
+        # Full training state of both models, a resumed run continues with the next epoch
+        with timer.phase("checkpoint"):
+            checkpointer.save({"epoch": epoch + 1, "modelM0": modelM0.state_dict(),
+                               "modelM1": {name: module.state_dict() for name, module in modelM1.getModules().items()},
+                               "optimizer": optimizer.state_dict(), "scaler": scaler.state_dict(),
+                               "best_acc": best_acc, "best_val_loss_0": best_val_loss_0,
+                               "best_val_loss_1": best_val_loss_1, "elapsed": time.time() - since,
+                               "early_stopping": {name: stopper.state_dict() for name, stopper in stoppers.items()},
+                               "rng": getRNGState(generators)}, state_path)
+
+        timer.endEpoch(epoch, writer if log else None)
+
+        if broadcastFlag(bool(stoppers) and all(stopper.shouldStop for stopper in stoppers.values())):
+            logging.info("Early stopping at epoch {}: no validation loss improved in the last {} validations".format(
+                epoch, min(stopper.bad_validations for stopper in stoppers.values())))
+            break
 
     time_elapsed = time.time() - since
     logging.info('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
     logging.info('Best val Acc: {:4f}'.format(best_acc))
+    for stopper in stoppers.values():
+        logging.info('Time to target - ' + stopper.report())
+    if isMain:
+        timer.dumpJSON(TBLOGDIR + "_step_timing.json")
 
     # save the model
+    if log:
+        visualizer.close()
     logging.info("Saving the models before exiting")
     if not isM0Frozen:
-        torch.save(modelM0.state_dict(), M0_model_path)
+        checkpointer.save(modelM0.state_dict(), M0_model_path)
     if not isM1Frozen:
-        saveModel(modelM1, M1_model_path)
+        saveModel(modelM1, M1_model_path, checkpointer)
+    checkpointer.close()
 
     logging.info("############################## END Model Training ##############################")
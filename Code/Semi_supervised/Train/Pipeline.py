@@ -16,11 +16,15 @@ sys.path.insert(0, ROOT_DIR + "/")
 from Code.Semi_supervised.Train.Model_M0.M0_main import M0_Pipeline
 from Code.Semi_supervised.Train.Model_M1.M1_main import M1_Pipeline
 from Code.Semi_supervised.Test.main import Test_Pipeline
+from Code.Utils.distributed import isMainProcess, barrier
+from Code.Utils.artifacts import stageKey, dataManifest, stateHash, fileHash
 
 
 class Pipeline:
     def __init__(self, dataset_path, modelWeights_path, log_path, dataset_type, loss_fn, model_type, M1_model_path=None, M1_bw_path=None,
-                 isM0Frozen=False, isM1Frozen=False, device="cuda", seed_value=42):
+                 isM0Frozen=False, isM1Frozen=False, device="cuda", seed_value=42, val_interval=1, patience=None,
+                 min_delta=0.0, batch_size=1, accum_steps=1, pretrained_path=None, artifact_store=None,
+                 flow_cache_path=None, profile=False):
         self.dataset_type = dataset_type
 
         if self.dataset_type == "chaos":
@@ -49,10 +53,18 @@ class Pipeline:
         self.temp_model_train_type = self.temp_model_train_type + "_" + self.loss_fn + "_" + self.model_type
 
         self.modelWeights_path = modelWeights_path
+        # Pre-trained M0 weights may be shared by several runs writing into their own modelWeights_path
+        self.pretrained_path = modelWeights_path if pretrained_path is None else pretrained_path
 
         # Paths for pre training model M0
-        self.M0_model_base = self.modelWeights_path + "M0_" + self.model_type + ".pth"
-        self.M0_model_bw_base = self.modelWeights_path + "M0_bw_" + self.model_type + ".pth"
+        if artifact_store is None:
+            self.M0_model_base = self.pretrained_path + "M0_" + self.model_type + ".pth"
+            self.M0_model_bw_base = self.pretrained_path + "M0_bw_" + self.model_type + ".pth"
+        else:
+            # With a store every run trains or restores M0 in its own weights directory and publishes it only
+            # through the store, concurrent runs never write the shared pre-trained weights
+            self.M0_model_base = self.modelWeights_path + "M0_" + self.loss_fn + "_" + self.model_type + ".pth"
+            self.M0_model_bw_base = self.modelWeights_path + "M0_bw_" + self.loss_fn + "_" + self.model_type + ".pth"
 
         # Paths for main training model M0 + M1
         self.M0_model_path = self.modelWeights_path + "M0_" + self.temp_model_train_type + ".pth"
@@ -72,29 +84,99 @@ class Pipeline:
         self.device = device
         self.seed_value = seed_value
 
+        self.val_interval = val_interval
+        self.patience = patience
+        self.min_delta = min_delta
+
+        self.batch_size = batch_size
+        self.accum_steps = accum_steps
+
+        # Finished stages are reused from the store when their inputs did not change (None: always train)
+        self.artifact_store = artifact_store
+        self._manifest = None
+        # Registrations of a fixed M1 are cached per image pair (None: register every batch)
+        self.flow_cache_path = flow_cache_path
+        # Per-phase step timing of the trainers (off: no device synchronization in production runs)
+        self.profile = profile
+
+    def dataManifest(self):
+        if self._manifest is None:
+            self._manifest = dataManifest(self.dataset_path)
+        return self._manifest
+
+    def stageConfig(self, epochs):
+        return {"dataset_type": self.dataset_type, "loss_fn": self.loss_fn, "model_type": self.model_type,
+                "isM0Frozen": self.isM0Frozen, "isM1Frozen": self.isM1Frozen, "epochs": epochs,
+                "val_interval": self.val_interval, "patience": self.patience, "min_delta": self.min_delta,
+                "batch_size": self.batch_size, "accum_steps": self.accum_steps}
+
     def getModelM0(self, model_weights_path):
         obj = M0_Pipeline(self.dataset_path, self.M0_model_base, self.M0_model_bw_base, self.logPath, self.model_type)
         modelM0 = obj.defineModel()
         # Loading the best weights for Model M0
-        modelM0.load_state_dict(torch.load(model_weights_path))
+        modelM0.load_state_dict(torch.load(model_weights_path, map_location=self.device))
         modelM0.to(self.device)
         return modelM0
 
-    def trainModel_M0(self, epochs):
+    def trainModel_M0(self, epochs, resume=False):
         obj = M0_Pipeline(self.dataset_path, self.M0_model_base, self.M0_model_bw_base,self.loss_fn, self.model_type,
                           self.isChaos, self.device, self.logPath,
-                          epochs=epochs)
-        obj.trainModel()
-
-    def trainModel_M1(self, model_M0, epochs, logger, TestModel=False):
+                          epochs=epochs, val_interval=self.val_interval, patience=self.patience,
+                          min_delta=self.min_delta, batch_size=self.batch_size, accum_steps=self.accum_steps,
+                          profile=self.profile)
+        outputs = {"model": self.M0_model_base, "bw": self.M0_model_bw_base}
+        key = None
+        if self.artifact_store is not None:
+            key = stageKey("M0", self.stageConfig(epochs), obj.seed, self.dataManifest())
+            if self.artifact_store.get(key) is not None:
+                self.artifact_store.restore(key, outputs)
+                barrier()
+                return
+        obj.trainModel(resume=resume)
+        if key is not None and isMainProcess():
+            self.artifact_store.commit(key, "M0", outputs)
+        # Rank 0 alone writes the weights and the artifact, the other ranks read them in the next stage
+        barrier()
+
+    def trainModel_M1(self, model_M0, epochs, logger, TestModel=False, resume=False):
         obj_M1 = M1_Pipeline(self.dataset_path, self.M1_model_path, self.M1_bw_path,self.loss_fn, self.model_type,
                              self.device, self.logPath,
-                             self.isChaos, self.isM0Frozen, self.isM1Frozen, epochs, self.seed_value)
+                             self.isChaos, self.isM0Frozen, self.isM1Frozen, epochs, self.seed_value,
+                             val_interval=self.val_interval, patience=self.patience, min_delta=self.min_delta,
+                             batch_size=self.batch_size, accum_steps=self.accum_steps,
+                             flow_cache_path=self.flow_cache_path, profile=self.profile)
         train_loader, validation_loader, test_loader = obj_M1.train_val_test_slit()
         dataloaders = [train_loader, validation_loader]
-        obj_M1.trainModel(model_M0, dataloaders, logger, self.M0_model_path, self.M0_bw_path)
 
-        if self.dataset_type == "chaos" and TestModel:
+        outputs = {}
+        if not self.isM0Frozen:
+            outputs.update(M0_model=self.M0_model_path, M0_bw=self.M0_bw_path)
+        if not self.isM1Frozen:
+            outputs.update(M1_model=self.M1_model_path, M1_bw=self.M1_bw_path)
+        key = None
+        if self.artifact_store is not None:
+            # The stage depends on the M0 weights it starts from and, in M1 frozen mode, on the loaded M1 weights
+            upstream = [stateHash(model_M0.state_dict())]
+            if self.isM1Frozen:
+                upstream.append(fileHash(self.M1_bw_path))
+            key = stageKey("M1", self.stageConfig(epochs), self.seed_value, self.dataManifest(), upstream)
+
+        if key is not None and self.artifact_store.get(key) is not None:
+            self.artifact_store.restore(key, outputs)
+            if not self.isM0Frozen:
+                # Same M0 state the caller would hold after training
+                model_M0.load_state_dict(torch.load(self.M0_model_path, map_location=self.device))
+        else:
+            obj_M1.trainModel(model_M0, dataloaders, logger, self.M0_model_path, self.M0_bw_path, resume=resume)
+            if key is not None and isMainProcess():
+                self.artifact_store.commit(key, "M1", {name: path for name, path in outputs.items()
+                                                       if os.path.isfile(path)})
+        barrier()
+
+        # The test set is small, it is evaluated by rank 0 alone
+        if self.dataset_type == "chaos" and TestModel and isMainProcess():
             obj_Test = Test_Pipeline(self.M0_model_path, self.M0_bw_path, self.M1_model_path, self.M1_bw_path,
-                                     self.dataset_path, self.logPath, self.device,self.loss_fn,self.model_type)
-            obj_Test.testModel(test_loader)
+                                     self.dataset_path, self.logPath, self.device,self.loss_fn,self.model_type,
+                                     batch_size=self.batch_size, artifact_store=self.artifact_store,
+                                     seed_value=self.seed_value, flow_cache_path=self.flow_cache_path)
+            return obj_Test.testModel(test_loader)
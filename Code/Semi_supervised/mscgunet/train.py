@@ -5,6 +5,56 @@ import torch
 import os
 
 
+class MscgunetInference(nn.Module):
+    """
+    CT <- MRI branch of Mscgunet at full resolution as a single module, shares the sub-modules of the given Mscgunet
+    Used by Mscgunet.register and as the self-contained graph for export (TorchScript / ONNX)
+    """
+
+    def __init__(self, modelM1):
+        super(MscgunetInference, self).__init__()
+        self.feature_extractor = modelM1.feature_extractor_training
+        self.scg = modelM1.scg_training
+        self.graph_layers1 = modelM1.graph_layers1_training
+        self.graph_layers2 = modelM1.graph_layers2_training
+        self.upsamplers = nn.ModuleList([modelM1.upsampler1_training, modelM1.upsampler2_training,
+                                         modelM1.upsampler3_training, modelM1.upsampler4_training,
+                                         modelM1.upsampler5_training])
+        self.conv_decoders = nn.Sequential(modelM1.conv_decoder1_training, modelM1.conv_decoder2_training,
+                                           modelM1.conv_decoder3_training)
+        self.resize = modelM1.resize
+        self.integrate = modelM1.integrate
+        self.fullsize = modelM1.fullsize
+        self.stn_deformable = modelM1.stn_deformable
+
+    def forward(self, CT, MRI, MRI_LBL=None):
+        """
+        :return: warped MRI, warped MRI label (None if not given), full resolution flow, integrated half resolution flow
+        """
+        encodings = self.feature_extractor(CT, MRI)
+        A, gx, _, z_hat = self.scg(encodings[5])
+        B, C, H, W, D = encodings[5].size()
+        gop_layers1, A_layers1 = self.graph_layers1((gx.reshape(B, -1, C), A))
+        gop_layers2, A_layers2 = self.graph_layers2((gop_layers1, A_layers1))
+        gop_layers2 = torch.bmm(A_layers2, gop_layers2) + z_hat
+
+        gx = gop_layers2.reshape(B, 9, 4, 4, 4)
+        gx = F.interpolate(gx, (H, W, D), mode='trilinear', align_corners=False)
+        for upsampler, encoding in zip(self.upsamplers, encodings[4::-1]):
+            gx = upsampler(gx, encoding)
+
+        dvf = self.conv_decoders(torch.cat((CT, gx), 1))
+
+        integrated_flow = self.integrate(self.resize(dvf))
+        full_flow = self.fullsize(integrated_flow)
+
+        warped = self.stn_deformable(MRI, full_flow)
+        pseudo_lbl = None
+        if MRI_LBL is not None:
+            pseudo_lbl = self.stn_deformable(MRI_LBL, full_flow)
+        return warped, pseudo_lbl, full_flow, integrated_flow
+
+
 class Mscgunet:
     def __init__(self, device):
         self.lr = 1e-4
@@ -64,6 +114,8 @@ class Mscgunet:
             param.requires_grad = False
             param.volatile = True
 
+        self.inference = MscgunetInference(self)
+
     def initializeModel(self, model_dir):
         # load previous checkpoints
         checkpoint = torch.load(os.path.join(model_dir), map_location=self.device)
@@ -84,7 +136,51 @@ class Mscgunet:
         self.conv_decoder2_training.load_state_dict(checkpoint["conv_decoder2_training"])
         self.conv_decoder3_training.load_state_dict(checkpoint["conv_decoder3_training"])
 
-    def lossCal(self, CT, MRI, MRI_LBL):
+    def getModules(self):
+        """
+        Trainable sub-modules keyed by the names used in the saved checkpoints
+        """
+        return {"feature_extractor_training": self.feature_extractor_training,
+                "scg_training": self.scg_training,
+                "upsampler1_training": self.upsampler1_training,
+                "upsampler2_training": self.upsampler2_training,
+                "upsampler3_training": self.upsampler3_training,
+                "upsampler4_training": self.upsampler4_training,
+                "upsampler5_training": self.upsampler5_training,
+                "graph_layers1_training": self.graph_layers1_training,
+                "graph_layers2_training": self.graph_layers2_training,
+                "conv_decoder1_training": self.conv_decoder1_training,
+                "conv_decoder2_training": self.conv_decoder2_training,
+                "conv_decoder3_training": self.conv_decoder3_training,
+                "conv_decoder4_training": self.conv_decoder4_training,
+                "conv_decoder5_training": self.conv_decoder5_training,
+                "conv_decoder6_training": self.conv_decoder6_training}
+
+    def register(self, CT, MRI, MRI_LBL=None):
+        """
+        Inference only: warps the MRI (and its label) onto the CT
+        Only the CT <- MRI branch at full resolution is computed, without losses and gradients
+        :return: warped MRI, warped MRI label (None if not given), full resolution flow, integrated half resolution flow
+        """
+        modules = self.getModules().values()
+        training = [module.training for module in modules]
+        for module in modules:
+            module.eval()
+
+        with torch.no_grad():
+            warped, pseudo_lbl, full_flow, integrated_flow = self.inference(
+                CT.float().to(self.device), MRI.float().to(self.device),
+                None if MRI_LBL is None else MRI_LBL.float().to(self.device))
+
+        for module, mode in zip(modules, training):
+            module.train(mode)
+
+        return warped, pseudo_lbl, full_flow, integrated_flow
+
+    def lossCal(self, CT, MRI, MRI_LBL, return_flow=False):
+        """
+        :param return_flow: additionally return the integrated CT <- MRI flow at half resolution
+        """
         X = CT
         Y = MRI
 
@@ -209,4 +305,6 @@ class Mscgunet:
 
         psuedo_lbl = self.stn_deformable(Ylbl, full_flow_xy)
 
+        if return_flow:
+            return total_loss, fully_warped_image_xy, psuedo_lbl, integrated_pos_flow_xy
         return total_loss, fully_warped_image_xy, psuedo_lbl
@@ -45,3 +45,21 @@ class CustomDataset(Dataset):
 
     def __len__(self):
         return self.data_len
+
+
+def getSubjectsDataset(dataset_path, csv_file, transform=None, preload=True):
+    """
+    Same volumes as CustomDataset, as a torchio SubjectsDataset for patch sampling
+    Args:
+        preload: read every volume once and keep it in memory, otherwise the queue workers read the files each time
+                 a volume is sampled (for datasets that do not fit into memory)
+    """
+    data_info = pd.read_csv(csv_file, header=None)
+    subjects = []
+    for image_name, label_name in zip(data_info.iloc[:, 0], data_info.iloc[:, 1]):
+        subject = tio.Subject(image=tio.ScalarImage(dataset_path + "images/" + image_name),
+                              label=tio.LabelMap(dataset_path + "gt/" + label_name))
+        if preload:
+            subject.load()
+        subjects.append(subject)
+    return tio.SubjectsDataset(subjects, transform=transform)
@@ -1,13 +1,15 @@
 import os
 import sys
+from functools import partial
 
+import torch
 import torch.optim as optim
 import torchio as tio
 from torchvision import transforms
 
 from Code.Utils.loss import DiceLoss
 from Model.M0 import U_Net_M0
-from dataloader import CustomDataset
+from dataloader import CustomDataset, getSubjectsDataset
 from train import train
 
 try:
@@ -46,10 +48,43 @@ def getTransform(m, s):
     return preprocess
 
 
-def trainModel():
+def _padToSize(tensor, size):
+    # Zero padding at the end of every axis keeps the affine of the volume valid
+    widths = []
+    for dim, target in reversed(list(zip(tensor.shape[1:], size))):
+        widths += [0, max(target - dim, 0)]
+    return torch.nn.functional.pad(tensor, widths)
+
+
+def padToPatch(patch_size):
+    """
+    Pads the image and label of every subject to at least patch_size, the patch samplers reject smaller volumes
+    Larger volumes are left untouched, unlike tio.CropOrPad.
+    """
+    return tio.Lambda(partial(_padToSize, size=patch_size))
+
+
+def getPatchLoader(subjects_dataset, patch_size, samples_per_volume, queue_length, batch_size,
+                   foreground_probability=None, num_workers=4):
+    """
+    Patches are sampled by background workers into a queue, so the GPU never waits for a volume to be read
+    :param foreground_probability: probability of a patch being centred on the label, None samples uniformly
+    """
+    if foreground_probability is None:
+        sampler = tio.data.UniformSampler(patch_size)
+    else:
+        sampler = tio.data.LabelSampler(patch_size, label_name="label",
+                                        label_probabilities={0: 1 - foreground_probability,
+                                                             1: foreground_probability})
+    queue = tio.Queue(subjects_dataset, max_length=queue_length, samples_per_volume=samples_per_volume,
+                      sampler=sampler, num_workers=num_workers, shuffle_subjects=True, shuffle_patches=True)
+    # The queue already loads in its own workers, the loader must not spawn more
+    return torch.utils.data.DataLoader(queue, batch_size=batch_size, num_workers=0, pin_memory=True)
+
+
+def trainModel(patches=True, device="cuda", profile=False):
     model = defineModel()
     optimizer = defineOptimizer(model)
-    criterion = defineCriterion
     modelPath = "/project/mukhopad/tmp/LiverTumorSeg/Code/Supervised/model_weights/m1.pth"
     modelPath_bestweight = "/project/mukhopad/tmp/LiverTumorSeg/Code/Supervised/model_weights/m1_bw.pth"
     dataset_path = "/project/tawde/DL_Liver/NewDataforReg/Dataset/"
@@ -59,9 +94,20 @@ def trainModel():
     num_epochs = 1000
     # checkCSV_Student(dataset_Path=dataset_path, csv_FileName=csv_file, overwrite=True)
     csv_file = "/project/tawde/DL_Liver/NewDataforReg/Dataset/Data.csv"
-    dataloaders = CustomDataset(dataset_path, csv_file, transform)
-
-    train(dataloaders, modelPath, modelPath_bestweight, num_epochs, model, criterion, optimizer)
-
-
-trainModel()
+    if patches:
+        # (W, H, D) as stored, every dimension has to be divisible by 16 for the four poolings of the U-Net
+        patch_size = (128, 128, 32)
+        subjects_dataset = getSubjectsDataset(dataset_path, csv_file, transform=padToPatch(patch_size),
+                                              preload=True)
+        dataloader = getPatchLoader(subjects_dataset, patch_size, samples_per_volume=8, queue_length=64,
+                                    batch_size=4, foreground_probability=0.7)
+    else:
+        dataset = CustomDataset(dataset_path, csv_file, transform)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=True, num_workers=2,
+                                                 pin_memory=True)
+
+    train(dataloader, modelPath, modelPath_bestweight, num_epochs, model, optimizer, device=device, profile=profile)
+
+
+# --profile: per-phase step timing, synchronizes the device at every phase boundary
+trainModel(profile="--profile" in sys.argv)
@@ -5,11 +5,15 @@ from datetime import datetime
 
 import matplotlib.pyplot as plt
 import torch
+import torchio as tio
 from torch.cuda.amp import autocast, GradScaler
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
-from Code.Utils.loss import DiceLoss
+from Code.Utils.checkpoint import CheckpointWriter, atomicSave
+from Code.Utils.loss import DiceLoss, dice_per_sample
+from Code.Utils.profiling import StepTimer
+from Code.Utils.visualization import VisualizationWriter
 
 scaler = GradScaler()
 torch.set_num_threads(1)
@@ -38,19 +42,38 @@ def saveImage(img, lbl, op, disp_imgs):
     return figure
 
 
+def prepareBatch(batch, device):
+    """
+    Moves a batch of whole volumes (CustomDataset) or of patches (torchio queue) to the device
+    :return: image and label as (B, 1, D, H, W)
+    """
+    if isinstance(batch, dict):
+        image = batch["image"][tio.DATA]
+        label = batch["label"][tio.DATA]
+    else:
+        image, label = batch
+        image = image.unsqueeze(1)
+        label = label.unsqueeze(1)
+    # torchio keeps the volumes as (W, H, D), the model expects the slices first
+    image = image.permute(0, 1, 4, 2, 3).to(device=device, dtype=torch.float, non_blocking=True)
+    label = label.permute(0, 1, 4, 2, 3).to(device=device, dtype=torch.float, non_blocking=True)
+    return image, label
+
+
 def train(dataloaders, modelPath, modelPath_bestweight, num_epochs, model, optimizer,
-          log=False, device="cuda:4"):
+          log=False, device="cuda", profile=False):
+    start_time = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
+    TBLOGDIR = "/project/mukhopad/tmp/LiverTumorSeg/Code/Supervised/runs/Training/{}".format(start_time)
     if log:
-        start_time = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
-        TBLOGDIR = "/project/mukhopad/tmp/LiverTumorSeg/Code/Supervised/runs/Training/{}".format(start_time)
         writer = SummaryWriter(TBLOGDIR)
+        visualizer = VisualizationWriter(writer)
+    timer = StepTimer(device, enabled=profile)
+    checkpointer = CheckpointWriter()
     best_model_wts = ""
     best_acc = 0.0
     best_val_loss = 99999
     since = time.time()
     model.to(device)
-    params_to_update = model.parameters()
-    optimizer = torch.optim.SGD(params=params_to_update, lr=0.001, momentum=0.9)
     criterion = DiceLoss()
     store_idx = 1  # int(len(dataloaders[0])/2)
     # criterion = torch.nn.
@@ -71,32 +94,36 @@ def train(dataloaders, modelPath, modelPath_bestweight, num_epochs, model, optim
             running_corrects = 0
             idx = 0
             # Iterate over data.
-            for batch in tqdm(dataloaders):
-                image_batch, labels_batch = batch
-
+            for batch in tqdm(timer.iterate(dataloaders), total=len(dataloaders)):
                 optimizer.zero_grad()
                 # forward
                 with torch.set_grad_enabled(phase == 0):
                     with autocast(enabled=True):
-                        outputs = model(
-                            image_batch.permute(2, 0, 1).unsqueeze(0).unsqueeze(0).to(device=device, dtype=torch.float))
-                        loss, acc = criterion(outputs[0].squeeze(1).squeeze(0),
-                                              labels_batch.permute(2, 0, 1).to(device))
+                        with timer.phase("h2d"):
+                            image, label = prepareBatch(batch, device)
+                        with timer.phase("forward"):
+                            outputs = model(image)
+                        with timer.phase("loss"):
+                            loss = criterion(outputs, label)
+                            acc = dice_per_sample(outputs.float(), label).mean()
 
                     # backward + optimize only if in training phase
                     if phase == 0:
-                        scaler.scale(loss).backward()
-                        scaler.step(optimizer)
-                        scaler.update()
-                        if epoch % 50 == 0:
-                            s = random.randint(1, 21)
-                            img = image_batch[:, :, s:(s + disp_imgs)].detach().cpu()
-                            lbl = labels_batch[:, :, s:(s + disp_imgs)].detach().cpu()
-                            op = outputs[0].squeeze().permute(1, 2, 0)[:, :, s:(s + disp_imgs)].detach().cpu()
-
-                            fig = saveImage(img, lbl, op, disp_imgs)
-                            text = "Epoch : " + str(epoch)
-                            writer.add_figure(text, fig, epoch)
+                        with timer.phase("backward"):
+                            scaler.scale(loss).backward()
+                        with timer.phase("optimizer"):
+                            scaler.step(optimizer)
+                            scaler.update()
+                        if epoch % 50 == 0 and log:
+                            with timer.phase("logging"):
+                                # slabs of consecutive slices of the first volume (or patch) of the batch
+                                num_slices = min(disp_imgs, image.shape[2])
+                                s = random.randint(0, image.shape[2] - num_slices)
+                                visualizer.submit(saveImage, "Epoch : " + str(epoch), epoch,
+                                                  {"img": image[0, 0, s:(s + num_slices)].permute(1, 2, 0),
+                                                   "lbl": label[0, 0, s:(s + num_slices)].permute(1, 2, 0),
+                                                   "op": outputs[0, 0, s:(s + num_slices)].permute(1, 2, 0)},
+                                                  disp_imgs=num_slices)
 
                     # statistics
                     running_loss += loss.item()
@@ -106,8 +133,8 @@ def train(dataloaders, modelPath, modelPath_bestweight, num_epochs, model, optim
                     running_corrects += acc.item()
                     idx += 1
 
-            epoch_loss = running_loss / len(dataloaders[phase])
-            epoch_acc = running_corrects / len(dataloaders[phase])
+            epoch_loss = running_loss / idx
+            epoch_acc = running_corrects / idx
             if phase == 0:
                 mode = "Train"
                 if log:
@@ -131,18 +158,27 @@ def train(dataloaders, modelPath, modelPath_bestweight, num_epochs, model, optim
         if epoch % 10 == 0:
             print("Saving the model")
             # save the model
-            torch.save(model.state_dict(), modelPath)
+            with timer.phase("checkpoint"):
+                checkpointer.save(model.state_dict(), modelPath)
             # load best model weights
             # model.load_state_dict(best_model_wts)
             # torch.save(model, modelPath_bestweight)
 
+        timer.endEpoch(epoch, writer if log else None)
+
     time_elapsed = time.time() - since
     print('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
     print('Best val Acc: {:4f}'.format(best_acc))
+    timer.dumpJSON(TBLOGDIR + "_step_timing.json")
 
+    if log:
+        visualizer.close()
+    # the final saves pickle the whole model, so they are written synchronously once the pending ones are done
+    checkpointer.close()
     print("Saving the model")
     # save the model
-    torch.save(model, modelPath)
-    # load best model weights
-    model.load_state_dict(best_model_wts)
-    torch.save(model, modelPath_bestweight)
+    atomicSave(model, modelPath)
+    # load best model weights, without a validation phase the final weights are the best ones
+    if best_model_wts:
+        model.load_state_dict(best_model_wts)
+    atomicSave(model, modelPath_bestweight)
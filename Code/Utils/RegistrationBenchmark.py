@@ -0,0 +1,150 @@
+import argparse
+import os
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import ants
+import numpy as np
+import pandas as pd
+import torch
+
+try:
+    from Code.Utils.antsImpl import RegistrationService, registration
+    from Code.Utils.metrics import ncc, segmentationMetrics
+    from Code.Utils.ssim3d import ssim3d
+except ImportError:
+    from antsImpl import RegistrationService, registration
+    from metrics import ncc, segmentationMetrics
+    from ssim3d import ssim3d
+
+TRANSLATION_TYPES = ["SyN", "Affine", "BOLDAffine", "BOLDRigid", "QuickRigid", "Rigid", "Similarity",
+                     "SyNRA", "Translation"]
+
+RESULT_COLUMNS = ["subject", "transform", "runtime_s", "ssim", "ncc", "mi", "dice", "error"]
+
+
+def toArray(img):
+    """
+    Converts an ANTsImage into a picklable dict (array + header) so that it can be sent to a worker process
+    """
+    return {"data": img.numpy(), "origin": img.origin, "spacing": img.spacing, "direction": img.direction}
+
+
+def fromArray(arr):
+    return ants.from_numpy(arr["data"], origin=arr["origin"], spacing=arr["spacing"], direction=arr["direction"])
+
+
+def loadPair(dataset_path, name, isChaos=True):
+    """
+    Reads the MRI/CT pair of one subject (and their labels, if present) exactly once
+    """
+    pair = {"mri": toArray(ants.image_read(os.path.join(dataset_path, "mri", name))),
+            "ct": toArray(ants.image_read(os.path.join(dataset_path, "ct", name)))}
+
+    mri_gt = os.path.join(dataset_path, "mri_gt", name)
+    ct_gt = os.path.join(dataset_path, "ct_gt", name)
+    if os.path.isfile(mri_gt) and os.path.isfile(ct_gt):
+        mri_lbl = ants.image_read(mri_gt)
+        if isChaos:
+            # Using the liver section in the MRI label
+            data = mri_lbl.numpy()
+            mri_lbl = mri_lbl.new_image_like(((data >= 55) & (data <= 70)).astype(np.float32))
+        pair["mri_gt"] = toArray(mri_lbl)
+        pair["ct_gt"] = toArray(ants.image_read(ct_gt))
+    return pair
+
+
+def cropEmptySlices(img, ref):
+    """
+    Drops the axial slices (last axis) that are empty in img from both volumes
+    """
+    keep = img.reshape(-1, img.shape[-1]).any(0)
+    return img[..., keep], ref[..., keep]
+
+
+def normalize(img):
+    return (img - img.min()) / (img.max() - img.min() + 1e-8)
+
+
+def runJob(subject, transform, pair, tmp_root=None):
+    row = dict.fromkeys(RESULT_COLUMNS)
+    row.update(subject=subject, transform=transform)
+
+    try:
+        fixed = fromArray(pair["ct"])
+        moving = fromArray(pair["mri"])
+
+        with registration(fixed, moving, transform, tmp_root,
+                          prefix="{}_{}_".format(subject.split(".")[0], transform)) as (mytx, runtime):
+            row["runtime_s"] = runtime
+
+            warped = mytx["warpedmovout"]
+            fixed_np = fixed.numpy()
+            warped_np = warped.numpy()
+
+            row["ncc"] = ncc(fixed_np, warped_np)
+            row["mi"] = ants.image_mutual_information(fixed.clone("float"), warped.clone("float"))
+
+            warped_crop, fixed_crop = cropEmptySlices(warped_np, fixed_np)
+            row["ssim"] = ssim3d(torch.from_numpy(normalize(warped_crop)).permute(2, 0, 1).float(),
+                                 torch.from_numpy(normalize(fixed_crop)).permute(2, 0, 1).float()).item()
+
+            if "mri_gt" in pair:
+                warped_lbl = ants.apply_transforms(fixed=fixed, moving=fromArray(pair["mri_gt"]),
+                                                   transformlist=mytx["fwdtransforms"],
+                                                   interpolator="nearestNeighbor")
+                row["dice"] = segmentationMetrics(warped_lbl.numpy(), pair["ct_gt"]["data"] > 0,
+                                                  surface=False)["dice"][0]
+    except Exception as e:
+        row["error"] = repr(e)
+    return row
+
+
+def findSubjects(dataset_path):
+    mri = {p.name for p in Path(dataset_path, "mri").glob("*")}
+    ct = {p.name for p in Path(dataset_path, "ct").glob("*")}
+    return sorted(mri & ct)
+
+
+def benchmark(dataset_path, output_csv, transforms=TRANSLATION_TYPES, workers=4, threads_per_job=1, tmp_root=None,
+              isChaos=True):
+    """
+    Runs every subject x transform registration on a process pool and writes one result row per job
+    """
+    subjects = findSubjects(dataset_path)
+    rows = []
+    with RegistrationService(workers=workers, threads_per_job=threads_per_job) as service:
+        futures = []
+        for subject in subjects:
+            pair = loadPair(dataset_path, subject, isChaos)
+            for transform in transforms:
+                futures.append(service.submitJob(runJob, subject, transform, pair, tmp_root))
+        for future in as_completed(futures):
+            row = future.result()
+            print("Subject: {}  Transform: {}  Runtime: {}  SSIM: {}  Error: {}".format(
+                row["subject"], row["transform"], row["runtime_s"], row["ssim"], row["error"]))
+            rows.append(row)
+
+    results = pd.DataFrame(rows, columns=RESULT_COLUMNS).sort_values(["subject", "transform"])
+    results.to_csv(output_csv, index=False)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel ANTs registration baseline benchmark")
+    parser.add_argument("--dataset", default="/project/mukhopad/tmp/LiverTumorSeg/Dataset/chaos_3D/")
+    parser.add_argument("--output", default="ants_benchmark.csv")
+    parser.add_argument("--transforms", nargs="+", default=TRANSLATION_TYPES)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads-per-job", type=int, default=1)
+    parser.add_argument("--tmp-root", default=None)
+    parser.add_argument("--clinical", action="store_true")
+    args = parser.parse_args()
+
+    results = benchmark(args.dataset, args.output, args.transforms, args.workers, args.threads_per_job,
+                        args.tmp_root, isChaos=not args.clinical)
+    print(results.groupby("transform")[["runtime_s", "ssim", "ncc", "mi", "dice"]].mean())
+
+
+if __name__ == "__main__":
+    main()
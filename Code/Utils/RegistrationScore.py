@@ -5,7 +5,7 @@ import ants
 import torch
 import torchio as tio
 
-import pytorch_ssim
+from ssim3d import ssim3d
 
 torch.set_num_threads(1)
 
@@ -16,21 +16,10 @@ print('gettempdir():', tempfile.gettempdir())
 
 
 def fixImage(img, img1):
-    out = 0
-    out_2 = 0
-    flag = 0
-    for i in range(0, img[tio.DATA].squeeze().shape[2]):
-        temp = img[tio.DATA].squeeze(0)[:, :, i:(i + 1)]
-        temp2 = img1[:, :, i:(i + 1)]
-        if temp.max() != 0:
-            if flag != 0:
-                out = torch.cat((out, temp), 2)
-                out_2 = torch.cat((out_2, torch.tensor(temp2)), 2)
-            else:
-                out = temp
-                out_2 = torch.tensor(temp2)
-                flag = 1
-    return out, out_2
+    # Keep only the axial slices whose warped content is non-empty
+    data = img[tio.DATA].squeeze(0)
+    keep = data.flatten(0, 1).amax(0) != 0
+    return data[:, :, keep], torch.tensor(img1)[:, :, keep]
 
 
 def main():
@@ -72,8 +61,7 @@ def main():
                         if torch.cuda.is_available():
                             img1 = img1.cuda()
                             img2 = img2.cuda()
-                        ssim = pytorch_ssim.ssim(img1.permute(2, 1, 0).unsqueeze(0), img2.permute(2, 1, 0).unsqueeze(0),
-                                                 size_average=False)
+                        ssim = ssim3d(img1.permute(2, 0, 1).float(), img2.permute(2, 0, 1).float())
                         print("SSIM :", ssim.item())
                     except:
                         print("Cannot calculate SSIM")
@@ -1,25 +1,191 @@
+import os
+import glob
+import time
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
 import ants
+import numpy as np
 
 
-def getWarp_antspy(moving, fixed):
-    # mi = ants.image_read(moving)
-    # fi = ants.image_read(fixed)
-    mi = ants.from_numpy(moving)
-    fi = ants.from_numpy(fixed)
-    mytx = ants.registration(fixed=fi, moving=mi, type_of_transform='SyN', verbose=False,
-                             outprefix="/scratch/mukhopad/")
+def getWarp_antspy(moving, fixed, service, type_of_transform='SyN'):
+    """
+    Forward transforms of moving onto fixed, registered by (or read from the cache of) a RegistrationService
+    The transform files belong to the service cache, RegistrationService.clear removes them
+    """
+    return service.register(fixed, moving, type_of_transform)['fwdtransforms']
 
-    return mytx['fwdtransforms']
 
-
-def applyTransformation(fixed, moving, transformation):
+def applyTransformation(fixed, moving, transformation, interpolator='linear', whichtoinvert=None):
     mi = ants.from_numpy(moving)
     fi = ants.from_numpy(fixed)
     mywarpedimage = ants.apply_transforms(fixed=fi, moving=mi,
-                                          transformlist=transformation)
+                                          transformlist=transformation, interpolator=interpolator,
+                                          whichtoinvert=whichtoinvert)
     return mywarpedimage
 
 
+def transformKey(fixed, moving, type_of_transform):
+    """
+    Content hash identifying a registration: fixed image, moving image and transform type
+    """
+    h = hashlib.sha256()
+    for img in (fixed, moving):
+        img = np.ascontiguousarray(img)
+        h.update(str((img.shape, img.dtype.str)).encode())
+        h.update(img.tobytes())
+    h.update(type_of_transform.encode())
+    return h.hexdigest()
+
+
+def initWorker(threads):
+    # ITK reads the thread budget when its global thread pool is created, i.e. before the first registration
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(threads)
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+
+
+@contextmanager
+def registration(fixed, moving, type_of_transform, tmp_root=None, prefix="ants_"):
+    """
+    ants.registration into its own temporary prefix, which is removed on exit
+    Used by the jobs that evaluate a registration inside a RegistrationService worker.
+    :return: ants.registration result, runtime in seconds
+    """
+    job_dir = tempfile.mkdtemp(prefix=prefix, dir=tmp_root)
+    try:
+        since = time.time()
+        mytx = ants.registration(fixed=fixed, moving=moving, type_of_transform=type_of_transform, verbose=False,
+                                 outprefix=os.path.join(job_dir, ""))
+        yield mytx, time.time() - since
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def _register(fixed, moving, type_of_transform, cache_dir, key):
+    job_dir = tempfile.mkdtemp(prefix=key[:12] + "_", dir=cache_dir)
+    try:
+        mytx = ants.registration(fixed=ants.from_numpy(fixed), moving=ants.from_numpy(moving),
+                                 type_of_transform=type_of_transform, verbose=False,
+                                 outprefix=os.path.join(job_dir, ""))
+        # Move the finished transforms into the cache entry in one rename, readers never see a partial entry
+        entry = os.path.join(cache_dir, key)
+        files = {"fwdtransforms": [os.path.basename(t) for t in mytx['fwdtransforms']],
+                 "invtransforms": [os.path.basename(t) for t in mytx['invtransforms']]}
+        with open(os.path.join(job_dir, "transforms.txt"), "w") as f:
+            for name in ("fwdtransforms", "invtransforms"):
+                f.write(name + "=" + ",".join(files[name]) + "\n")
+        try:
+            os.rename(job_dir, entry)
+        except OSError:
+            # Another worker finished the same registration first
+            shutil.rmtree(job_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+    return key
+
+
+class RegistrationService:
+    """
+    Runs ANTs registrations in a worker pool and caches the forward/inverse transforms on disk
+    Transforms are keyed by transformKey, so repeated warps of labels or other modalities only pay for
+    apply_transforms. The same workers run the jobs of the registration benchmarks (submitJob).
+    """
+
+    def __init__(self, cache_dir=None, workers=1, threads_per_job=1, isolated=False):
+        """
+        :param cache_dir: transform cache, None uses a temporary directory that is removed on close
+        :param isolated: every job runs in its own freshly spawned process, which inherits no memory of the parent
+        """
+        self.ownsCache = cache_dir is None
+        self.cache_dir = tempfile.mkdtemp(prefix="ants_cache_") if cache_dir is None else cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if isolated:
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                            max_tasks_per_child=1, initializer=initWorker,
+                                            initargs=(threads_per_job,))
+        else:
+            self.pool = ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(threads_per_job,))
+        self.pending = {}
+
+    def getTransforms(self, key):
+        """
+        :return: dict with the absolute 'fwdtransforms' and 'invtransforms' paths, or None if not cached
+        """
+        entry = os.path.join(self.cache_dir, key)
+        index = os.path.join(entry, "transforms.txt")
+        if not os.path.isfile(index):
+            return None
+        transforms = {}
+        with open(index) as f:
+            for line in f:
+                name, files = line.strip().split("=")
+                transforms[name] = [os.path.join(entry, t) for t in files.split(",") if t]
+        return transforms
+
+    def submit(self, fixed, moving, type_of_transform='SyN'):
+        """
+        Queues a registration (unless it is already cached or running) and returns its key
+        """
+        key = transformKey(fixed, moving, type_of_transform)
+        if self.getTransforms(key) is None and key not in self.pending:
+            self.pending[key] = self.pool.submit(_register, np.ascontiguousarray(fixed, dtype=np.float32),
+                                                 np.ascontiguousarray(moving, dtype=np.float32),
+                                                 type_of_transform, self.cache_dir, key)
+        return key
+
+    def wait(self, key):
+        if key in self.pending:
+            self.pending.pop(key).result()
+        transforms = self.getTransforms(key)
+        if transforms is None:
+            raise RuntimeError("Registration " + key + " did not produce any transform")
+        return transforms
+
+    def register(self, fixed, moving, type_of_transform='SyN'):
+        return self.wait(self.submit(fixed, moving, type_of_transform))
+
+    def submitJob(self, fn, *args):
+        """
+        Runs fn(*args) on the workers, e.g. a benchmark job registering with registration()
+        :return: future of the result
+        """
+        return self.pool.submit(fn, *args)
+
+    def warp(self, fixed, moving, key, interpolator='linear', inverse=False):
+        """
+        Applies a cached transform to another image (e.g. a label or a second modality)
+        """
+        transforms = self.wait(key)
+        if inverse:
+            # invtransforms lists the affine matrices un-inverted, only the inverse warp fields are inverted already
+            invtransforms = transforms['invtransforms']
+            return applyTransformation(fixed, moving, invtransforms, interpolator,
+                                       [path.endswith(".mat") for path in invtransforms])
+        return applyTransformation(fixed, moving, transforms['fwdtransforms'], interpolator)
+
+    def clear(self):
+        for entry in glob.glob(os.path.join(self.cache_dir, "*")):
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        if self.ownsCache:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def getWarp_simpleITK(img1, img2):
     fi = ants.image_read(ants.get_ants_data('r16'))  # Sample Input
     mi = ants.image_read(ants.get_ants_data('r64'))  # Sample Input
@@ -41,4 +207,5 @@ def getMutalInfo(img1, img2):
 
 """moving = r'/project/tawde/DL_Liver/NewDataforReg/CTDIcom/1/Nifty/MR1nifty.nii.gz'
 fixed = r'/project/tawde/DL_Liver/NewDataforReg/CTDIcom/1/Nifty/CT1nifty.nii.gz'
-a = getWarp_antspy(moving, fixed)"""
+with RegistrationService() as service:
+    a = getWarp_antspy(moving, fixed, service)"""
@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import torch
+
+
+def fileHash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def stateHash(state_dict):
+    """
+    Content hash of in-memory weights, independent of the device they live on
+    """
+    h = hashlib.sha256()
+    for name, tensor in sorted(state_dict.items()):
+        tensor = tensor.detach().cpu().contiguous()
+        h.update(name.encode())
+        h.update(str((tuple(tensor.shape), str(tensor.dtype))).encode())
+        h.update(tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() else b"")
+    return h.hexdigest()
+
+
+def dataManifest(dataset_path, exclude=("temp",)):
+    """
+    Cheap fingerprint of a dataset directory: relative path, size and modification time of every file
+    The preprocessing cache (temp/) is excluded, it is derived from the other files
+    """
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(dataset_path):
+        dirs[:] = sorted(d for d in dirs if d not in exclude)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            h.update(str((os.path.relpath(path, dataset_path), stat.st_size, stat.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def stageKey(stage, config, seed, manifest, upstream=()):
+    """
+    Identity of a pipeline stage: its configuration, seed, input data and the hashes of the artifacts it consumes
+    """
+    description = {"stage": stage, "config": config, "seed": seed, "manifest": manifest, "upstream": list(upstream)}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _copyAtomic(src, dst):
+    tmp_path = "{}.tmp.{}".format(dst, os.getpid())
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class ArtifactStore:
+    """
+    Content-addressed store for the outputs of pipeline stages
+    Every entry is a directory named by its stage key holding the produced files and an artifact.json index. Entries
+    are assembled in a temporary directory and renamed into place, so an entry either is complete or does not exist.
+    """
+
+    INDEX = "artifact.json"
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def entryPath(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """
+        :return: index of the finished artifact, None if the stage has not been run with these inputs
+        """
+        index = os.path.join(self.entryPath(key), self.INDEX)
+        if not os.path.isfile(index):
+            return None
+        with open(index) as f:
+            return json.load(f)
+
+    def filePath(self, key, name):
+        return os.path.join(self.entryPath(key), self.get(key)["files"][name]["file"])
+
+    def fileHashOf(self, key, name):
+        return self.get(key)["files"][name]["sha256"]
+
+    def restore(self, key, targets):
+        """
+        Copies the files of an artifact to the paths the pipeline expects them at
+        :param targets: dict name -> destination path, names the stage did not produce are skipped
+        """
+        entry = self.get(key)
+        for name, path in targets.items():
+            if name in entry["files"]:
+                _copyAtomic(os.path.join(self.entryPath(key), entry["files"][name]["file"]), path)
+        logging.info("Reusing artifact " + key + " : " + ", ".join(targets))
+
+    def commit(self, key, stage, files, metadata=None):
+        """
+        :param files: dict name -> path of a produced file
+        """
+        parent = os.path.dirname(self.entryPath(key))
+        os.makedirs(parent, exist_ok=True)
+        job_dir = tempfile.mkdtemp(prefix=key[:12] + "_", dir=parent)
+        try:
+            index = {"stage": stage, "key": key, "created": time.strftime("%Y.%m.%d.%H.%M.%S"),
+                     "metadata": metadata or {}, "files": {}}
+            for name, path in files.items():
+                file_name = name + os.path.splitext(path)[1]
+                shutil.copyfile(path, os.path.join(job_dir, file_name))
+                index["files"][name] = {"file": file_name, "sha256": fileHash(path)}
+            with open(os.path.join(job_dir, self.INDEX), "w") as f:
+                json.dump(index, f, indent=2)
+            try:
+                os.rename(job_dir, self.entryPath(key))
+            except OSError:
+                # Another run committed the same stage first
+                shutil.rmtree(job_dir, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+        logging.info("Stored artifact " + key + " for stage " + stage)
+        return self.get(key)
@@ -0,0 +1,167 @@
+import os
+import random
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def toCPU(obj):
+    """
+    Detached CPU copy of a (nested) state dict, safe to serialise while training keeps updating the originals
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, toCPU(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(toCPU(v) for v in obj)
+    return obj
+
+
+def atomicSave(obj, path):
+    """
+    torch.save to a temporary file in the same directory followed by an atomic rename,
+    so that a crash never leaves a truncated checkpoint behind
+    """
+    tmp_path = "{}.tmp.{}".format(path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class CheckpointWriter:
+    """
+    Serialises checkpoints on a background thread
+    save() only takes a CPU snapshot; if a path is saved again before the previous request was written,
+    the older snapshot is replaced (coalesced) and never hits the disk
+    A disabled writer ignores every save, e.g. on the non-zero ranks of a distributed run
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.writing = False
+        self.stopped = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="CheckpointWriter", daemon=True)
+        if self.enabled:
+            self.thread.start()
+
+    def save(self, obj, path):
+        if not self.enabled:
+            return
+        snapshot = toCPU(obj)
+        with self.condition:
+            self._raiseError()
+            self.pending.pop(path, None)
+            self.pending[path] = snapshot
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                path, snapshot = self.pending.popitem(last=False)
+                self.writing = True
+            try:
+                atomicSave(snapshot, path)
+            except Exception as e:
+                logging.error("Saving checkpoint " + path + " failed: " + repr(e))
+                with self.condition:
+                    self.error = e
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def _raiseError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Background checkpoint write failed") from error
+
+    def flush(self):
+        """
+        Blocks until every requested checkpoint is on disk
+        """
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+            self._raiseError()
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.flush()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+def statePath(path):
+    """
+    Path of the resumable training state that belongs to a weights file, e.g. M0_Unet.pth -> M0_Unet_state.pth
+    """
+    root, ext = os.path.splitext(path)
+    return root + "_state" + (ext or ".pth")
+
+
+def loaderGenerators(dataloaders):
+    return [loader.generator for loader in dataloaders if getattr(loader, "generator", None) is not None]
+
+
+def getRNGState(generators=()):
+    """
+    Every random stream a training run draws from: python, numpy, torch (CPU and CUDA) and the dataloader generators
+    The numpy state is stored as plain python types so the checkpoint only holds tensors and builtins
+    """
+    np_state = np.random.get_state()
+    state = {"random": random.getstate(),
+             "numpy": (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+             "torch": torch.get_rng_state(),
+             "generators": [g.get_state() for g in generators]}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def setRNGState(state, generators=()):
+    random.setstate(state["random"])
+    np_state = state["numpy"]
+    np.random.set_state((np_state[0], np.asarray(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        if len(state["cuda"]) == torch.cuda.device_count():
+            torch.cuda.set_rng_state_all(state["cuda"])
+        else:
+            logging.warning("CUDA device count changed, the CUDA RNG state is not restored")
+    if len(state["generators"]) != len(generators):
+        raise ValueError("Checkpoint holds {} generator states, got {} generators".format(len(state["generators"]),
+                                                                                           len(generators)))
+    for generator, generator_state in zip(generators, state["generators"]):
+        generator.set_state(generator_state)
+
+
+def loadTrainingState(path):
+    """
+    :return: the saved training state, or None if the run has not written one yet
+    """
+    if not os.path.isfile(path):
+        logging.info("No training state found at " + path + ", starting from scratch")
+        return None
+    logging.info("Resuming from training state " + path)
+    return torch.load(path, map_location="cpu")
@@ -0,0 +1,136 @@
+import os
+import logging
+
+import torch
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def initDistributed(device="cuda"):
+    """
+    Joins the process group described by the torchrun environment (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, ...)
+    CUDA ranks use NCCL and one device per local rank, everything else uses gloo on the CPU
+    :return: device of this rank
+    """
+    if "WORLD_SIZE" not in os.environ:
+        logging.warning("No torchrun environment found, running on a single process")
+        return device
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if str(device).startswith("cuda") and torch.cuda.is_available():
+        device = "cuda:{}".format(local_rank)
+        torch.cuda.set_device(device)
+        backend = "nccl"
+    else:
+        device = "cpu"
+        backend = "gloo"
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    logging.info("Rank {}/{} using {} on {}".format(getRank(), getWorldSize(), backend, device))
+    return device
+
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def getRank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def getWorldSize():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def isMainProcess():
+    return getRank() == 0
+
+
+def barrier():
+    """
+    Waits until every rank reached this point, e.g. until rank 0 wrote the weights the next stage reads
+    """
+    if getWorldSize() > 1:
+        dist.barrier()
+
+
+def getSampler(dataset, seed, shuffle=True):
+    """
+    Shards the dataset across the ranks, None when running on a single process
+    """
+    if getWorldSize() == 1:
+        return None
+    return DistributedSampler(dataset, num_replicas=getWorldSize(), rank=getRank(), shuffle=shuffle, seed=seed)
+
+
+def setEpoch(dataloaders, epoch):
+    # DistributedSampler derives its shuffling from seed + epoch, all ranks have to agree on the epoch
+    for loader in dataloaders:
+        if isinstance(loader.sampler, DistributedSampler):
+            loader.sampler.set_epoch(epoch)
+
+
+def _tensors(modules):
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            yield tensor
+
+
+def broadcastParameters(modules):
+    """
+    Copies the parameters and buffers (e.g. BatchNorm statistics) of rank 0 to every rank
+    """
+    if getWorldSize() == 1:
+        return
+    for tensor in _tensors(modules):
+        dist.broadcast(tensor.data, src=0)
+
+
+def allReduceGradients(optimizer):
+    """
+    Averages the gradients of all parameters handled by the optimizer across the ranks
+    The gradients are flattened into one buffer per device and dtype, so every step issues only a few collectives.
+    Works for optimizers spanning several models (e.g. the unified M0 + M1 optimizer), which a single
+    DistributedDataParallel wrapper cannot cover.
+    """
+    world_size = getWorldSize()
+    if world_size == 1:
+        return
+    buckets = {}
+    for group in optimizer.param_groups:
+        for param in group["params"]:
+            if param.grad is not None:
+                buckets.setdefault((param.grad.device, param.grad.dtype), []).append(param.grad)
+    for grads in buckets.values():
+        flat = _flatten_dense_tensors(grads)
+        dist.all_reduce(flat)
+        flat /= world_size
+        for grad, synced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+            grad.copy_(synced)
+
+
+def allReduceSum(values):
+    """
+    Sums a list of python numbers across the ranks, e.g. running losses and sample counts
+    """
+    if getWorldSize() == 1:
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64)
+    if dist.get_backend() == "nccl":
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def broadcastFlag(flag):
+    """
+    Decision of rank 0 (e.g. early stopping) for every rank
+    """
+    if getWorldSize() == 1:
+        return flag
+    tensor = torch.tensor([int(flag)])
+    if dist.get_backend() == "nccl":
+        tensor = tensor.cuda()
+    dist.broadcast(tensor, src=0)
+    return bool(tensor.item())
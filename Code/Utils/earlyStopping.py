@@ -0,0 +1,57 @@
+import math
+
+
+class EarlyStopping:
+    """
+    Plateau detection on a validation loss
+    Stops once `patience` consecutive validations did not improve the best loss by more than min_delta. With
+    patience=None the run is never stopped, the best epoch is still tracked for the time-to-target report.
+    """
+
+    def __init__(self, name, patience=None, min_delta=0.0):
+        self.name = name
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = math.inf
+        self.best_epoch = None
+        self.best_elapsed = None
+        self.bad_validations = 0
+
+    def step(self, loss, epoch, elapsed):
+        """
+        :param elapsed: wall clock seconds since the start of the run
+        :return: True if the loss improved
+        """
+        if loss < self.best - self.min_delta:
+            self.best = loss
+            self.best_epoch = epoch
+            self.best_elapsed = elapsed
+            self.bad_validations = 0
+            return True
+        self.bad_validations += 1
+        return False
+
+    @property
+    def shouldStop(self):
+        return self.patience is not None and self.bad_validations >= self.patience
+
+    def report(self):
+        if self.best_epoch is None:
+            return "{} : no validation run".format(self.name)
+        return "{} : best {:.4f} reached at epoch {} after {:.1f} min".format(self.name, self.best, self.best_epoch,
+                                                                             self.best_elapsed / 60.)
+
+    def state_dict(self):
+        return {"best": self.best, "best_epoch": self.best_epoch, "best_elapsed": self.best_elapsed,
+                "bad_validations": self.bad_validations}
+
+    def load_state_dict(self, state):
+        self.best = state["best"]
+        self.best_epoch = state["best_epoch"]
+        self.best_elapsed = state["best_elapsed"]
+        self.bad_validations = state["bad_validations"]
+
+
+def isValidationEpoch(epoch, num_epochs, val_interval):
+    # The last epoch is always validated, so the final weights are always compared against the best ones
+    return (epoch + 1) % val_interval == 0 or epoch == num_epochs - 1
@@ -0,0 +1,89 @@
+import os
+import hashlib
+import logging
+
+import torch
+
+from Code.Utils.artifacts import fileHash
+from Code.Utils.checkpoint import atomicSave
+
+
+def pairHash(ct, mri, mri_lbl, weights_hash):
+    """
+    Content hash of one CT/MRI pair and MRI label registered by the M1 weights with the given hash
+    """
+    h = hashlib.sha256(weights_hash.encode())
+    for tensor in (ct, mri, mri_lbl):
+        tensor = tensor.detach().float().cpu().contiguous()
+        h.update(str(tuple(tensor.shape)).encode())
+        h.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+class FlowCache:
+    """
+    Mscgunet registrations keyed by the content of the image pair and the M1 weights, evaluating or fine-tuning M0
+    against a fixed M1 reads the warped MRI and pseudo label from here instead of registering the pair again
+    Every entry holds the flow, warped MRI and pseudo label in dtype (float16 by default) and the M1 loss. The flow is
+    kept at the integration (half) resolution unless full_resolution=True.
+    """
+
+    def __init__(self, root, M1_bw_path=None, weights_hash=None, dtype=torch.float16, full_resolution=False):
+        self.root = root
+        self.weights_hash = weights_hash if weights_hash is not None else fileHash(M1_bw_path)
+        self.dtype = dtype
+        self.full_resolution = full_resolution
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def config(self):
+        # Cached registrations differ from fresh ones by the storage precision, results depending on them record it
+        return {"dtype": str(self.dtype), "full_resolution": self.full_resolution}
+
+    def entryPath(self, key):
+        return os.path.join(self.root, key[:2], key + ".pt")
+
+    def keys(self, CT, MRI, MRI_LBL):
+        return [pairHash(CT[i], MRI[i], MRI_LBL[i], self.weights_hash) for i in range(CT.shape[0])]
+
+    def get(self, key, device="cpu"):
+        path = self.entryPath(key)
+        if not os.path.isfile(path):
+            return None
+        return torch.load(path, map_location=device)
+
+    def put(self, key, warped, pseudo_lbl, flow, loss):
+        entry = {"warped": warped.detach().to("cpu", self.dtype),
+                 "pseudo_lbl": pseudo_lbl.detach().to("cpu", self.dtype),
+                 "flow": flow.detach().to("cpu", self.dtype),
+                 "full_resolution": self.full_resolution, "loss": float(loss)}
+        path = self.entryPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomicSave(entry, path)
+
+    def lossCal(self, modelM1, CT, MRI, MRI_LBL):
+        """
+        Drop-in for modelM1.lossCal: loss, warped MRI, pseudo label
+        A batch whose pairs are all cached skips the registration, its loss is the mean of the stored batch losses
+        (exact for batch size 1). Otherwise the whole batch is registered and every pair is stored.
+        """
+        keys = self.keys(CT, MRI, MRI_LBL)
+        if all(os.path.isfile(self.entryPath(key)) for key in keys):
+            entries = [self.get(key, modelM1.device) for key in keys]
+            self.hits += len(keys)
+            warped = torch.stack([entry["warped"] for entry in entries]).float()
+            pseudo_lbl = torch.stack([entry["pseudo_lbl"] for entry in entries]).float()
+            loss = torch.tensor(sum(entry["loss"] for entry in entries) / len(entries), device=modelM1.device)
+            return loss, warped, pseudo_lbl
+
+        self.misses += len(keys)
+        loss, warped, pseudo_lbl, flow = modelM1.lossCal(CT, MRI, MRI_LBL, return_flow=True)
+        stored_flow = modelM1.fullsize(flow) if self.full_resolution else flow
+        for i, key in enumerate(keys):
+            self.put(key, warped[i], pseudo_lbl[i], stored_flow[i], loss.item())
+        # Same precision as a cache hit, so results do not depend on which pairs were cached already
+        return loss, warped.detach().to(self.dtype).float(), pseudo_lbl.detach().to(self.dtype).float()
+
+    def logStats(self):
+        logging.info("Flow cache {} : {} hits, {} misses".format(self.root, self.hits, self.misses))
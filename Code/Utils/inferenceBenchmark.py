@@ -0,0 +1,192 @@
+import os
+import sys
+import time
+import logging
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT_DIR + "/")
+
+from Code.Utils.results import ResultStreamWriter
+from Code.Utils.inferenceOptimizer import optimizeForInference
+from Code.Utils.tta import ttaPredict, augmentations
+from Model.M0 import U_Net_M0
+from Model.DeepSupAttUNet3D import DeepSupAttentionUnet, AttnGatingBlock
+
+RESULT_COLUMNS = ["benchmark", "variant", "device", "shape", "mean_ms", "median_ms", "min_ms", "peak_memory_mb",
+                  "max_abs_diff", "speedup"]
+
+
+def synchronize(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+
+
+def benchmark(fn, inputs, device="cpu", warmup=3, repeats=10):
+    """
+    Latency of fn(*inputs) after warmup untimed calls
+    Peak memory is the allocator peak of the timed calls on CUDA. On the CPU it is reported as NaN: the peak RSS is a
+    process-lifetime high-water mark and would credit every variant with the peak of the ones measured before it.
+    """
+    isCuda = str(device).startswith("cuda")
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(*inputs)
+        synchronize(device)
+        if isCuda:
+            torch.cuda.reset_peak_memory_stats(device)
+        times = []
+        for _ in range(repeats):
+            since = time.perf_counter()
+            fn(*inputs)
+            synchronize(device)
+            times.append((time.perf_counter() - since) * 1000.)
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if isCuda else float("nan")
+    return {"mean_ms": float(np.mean(times)), "median_ms": float(np.median(times)), "min_ms": float(np.min(times)),
+            "peak_memory_mb": peak}
+
+
+def maxAbsDiff(a, b):
+    return (a.float() - b.float()).abs().max().item()
+
+
+def compare(name, variants, inputs, device, reference=None, warmup=3, repeats=10):
+    """
+    Benchmarks every variant on the same inputs and checks it against the first one (or reference)
+    :param variants: dict variant name -> callable returning the output tensor
+    :return: result rows, speedup relative to the first variant
+    """
+    with torch.no_grad():
+        expected = reference if reference is not None else next(iter(variants.values()))(*inputs)
+    rows = []
+    for variant, fn in variants.items():
+        row = dict(benchmark=name, variant=variant, device=str(device), shape="x".join(map(str, inputs[0].shape)))
+        row.update(benchmark(fn, inputs, device, warmup, repeats))
+        with torch.no_grad():
+            row["max_abs_diff"] = maxAbsDiff(fn(*inputs), expected)
+        row["speedup"] = rows[0]["median_ms"] / row["median_ms"] if rows else 1.
+        rows.append(row)
+        logging.info(str(row))
+    return rows
+
+
+def deepSupHeads(device, shape, warmup=3, repeats=10):
+    """
+    DeepSupAttentionUnet with all four heads against forward_final, which computes only the final map
+    """
+    model = DeepSupAttentionUnet(1, 1).to(device).eval()
+    x = torch.rand(shape, device=device)
+    return compare("deepsup_heads", {"all_heads": lambda inp: model(inp)[3],
+                                     "final_head": model.forward_final}, [x], device,
+                   warmup=warmup, repeats=repeats)
+
+
+def randomizeBatchNorm(model, seed=42):
+    # Freshly initialized BatchNorm layers are identities, random statistics make the parity check meaningful
+    generator = torch.Generator().manual_seed(seed)
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm3d):
+            shape = module.running_mean.shape
+            module.running_mean.copy_(torch.randn(shape, generator=generator) * 0.1)
+            module.running_var.copy_(torch.rand(shape, generator=generator) + 0.5)
+            module.weight.data.copy_(torch.rand(shape, generator=generator) + 0.5)
+            module.bias.data.copy_(torch.randn(shape, generator=generator) * 0.1)
+    return model
+
+
+def foldedModels(device, shape, warmup=3, repeats=10):
+    """
+    Eager model against the BatchNorm folded copy and the folded, traced and fused TorchScript graph
+    """
+    rows = []
+    for name, model in (("U_Net_M0", U_Net_M0()), ("DeepSup", DeepSupAttentionUnet(1, 1))):
+        model = randomizeBatchNorm(model).to(device).eval()
+        x = torch.rand(shape, device=device)
+        folded = optimizeForInference(model)
+        scripted = optimizeForInference(model, [x], script=True)
+        # DeepSupAttentionUnet is compared on its final map
+        final = (lambda fn: (lambda inp: fn(inp)[3])) if name == "DeepSup" else (lambda fn: fn)
+        rows += compare("fold_" + name, {"eager": final(model), "folded": final(folded),
+                                         "folded_jit": final(scripted)}, [x], device,
+                        warmup=warmup, repeats=repeats)
+    return rows
+
+
+def repeatedGate(block, x, g):
+    """
+    Former AttnGatingBlock.forward, which copied the upsampled gate for every channel of x before multiplying
+    """
+    psi = torch.sigmoid(block.conv3(block.act_xg(block.conv1(x) + block.conv2(g))))
+    upsample_psi = F.interpolate(psi, scale_factor=2, mode='nearest').repeat(1, x.shape[1], 1, 1, 1)
+    return block.bn1(block.conv4(torch.mul(upsample_psi, x)))
+
+
+def attentionGates(device, shape, warmup=3, repeats=10):
+    """
+    Broadcast attention gate against the repeated one at the three gating levels of DeepSupAttentionUnet
+    shape is the network input, x and g are sized like the skip connection and gating signal of each level
+    """
+    rows = []
+    depth, height, width = shape[2:]
+    for level, (x_channels, g_channels, inter_channels, scale) in enumerate(((256, 512, 128, 8), (128, 288, 64, 4),
+                                                                            (64, 192, 32, 2)), 1):
+        block = AttnGatingBlock(x_channels, g_channels, inter_channels, is_leaky=True)
+        block = randomizeBatchNorm(block).to(device).eval()
+        x = torch.rand((shape[0], x_channels, depth // scale, height // scale, width // scale), device=device)
+        g = torch.rand((shape[0], g_channels, depth // scale // 2, height // scale // 2, width // scale // 2),
+                       device=device)
+        rows += compare("attn_gate_{}".format(level), {"repeat": lambda a, b: repeatedGate(block, a, b),
+                                                       "broadcast": block}, [x, g], device,
+                        warmup=warmup, repeats=repeats)
+    return rows
+
+
+def testTimeAugmentation(device, shape, warmup=3, repeats=10):
+    """
+    Single forward pass against test-time augmentation with all views in one batch and with one pass per view
+    The TTA variants differ from the single pass by design, max_abs_diff is reported against the batched TTA.
+    """
+    model = U_Net_M0().to(device).eval()
+    x = torch.rand(shape, device=device)
+    transforms = augmentations(x.shape)
+    with torch.no_grad():
+        reference = ttaPredict(model, x, transforms)
+    return compare("tta_{}_views".format(len(transforms)),
+                   {"single": model,
+                    "tta_batched": lambda inp: ttaPredict(model, inp, transforms),
+                    "tta_sequential": lambda inp: ttaPredict(model, inp, transforms, max_views=shape[0])},
+                   [x], device, reference=reference, warmup=warmup, repeats=repeats)
+
+
+BENCHMARKS = {"deepsup": deepSupHeads, "fold": foldedModels, "attention": attentionGates,
+              "tta": testTimeAugmentation}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency, memory and parity of the inference variants of the models")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS))
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--shape", type=int, nargs=5, default=[1, 1, 32, 128, 128])
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--output", default="inference_benchmark.csv")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rows = BENCHMARKS[args.benchmark](args.device, tuple(args.shape), args.warmup, args.repeats)
+    with ResultStreamWriter(args.output, RESULT_COLUMNS, string_columns=("benchmark", "variant", "device", "shape")) \
+            as writer:
+        for row in rows:
+            writer.write(row)
+    for row in rows:
+        print("{:<16} {:<14} median {:9.2f} ms  peak {:9.1f} MB  max|diff| {:.2e}  speedup {:.2f}x".format(
+            row["benchmark"], row["variant"], row["median_ms"], row["peak_memory_mb"], row["max_abs_diff"],
+            row["speedup"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import copy
+import logging
+
+import torch
+import torch.nn as nn
+
+from Model.M0 import conv_block, up_conv
+from Model.DeepSupAttUNet3D import UnetConv3D, UnetGatingSignal, AttnGatingBlock
+
+# Convolutions followed by a BatchNorm3d in the forward of the blocks that keep them as separate attributes
+FOLD_PAIRS = {UnetConv3D: [("conv1", "bn1"), ("conv2", "bn2")],
+              UnetGatingSignal: [("conv", "bn")],
+              AttnGatingBlock: [("conv4", "bn1")]}
+
+
+def foldConvBN(conv, bn):
+    """
+    Convolution computing conv followed by the eval-mode bn
+    W' = W * gamma / sqrt(var + eps), b' = (b - mean) * gamma / sqrt(var + eps) + beta
+    """
+    fused = copy.deepcopy(conv)
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps) if bn.affine \
+        else 1. / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias.detach() if bn.affine else torch.zeros_like(bn.running_mean)
+    bias = conv.bias.detach() if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight = nn.Parameter(conv.weight.detach() * scale.reshape(-1, *([1] * (conv.weight.dim() - 1))))
+    fused.bias = nn.Parameter((bias - bn.running_mean) * scale + shift)
+    return fused
+
+
+def _foldSequential(sequential):
+    # conv_block and up_conv: Conv3d directly followed by BatchNorm3d inside an nn.Sequential
+    folded = 0
+    for i in range(len(sequential) - 1):
+        if isinstance(sequential[i], nn.Conv3d) and isinstance(sequential[i + 1], nn.BatchNorm3d):
+            sequential[i] = foldConvBN(sequential[i], sequential[i + 1])
+            sequential[i + 1] = nn.Identity()
+            folded += 1
+    return folded
+
+
+def foldBatchNorm(model):
+    """
+    Folds every eval-mode BatchNorm3d of the segmentation models into the preceding convolution, in place
+    :return: number of folded pairs
+    """
+    folded = 0
+    for module in model.modules():
+        if isinstance(module, (conv_block, up_conv)):
+            folded += _foldSequential(module.conv if isinstance(module, conv_block) else module.up)
+        for conv_name, bn_name in FOLD_PAIRS.get(type(module), []):
+            conv, bn = getattr(module, conv_name), getattr(module, bn_name)
+            # is_batchnorm=False blocks use an empty nn.Sequential instead of the BatchNorm3d
+            if isinstance(bn, nn.BatchNorm3d):
+                setattr(module, conv_name, foldConvBN(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+                folded += 1
+    return folded
+
+
+def optimizeForInference(model, example_inputs=None, script=False):
+    """
+    Returns an inference-only copy of an M0 model, the original is left untouched
+    The BatchNorm layers are folded into the convolutions. With script=True the folded model is additionally traced,
+    frozen and passed through torch.jit.optimize_for_inference, which fuses the convolutions with the following
+    activations (and on the CPU selects the MKLDNN kernels); the trace is specialized to the example input shapes.
+    """
+    optimized = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        folded = foldBatchNorm(optimized)
+    logging.info("Folded {} Conv3d/BatchNorm3d pairs".format(folded))
+    if script:
+        with torch.no_grad():
+            traced = torch.jit.trace(optimized, tuple(example_inputs), check_trace=False)
+            optimized = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    return optimized
@@ -60,3 +60,25 @@ def focal_tversky_loss(pred, target, alpha=0.7, beta=0.3, gamma=4. / 3.):
                     torch.finfo(torch.float32).eps + intersection + alpha * non_p_g + beta * p_non_g + smooth)
         ftl += (1. - ti) ** (1. / gamma + torch.finfo(torch.float32).eps)
     return ftl
+
+
+def dice_per_sample(y_pred, y_true, smooth=1):
+    """Dice score of every sample of the batch, same smoothing as DiceLoss.
+    y_pred: tensor with first dimension as batch
+    y_true: tensor with first dimension as batch
+    """
+    assert y_pred.size() == y_true.size()
+    pflat = y_pred.flatten(1)
+    tflat = y_true.flatten(1)
+    intersection = (pflat * tflat).sum(1)
+    union = (pflat + tflat).sum(1)
+    return (2. * intersection + smooth) / (union + smooth)
+
+
+def normalize_per_sample(img):
+    """Min-max normalisation of every sample of the batch on its own"""
+    flat = img.flatten(1)
+    shape = (-1,) + (1,) * (img.dim() - 1)
+    img_min = flat.min(1)[0].view(shape)
+    img_max = flat.max(1)[0].view(shape)
+    return (img - img_min) / (img_max - img_min)
@@ -0,0 +1,212 @@
+import numpy as np
+import torch
+from scipy import ndimage
+
+# Number of set bits for every possible byte, used to count voxels in bit-packed masks
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+METRIC_NAMES = ["dice", "jaccard", "precision", "sensitivity", "volume_difference", "hd95", "asd"]
+
+
+def toBinary(volume, threshold=0.5):
+    """
+    Converts a batch of predictions/labels into a boolean numpy array of shape (B, D, H, W)
+    :param volume: torch tensor or numpy array with shape (D, H, W), (B, D, H, W) or (B, 1, D, H, W)
+    :param threshold: voxels strictly above the threshold are foreground
+    """
+    if torch.is_tensor(volume):
+        volume = volume.detach().cpu()
+        mask = (volume > threshold) if volume.dtype != torch.bool else volume
+        mask = mask.numpy()
+    else:
+        volume = np.asarray(volume)
+        mask = (volume > threshold) if volume.dtype != bool else volume
+    if mask.ndim == 3:
+        mask = mask[np.newaxis]
+    elif mask.ndim == 5:
+        mask = mask[:, 0]
+    return mask
+
+
+def packMasks(masks):
+    """
+    Packs a boolean batch (B, ...) into a uint8 bitset of shape (B, ceil(N / 8))
+    """
+    return np.packbits(masks.reshape(masks.shape[0], -1), axis=1)
+
+
+def popcount(packed):
+    return _POPCOUNT[packed].sum(axis=1, dtype=np.int64)
+
+
+def confusionMatrix(pred, gt, packed=False):
+    """
+    Computes TP, FP, FN and TN for every item of the batch in a single pass
+    :param pred: boolean array (B, D, H, W)
+    :param gt: boolean array (B, D, H, W)
+    :param packed: count on bit-packed masks instead of the boolean voxels
+    :return: four int64 arrays of length B
+    """
+    assert pred.shape == gt.shape
+    n_voxels = int(np.prod(pred.shape[1:]))
+    if packed:
+        p = packMasks(pred)
+        g = packMasks(gt)
+        # Padding bits are zero in both masks, so they never contribute to TP, FP or FN
+        tp = popcount(p & g)
+        fp = popcount(p & ~g)
+        fn = popcount(~p & g)
+    else:
+        p = pred.reshape(pred.shape[0], -1)
+        g = gt.reshape(gt.shape[0], -1)
+        tp = np.count_nonzero(p & g, axis=1).astype(np.int64)
+        fp = np.count_nonzero(p, axis=1) - tp
+        fn = np.count_nonzero(g, axis=1) - tp
+    tn = n_voxels - tp - fp - fn
+    return tp, fp, fn, tn
+
+
+def _surface(mask):
+    return mask ^ ndimage.binary_erosion(mask, structure=ndimage.generate_binary_structure(mask.ndim, 1))
+
+
+def surfaceDistances(pred, gt, spacing=None):
+    """
+    Symmetric surface distances between two boolean volumes
+    :return: (distances pred->gt, distances gt->pred) or None if either mask is empty
+    """
+    if not pred.any() or not gt.any():
+        return None
+    # Distance transforms only need the bounding box around both masks (plus a one voxel border)
+    coords = np.argwhere(pred | gt)
+    lo = np.maximum(coords.min(0) - 1, 0)
+    hi = np.minimum(coords.max(0) + 2, pred.shape)
+    crop = tuple(slice(l, h) for l, h in zip(lo, hi))
+    pred = np.pad(pred[crop], 1)
+    gt = np.pad(gt[crop], 1)
+
+    pred_border = _surface(pred)
+    gt_border = _surface(gt)
+    dt_gt = ndimage.distance_transform_edt(~gt_border, sampling=spacing)
+    dt_pred = ndimage.distance_transform_edt(~pred_border, sampling=spacing)
+    return dt_gt[pred_border], dt_pred[gt_border]
+
+
+def _safeDivide(num, den, empty_value):
+    num = num.astype(np.float64)
+    den = den.astype(np.float64)
+    out = np.full(num.shape, empty_value, dtype=np.float64)
+    np.divide(num, den, out=out, where=den > 0)
+    return out
+
+
+def segmentationMetrics(pred, gt, threshold=0.5, spacing=None, surface=True, packed=False):
+    """
+    Computes overlap and surface-distance metrics for a batch of segmentations
+    :param pred: predictions, torch tensor or numpy array (see toBinary for accepted shapes)
+    :param gt: ground truth with the same shape as pred
+    :param threshold: binarisation threshold applied to both pred and gt
+    :param spacing: voxel spacing per axis, distances are reported in the same unit
+    :param surface: compute Hausdorff-95 and average surface distance
+    :param packed: count the confusion matrix on bit-packed masks
+    :return: dict of metric name -> numpy array of length B
+    """
+    pred = toBinary(pred, threshold)
+    gt = toBinary(gt, threshold)
+    tp, fp, fn, tn = confusionMatrix(pred, gt, packed=packed)
+
+    metrics = {"dice": _safeDivide(2 * tp, 2 * tp + fp + fn, 1.0),
+               "jaccard": _safeDivide(tp, tp + fp + fn, 1.0),
+               "precision": _safeDivide(tp, tp + fp, 1.0),
+               "sensitivity": _safeDivide(tp, tp + fn, 1.0),
+               "volume_difference": _safeDivide((tp + fp) - (tp + fn), tp + fn, 0.0)}
+
+    hd95 = np.full(len(tp), np.nan)
+    asd = np.full(len(tp), np.nan)
+    if surface:
+        for i in range(len(tp)):
+            distances = surfaceDistances(pred[i], gt[i], spacing)
+            if distances is None:
+                continue
+            d_pg, d_gp = distances
+            hd95[i] = max(np.percentile(d_pg, 95), np.percentile(d_gp, 95))
+            asd[i] = (d_pg.sum() + d_gp.sum()) / (len(d_pg) + len(d_gp))
+    metrics["hd95"] = hd95
+    metrics["asd"] = asd
+    return metrics
+
+
+class SegmentationMetrics:
+    """
+    Accumulates per-volume metrics over several batches
+    """
+
+    def __init__(self, threshold=0.5, spacing=None, surface=True, packed=False):
+        self.threshold = threshold
+        self.spacing = spacing
+        self.surface = surface
+        self.packed = packed
+        self.results = {name: [] for name in METRIC_NAMES}
+
+    def update(self, pred, gt):
+        batch = segmentationMetrics(pred, gt, self.threshold, self.spacing, self.surface, self.packed)
+        for name in METRIC_NAMES:
+            self.results[name].extend(batch[name].tolist())
+        return batch
+
+    def compute(self):
+        return {name: float(np.nanmean(values)) if len(values) and not np.all(np.isnan(values)) else float("nan")
+                for name, values in self.results.items()}
+
+    def reset(self):
+        self.results = {name: [] for name in METRIC_NAMES}
+
+
+def ncc(img1, img2):
+    """
+    Global normalized cross correlation between two volumes
+    """
+    a = np.asarray(img1, dtype=np.float64).ravel()
+    b = np.asarray(img2, dtype=np.float64).ravel()
+    a = a - a.mean()
+    b = b - b.mean()
+    return float((a * b).sum() / (np.sqrt((a * a).sum() * (b * b).sum()) + 1e-8))
+
+
+def mutualInformation(img1, img2, bins=32):
+    """
+    Mutual information (in nats) estimated from the joint intensity histogram
+    """
+    joint, _, _ = np.histogram2d(np.asarray(img1).ravel(), np.asarray(img2).ravel(), bins=bins)
+    pxy = joint / joint.sum()
+    px = pxy.sum(1, keepdims=True)
+    py = pxy.sum(0, keepdims=True)
+    nonzero = pxy > 0
+    return float((pxy[nonzero] * np.log(pxy[nonzero] / (px @ py)[nonzero])).sum())
+
+
+def jacobianDeterminant(flow):
+    """
+    Jacobian determinant of the transform x -> x + u(x)
+    :param flow: displacement field in voxels, shape (3, D, H, W) or (B, 3, D, H, W), channel i displaces axis i
+    :return: numpy array of shape (B, D, H, W)
+    """
+    if torch.is_tensor(flow):
+        flow = flow.detach().float().cpu().numpy()
+    if flow.ndim == 4:
+        flow = flow[np.newaxis]
+    grads = [np.gradient(flow[:, i], axis=(1, 2, 3)) for i in range(3)]
+    J = [[grads[i][j] + (1.0 if i == j else 0.0) for j in range(3)] for i in range(3)]
+    return (J[0][0] * (J[1][1] * J[2][2] - J[1][2] * J[2][1])
+            - J[0][1] * (J[1][0] * J[2][2] - J[1][2] * J[2][0])
+            + J[0][2] * (J[1][0] * J[2][1] - J[1][1] * J[2][0]))
+
+
+def foldingFraction(jacobian_det):
+    """
+    Fraction of voxels where the transform folds (non-positive Jacobian determinant), one value per volume
+    """
+    jacobian_det = np.asarray(jacobian_det)
+    if jacobian_det.ndim == 3:
+        jacobian_det = jacobian_det[np.newaxis]
+    return (jacobian_det <= 0).reshape(jacobian_det.shape[0], -1).mean(1)
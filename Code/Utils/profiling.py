@@ -0,0 +1,93 @@
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+PHASES = ["data", "h2d", "forward", "loss", "backward", "allreduce", "optimizer", "logging", "checkpoint"]
+
+
+class StepTimer:
+    """
+    Times the phases of every training step and aggregates them per epoch
+    On CUDA devices the device is synchronised at each phase boundary, so asynchronous kernels are charged to the
+    phase that launched them. Phases may be entered several times per step (e.g. two forward passes), the per-step
+    mean is always total time / number of steps.
+    """
+
+    def __init__(self, device="cpu", enabled=True):
+        self.enabled = enabled
+        self.device = device
+        self.sync = enabled and str(device).startswith("cuda") and torch.cuda.is_available()
+        self.mode = "Train"
+        self.history = []
+        self._reset()
+
+    def _reset(self):
+        self.totals = OrderedDict()
+        self.steps = OrderedDict()
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+
+    def _add(self, name, elapsed):
+        key = self.mode + "/" + name
+        self.totals[key] = self.totals.get(key, 0.0) + elapsed
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self._add(name, time.perf_counter() - start)
+
+    def iterate(self, iterable):
+        """
+        Wraps a dataloader, charging the time spent waiting for each batch to the 'data' phase
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            if self.enabled:
+                self._add("data", time.perf_counter() - start)
+                self.steps[self.mode] = self.steps.get(self.mode, 0) + 1
+            yield batch
+
+    def endEpoch(self, epoch, writer=None):
+        """
+        Closes the epoch: returns (and optionally writes to TensorBoard) the per phase totals and per step means
+        """
+        if not self.enabled:
+            return {}
+        summary = OrderedDict()
+        for key, total in self.totals.items():
+            mode = key.split("/")[0]
+            steps = max(self.steps.get(mode, 0), 1)
+            summary[key] = {"total_s": total, "per_step_ms": 1000. * total / steps}
+            if writer is not None:
+                writer.add_scalar("Timing/" + key + "_ms", 1000. * total / steps, epoch)
+        self.history.append({"epoch": epoch, "steps": dict(self.steps), "phases": summary})
+        self._reset()
+        return summary
+
+    def dumpJSON(self, path):
+        if not self.enabled:
+            return
+        overall = OrderedDict()
+        for entry in self.history:
+            for key, value in entry["phases"].items():
+                overall[key] = overall.get(key, 0.0) + value["total_s"]
+        with open(path, "w") as f:
+            json.dump({"total_s": overall, "epochs": self.history}, f, indent=2)
@@ -0,0 +1,51 @@
+import csv
+import os
+
+
+class ResultStreamWriter:
+    """
+    Appends result rows to a CSV or Parquet file as soon as they are available
+    Parquet output needs pyarrow and is only readable once close() has written the footer, prefer CSV for long runs
+    """
+
+    def __init__(self, path, columns, string_columns=()):
+        self.path = path
+        self.columns = list(columns)
+        self.isParquet = path.endswith(".parquet")
+        self._writer = None
+        self._file = None
+
+        if self.isParquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._pa = pa
+            self._schema = pa.schema([(name, pa.string() if name in string_columns else pa.float64())
+                                      for name in self.columns])
+            self._writer = pq.ParquetWriter(path, self._schema)
+        else:
+            new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+            self._file = open(path, "a", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns, extrasaction="ignore")
+            if new_file:
+                self._writer.writeheader()
+                self._file.flush()
+
+    def write(self, row):
+        if self.isParquet:
+            table = self._pa.Table.from_pylist([{name: row.get(name) for name in self.columns}], schema=self._schema)
+            self._writer.write_table(table)
+        else:
+            self._writer.writerow(row)
+            self._file.flush()
+
+    def close(self):
+        if self.isParquet:
+            self._writer.close()
+        else:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
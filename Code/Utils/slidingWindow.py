@@ -0,0 +1,97 @@
+import itertools
+
+import torch
+import torch.nn.functional as F
+
+from Code.Utils.tta import ttaPredict
+
+# Gaussian importance maps keyed by (patch_size, sigma_scale, dtype, device)
+_importance_cache = {}
+
+
+def gaussianImportance(patch_size, sigma_scale=0.125, dtype=torch.float32, device="cpu"):
+    """
+    Separable gaussian centred on the patch, the voxels near the border of a tile get a small but non-zero weight
+    :param sigma_scale: sigma as a fraction of the patch size along every axis
+    """
+    key = (tuple(patch_size), sigma_scale, dtype, torch.device(device))
+    if key not in _importance_cache:
+        importance = None
+        for size in patch_size:
+            coords = torch.arange(size, dtype=torch.float64) - (size - 1) / 2.
+            gauss = torch.exp(-coords ** 2 / (2 * (size * sigma_scale) ** 2))
+            importance = gauss if importance is None else importance.unsqueeze(-1) * gauss
+        importance = (importance / importance.max()).clamp(min=1e-3)
+        _importance_cache[key] = importance.to(dtype=dtype, device=device)
+    return _importance_cache[key]
+
+
+def tileStarts(size, patch, overlap):
+    """
+    Start offsets along one axis, the last tile is aligned to the end of the volume
+    """
+    if size <= patch:
+        return [0]
+    step = max(1, int(patch * (1 - overlap)))
+    starts = list(range(0, size - patch + 1, step))
+    if starts[-1] != size - patch:
+        starts.append(size - patch)
+    return starts
+
+
+def _predictor(model):
+    # DeepSupAttentionUnet skips its deep supervision heads at inference, they are not blended
+    return model.forward_final if hasattr(model, "forward_final") else model
+
+
+def slidingWindowInference(model, volume, patch_size=(32, 128, 128), overlap=0.5, sw_batch_size=4, device="cuda",
+                           output_device="cpu", sigma_scale=0.125, amp=False, tta=False):
+    """
+    Segments a volume of any size with a model trained on fixed size patches
+    The tiles are sent through the model sw_batch_size at a time and blended with gaussian importance weights into a
+    preallocated output, so the memory on the device is bounded by one tile batch regardless of the volume size.
+    :param volume: (C, D, H, W) or (1, C, D, H, W) tensor at native resolution, usually on the CPU
+    :param patch_size: tile size, a multiple of 16 for the four pooling levels of the M0 models
+    :param overlap: fraction of the patch shared by neighbouring tiles
+    :param tta: every tile is predicted as the average over its flipped (and, for square tiles, rotated) views
+    :return: (1, out_channels, D, H, W) tensor on output_device
+    """
+    if volume.dim() == 4:
+        volume = volume.unsqueeze(0)
+    shape = volume.shape[2:]
+
+    # Volumes smaller than a patch along some axis are padded and the padding is cropped at the end
+    pad = [max(0, p - s) for s, p in zip(shape, patch_size)]
+    if any(pad):
+        volume = F.pad(volume, [0, pad[2], 0, pad[1], 0, pad[0]])
+    padded_shape = volume.shape[2:]
+
+    importance = gaussianImportance(patch_size, sigma_scale, device=device)
+    output = None
+    weight = torch.zeros((1, 1) + tuple(padded_shape), dtype=torch.float32, device=output_device)
+    starts = list(itertools.product(*[tileStarts(s, p, overlap) for s, p in zip(padded_shape, patch_size)]))
+
+    base = _predictor(model)
+    predict = (lambda tiles: ttaPredict(base, tiles)) if tta else base
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        for i in range(0, len(starts), sw_batch_size):
+            batch_starts = starts[i:i + sw_batch_size]
+            slices = [tuple(slice(s, s + p) for s, p in zip(start, patch_size)) for start in batch_starts]
+            tiles = torch.cat([volume[(slice(None), slice(None)) + s] for s in slices]).to(device, torch.float)
+            with torch.cuda.amp.autocast(enabled=amp):
+                prediction = predict(tiles)
+            prediction = (prediction.float() * importance).to(output_device)
+
+            if output is None:
+                output = torch.zeros((1, prediction.shape[1]) + tuple(padded_shape), dtype=torch.float32,
+                                     device=output_device)
+            weight_tile = importance.to(output_device)
+            for j, s in enumerate(slices):
+                output[(slice(None), slice(None)) + s] += prediction[j]
+                weight[(slice(None), slice(None)) + s] += weight_tile
+    model.train(was_training)
+
+    output /= weight
+    return output[:, :, :shape[0], :shape[1], :shape[2]]
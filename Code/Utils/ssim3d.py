@@ -0,0 +1,141 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+# Separable gaussian kernels keyed by (window_size, sigma, channel, dtype, device)
+_window_cache = {}
+
+# Default weights of the five MS-SSIM scales (Wang et al. 2003)
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+
+def gaussianWindow3D(window_size, channel, dtype=torch.float32, device="cpu", sigma=1.5):
+    """
+    Returns the three 1D gaussian kernels (along D, H and W) used for a separable 3D convolution
+    Each kernel is shaped for a grouped conv3d: (channel, 1, k, 1, 1), (channel, 1, 1, k, 1), (channel, 1, 1, 1, k)
+    """
+    key = (window_size, sigma, channel, dtype, torch.device(device))
+    if key not in _window_cache:
+        coords = torch.arange(window_size, dtype=torch.float64) - window_size // 2
+        gauss = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+        gauss = (gauss / gauss.sum()).to(dtype=dtype, device=device)
+        kernel = gauss.view(1, 1, -1).repeat(channel, 1, 1)
+        _window_cache[key] = (kernel.view(channel, 1, -1, 1, 1),
+                              kernel.view(channel, 1, 1, -1, 1),
+                              kernel.view(channel, 1, 1, 1, -1))
+    return _window_cache[key]
+
+
+def _blur(img, window):
+    channel = img.shape[1]
+    for kernel in window:
+        padding = tuple(s // 2 for s in kernel.shape[2:])
+        img = F.conv3d(img, kernel, padding=padding, groups=channel)
+    return img
+
+
+def _ssim3d(img1, img2, window, data_range=1.0):
+    C1 = (0.01 * data_range) ** 2
+    C2 = (0.03 * data_range) ** 2
+
+    # Blur the five statistics in a single grouped convolution pass, the window is built for 5 * channel groups
+    channel = img1.shape[1]
+    stats = torch.cat([img1, img2, img1 * img1, img2 * img2, img1 * img2], 1)
+    stats = _blur(stats, window)
+    mu1, mu2, e11, e22, e12 = torch.split(stats, channel, 1)
+
+    mu1_sq = mu1.pow(2)
+    mu2_sq = mu2.pow(2)
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = e11 - mu1_sq
+    sigma2_sq = e22 - mu2_sq
+    sigma12 = e12 - mu1_mu2
+
+    cs_map = (2 * sigma12 + C2) / (sigma1_sq + sigma2_sq + C2)
+    ssim_map = ((2 * mu1_mu2 + C1) / (mu1_sq + mu2_sq + C1)) * cs_map
+    return ssim_map, cs_map
+
+
+def _window(img, window_size, sigma):
+    # Window must fit in the volume and stay odd so that the padded output keeps the input size
+    window_size = min(window_size, *img.shape[2:])
+    window_size -= 1 - window_size % 2
+    return gaussianWindow3D(window_size, 5 * img.shape[1], img.dtype, img.device, sigma)
+
+
+def _prepare(img1, img2):
+    assert img1.shape == img2.shape, "Input volumes must have the same shape"
+    if img1.dim() == 3:
+        img1, img2 = img1[None, None], img2[None, None]
+    elif img1.dim() == 4:
+        img1, img2 = img1.unsqueeze(1), img2.unsqueeze(1)
+    if not img1.is_floating_point():
+        img1 = img1.float()
+    return img1, img2.to(img1.dtype)
+
+
+def ssim3d(img1, img2, window_size=11, size_average=True, data_range=1.0, sigma=1.5):
+    """
+    Volumetric SSIM
+    :param img1: tensor of shape (D, H, W), (B, D, H, W) or (B, C, D, H, W)
+    :param img2: tensor with the same shape as img1
+    :param size_average: return the mean over the batch, otherwise one value per volume
+    """
+    img1, img2 = _prepare(img1, img2)
+    window = _window(img1, window_size, sigma)
+    ssim_map, _ = _ssim3d(img1, img2, window, data_range)
+    if size_average:
+        return ssim_map.mean()
+    return ssim_map.flatten(1).mean(1)
+
+
+def ms_ssim3d(img1, img2, window_size=11, size_average=True, data_range=1.0, weights=MS_SSIM_WEIGHTS, sigma=1.5):
+    """
+    Volumetric multi-scale SSIM
+    The number of scales is reduced when the volume is too small to be halved len(weights) - 1 times
+    """
+    img1, img2 = _prepare(img1, img2)
+    max_levels = int(math.floor(math.log2(min(img1.shape[2:]) / 2))) + 1
+    weights = torch.tensor(weights[:max(1, min(len(weights), max_levels))], dtype=img1.dtype, device=img1.device)
+    weights = weights / weights.sum()
+
+    values = []
+    for level in range(len(weights)):
+        window = _window(img1, window_size, sigma)
+        ssim_map, cs_map = _ssim3d(img1, img2, window, data_range)
+        if level == len(weights) - 1:
+            values.append(torch.relu(ssim_map.flatten(1).mean(1)))
+        else:
+            values.append(torch.relu(cs_map.flatten(1).mean(1)))
+            img1 = F.avg_pool3d(img1, 2, ceil_mode=True)
+            img2 = F.avg_pool3d(img2, 2, ceil_mode=True)
+
+    values = torch.stack(values, 1)
+    ms_ssim = torch.prod(values ** weights, 1)
+    if size_average:
+        return ms_ssim.mean()
+    return ms_ssim
+
+
+class SSIM3D(torch.nn.Module):
+    def __init__(self, window_size=11, size_average=True, data_range=1.0, multiscale=False):
+        super(SSIM3D, self).__init__()
+        self.window_size = window_size
+        self.size_average = size_average
+        self.data_range = data_range
+        self.multiscale = multiscale
+
+    def forward(self, img1, img2):
+        if self.multiscale:
+            return ms_ssim3d(img1, img2, self.window_size, self.size_average, self.data_range)
+        return ssim3d(img1, img2, self.window_size, self.size_average, self.data_range)
+
+
+class SSIM3DLoss(SSIM3D):
+    """
+    1 - (MS-)SSIM, usable as a registration/reconstruction loss
+    """
+
+    def forward(self, img1, img2):
+        return 1 - super(SSIM3DLoss, self).forward(img1, img2)
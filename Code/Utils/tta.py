@@ -0,0 +1,45 @@
+import torch
+
+# Test-time augmentations of (B, C, D, H, W) volumes as (name, transform, inverse); the 90 degree rotations in the
+# H-W plane are only used for square slices
+FLIPS = [("identity", lambda x: x, lambda x: x),
+         ("flip_w", lambda x: x.flip(4), lambda x: x.flip(4)),
+         ("flip_h", lambda x: x.flip(3), lambda x: x.flip(3)),
+         ("flip_d", lambda x: x.flip(2), lambda x: x.flip(2)),
+         ("flip_hw", lambda x: x.flip(3, 4), lambda x: x.flip(3, 4))]
+ROTATIONS = [("rot90", lambda x: x.rot90(1, (3, 4)), lambda x: x.rot90(-1, (3, 4))),
+             ("rot270", lambda x: x.rot90(-1, (3, 4)), lambda x: x.rot90(1, (3, 4)))]
+
+
+def augmentations(shape, rotations=True):
+    if rotations and shape[-1] == shape[-2]:
+        return FLIPS + ROTATIONS
+    return list(FLIPS)
+
+
+def _final(output):
+    # DeepSupAttentionUnet returns every deep supervision level, only the final map is averaged
+    return output[-1] if isinstance(output, (tuple, list)) else output
+
+
+def ttaPredict(predict, volume, transforms=None, max_views=None):
+    """
+    Averages the predictions of all augmented views of the volume
+    The views are stacked into one batch and sent through the model in a single forward pass (or in chunks of
+    max_views volumes to bound the memory); the inverse transforms are applied on the device before averaging.
+    :param predict: model or callable returning (B, C, D, H, W) probabilities
+    :param volume: (B, C, D, H, W) tensor on the model device
+    """
+    transforms = augmentations(volume.shape) if transforms is None else transforms
+    batch_size = volume.shape[0]
+    views = torch.cat([transform(volume) for _, transform, _ in transforms])
+    if max_views is None:
+        outputs = _final(predict(views))
+    else:
+        outputs = torch.cat([_final(predict(chunk)) for chunk in torch.split(views, max_views)])
+
+    prediction = None
+    for (_, _, inverse), output in zip(transforms, torch.split(outputs, batch_size)):
+        output = inverse(output.float())
+        prediction = output if prediction is None else prediction + output
+    return prediction / len(transforms)
@@ -0,0 +1,87 @@
+import queue
+import logging
+import threading
+
+import matplotlib
+
+# Figures are rendered off the main thread, which only the non-interactive backend supports
+matplotlib.use("Agg")
+
+_STOP = object()
+
+
+def selectSlice(label):
+    """
+    Index of the first slice (along the first axis) that contains the label, 0 if the label is empty
+    """
+    labelled = (label.flatten(1).amax(1) == 1).nonzero()
+    return int(labelled[0]) if len(labelled) else 0
+
+
+def normalize(img):
+    return (img - img.min()) / (img.max() - img.min())
+
+
+class VisualizationWriter:
+    """
+    Renders figures and writes them to TensorBoard on a background thread
+    The training loop only submits detached CPU snapshots; when the bounded queue is full the frame is dropped
+    instead of stalling training
+    """
+
+    def __init__(self, writer, maxsize=2):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="VisualizationWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, figure_fn, tag, step, volumes, label_key=None, normalize_keys=(), block=False, **kwargs):
+        """
+        :param figure_fn: function building the matplotlib figure, called with one keyword argument per volume
+        :param volumes: dict name -> tensor, the first volume of each batch is snapshotted
+        :param label_key: volume used to pick the displayed slice, if None the volumes are passed unsliced
+        :param normalize_keys: slices that are min-max normalized before rendering
+        :param block: wait for a free queue slot instead of dropping the frame
+        :param kwargs: passed unchanged to figure_fn
+        """
+        if not block and self.queue.full():
+            self.dropped += 1
+            return False
+        snapshot = {}
+        for name, volume in volumes.items():
+            volume = volume.detach()
+            if label_key is not None:
+                volume = volume.reshape(-1, *volume.shape[-3:])[0]
+            snapshot[name] = volume.to("cpu", copy=True)
+        try:
+            self.queue.put((figure_fn, tag, step, snapshot, label_key, normalize_keys, kwargs), block=block)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _render(self, figure_fn, tag, step, volumes, label_key, normalize_keys, kwargs):
+        if label_key is not None:
+            slice = selectSlice(volumes[label_key])
+            volumes = {name: volume[slice, :, :].unsqueeze(0).float() for name, volume in volumes.items()}
+        for name in normalize_keys:
+            volumes[name] = normalize(volumes[name])
+        fig = figure_fn(**volumes, **kwargs)
+        self.writer.add_figure(tag, fig, step)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            try:
+                self._render(*item)
+            except Exception as e:
+                logging.warning("Visualization failed: " + repr(e))
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.dropped:
+            logging.info("Visualization frames dropped : " + str(self.dropped))
@@ -49,8 +49,8 @@ class AttnGatingBlock(torch.nn.Module):
         sigmoid_xg = torch.sigmoid(psi)
 
         upsample_psi = F.interpolate(sigmoid_xg, scale_factor=2, mode='nearest')  #F.interpolate(sigmoid_xg, scale_factor=2, mode='trilinear')
-        upsample_psi = upsample_psi.repeat(1, x.shape[1], 1, 1, 1)
 
+        # The single channel gate is broadcast over the channels of x instead of being copied for each of them
         y = torch.mul(upsample_psi, x)
         result = self.conv4(y)
         result_bn = self.bn1(result)
@@ -100,7 +100,7 @@ class DeepSupAttentionUnet(torch.nn.Module):
 
         self.finalact = finalact
 
-    def forward(self, x):
+    def _decoder(self, x):
         scale_img_2 = F.avg_pool3d(x, 2)
         scale_img_3 = F.avg_pool3d(scale_img_2, 2)
         scale_img_4 = F.avg_pool3d(scale_img_3, 2)
@@ -138,6 +138,18 @@ class DeepSupAttentionUnet(torch.nn.Module):
         up3 = torch.cat([self.act6(self.up3(up2)), attn3], 1)
 
         up4 = torch.cat([self.act7(self.up4(up3)), conv1], 1)
+        return up1, up2, up3, up4
+
+    def _activate(self, out):
+        if self.finalact == "sigmoid":
+            return torch.sigmoid(out)
+        elif self.finalact == "softmax":
+            return F.softmax(out, -3)
+        else:
+            return out
+
+    def forward(self, x):
+        up1, up2, up3, up4 = self._decoder(x)
 
         conv6 = self.conv6(up1)
         conv7 = self.conv7(up2)
@@ -149,12 +161,15 @@ class DeepSupAttentionUnet(torch.nn.Module):
         out8 = self.pred3(conv8)
         out9 = self.final(conv9)
 
-        if self.finalact == "sigmoid":
-            return torch.sigmoid(out6), torch.sigmoid(out7), torch.sigmoid(out8), torch.sigmoid(out9)
-        elif self.finalact == "softmax":
-            return F.softmax(out6, -3), F.softmax(out7, -3), F.softmax(out8, -3), F.softmax(out9, -3)
-        else:
-            return out6, out7, out8, out9
+        return self._activate(out6), self._activate(out7), self._activate(out8), self._activate(out9)
+
+    def forward_final(self, x):
+        """
+        Inference path: only the full resolution head, same result as forward(x)[3]
+        conv6 - conv8 and the auxiliary heads pred1 - pred3 only serve the deep supervision loss and are skipped
+        """
+        up1, up2, up3, up4 = self._decoder(x)
+        return self._activate(self.final(self.conv9(up4)))
 
     @staticmethod
     def forward_pass(model_forward, img, gt, criterion):